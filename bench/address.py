@@ -0,0 +1,33 @@
+"""
+アドレスとhash160の相互変換(base58check)の速さと、address_to_scriptのキャッシュの効果を測る。
+リポジトリのルートで `python -m bench.address` のように実行する。
+"""
+from hb.address import address_to_script, b58_addresses_to_hash160s, hash160s_to_b58_addresses
+
+import os
+import time
+
+
+def main() -> None:
+    count = 20000
+    h160s = [os.urandom(20) for _ in range(count)]
+
+    start = time.perf_counter()
+    addrs = hash160s_to_b58_addresses(h160s)
+    print(f"encode {count} addresses: {(time.perf_counter() - start) * 1e3:.1f} ms")
+
+    start = time.perf_counter()
+    assert b58_addresses_to_hash160s(addrs) == h160s
+    print(f"decode {count} addresses: {(time.perf_counter() - start) * 1e3:.1f} ms")
+
+    hot = addrs[:100]  # エクスプローラのように同じアドレスを何度も変換する
+    address_to_script.cache_clear()
+    start = time.perf_counter()
+    for _ in range(count // len(hot)):
+        for addr in hot:
+            address_to_script(addr)
+    print(f"address_to_script x{count} over {len(hot)} addresses: {(time.perf_counter() - start) * 1e3:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
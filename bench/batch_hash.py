@@ -0,0 +1,60 @@
+"""
+NumPyによるバッチSHA-256dと、hashlibによるスカラーのSHA-256d(util.sha256d / midstate再利用)のハッシュレートを比較する。
+リポジトリのルートで `python -m bench.batch_hash` のように実行する。
+"""
+from hb import batch_hash
+from hb.util import sha256d, HeaderHasher
+
+import os
+import time
+
+
+def bench_scalar(header_prefix: bytes, count: int) -> float:
+    start = time.perf_counter()
+    for i in range(count):
+        sha256d(header_prefix + i.to_bytes(4, "little"))
+    return count / (time.perf_counter() - start)
+
+
+def bench_midstate(header_prefix: bytes, count: int) -> float:
+    hasher = HeaderHasher(header_prefix)
+    start = time.perf_counter()
+    for i in range(count):
+        hasher.hash(i)
+    return count / (time.perf_counter() - start)
+
+
+def bench_batch(header_prefix: bytes, count: int, batch_size: int) -> float:
+    start = time.perf_counter()
+    for batch_start in range(0, count, batch_size):
+        batch_hash.search_nonces(header_prefix, 1 << 224, batch_start, min(batch_size, count - batch_start))
+    return count / (time.perf_counter() - start)
+
+
+def bench_validation(count: int) -> None:
+    headers = [os.urandom(80) for _ in range(count)]
+    start = time.perf_counter()
+    for header in headers:
+        sha256d(header)
+    scalar = count / (time.perf_counter() - start)
+    start = time.perf_counter()
+    batch_hash.check_headers_pow(headers, [1 << 224] * count)
+    batch = count / (time.perf_counter() - start)
+    print(f"header validation: scalar {scalar:,.0f} H/s, batch {batch:,.0f} H/s")
+
+
+def main() -> None:
+    if not batch_hash.available():
+        print("numpy is not installed")
+        return
+    header_prefix = os.urandom(76)
+    count = 1 << 18
+    print(f"sha256d:       {bench_scalar(header_prefix, count):,.0f} H/s")
+    print(f"midstate:      {bench_midstate(header_prefix, count):,.0f} H/s")
+    for batch_size in (1 << 12, 1 << 14, 1 << 16):
+        print(f"numpy({batch_size:>6}): {bench_batch(header_prefix, count, batch_size):,.0f} H/s")
+    bench_validation(1 << 14)
+
+
+if __name__ == "__main__":
+    main()
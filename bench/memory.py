@@ -0,0 +1,101 @@
+"""
+OutPoint、TxIn、TxOut、Tx、Blockを大量に保持したときのメモリ使用量を、__slots__を使わない以前のdataclassと比較する。
+リポジトリのルートで `python -m bench.memory [ブロック数] [1ブロックあたりのTx数]` のように実行する。
+"""
+from hb.tx import OutPoint, TxIn, TxOut, Tx
+from hb.block import Block
+
+from dataclasses import dataclass
+from typing import List
+
+import gc
+import sys
+import tracemalloc
+
+
+# 以前の(__dict__を持つ)モデルと同じフィールドのdataclass
+@dataclass
+class DictOutPoint:
+    tx_hash: bytes
+    index: int
+
+
+@dataclass
+class DictTxIn:
+    outpoint: DictOutPoint
+    script_sig: bytes
+    sequence: int
+
+
+@dataclass
+class DictTxOut:
+    value: int
+    script_pubkey: bytes
+
+
+@dataclass
+class DictTx:
+    version: int
+    tx_ins: List[DictTxIn]
+    tx_outs: List[DictTxOut]
+    locktime: int
+
+
+@dataclass
+class DictBlock:
+    version: int
+    hash_prev_block: bytes
+    hash_merkle_root: bytes
+    time: int
+    bits: int
+    nonce: int
+    transactions: List[DictTx]
+
+
+def build_chain(classes, block_count: int, tx_count: int) -> list:
+    """
+    1入力2出力のTxを並べたブロックを作る。バイト列は共有しておき、オブジェクト自体の大きさだけを比べる
+    """
+    outpoint_cls, tx_in_cls, tx_out_cls, tx_cls, block_cls = classes
+    tx_hash = bytes(32)
+    script_sig = bytes(107)
+    script_pubkey = bytes(25)
+    blocks = []
+    for height in range(block_count):
+        txs = []
+        for i in range(tx_count):
+            tx_in = tx_in_cls(outpoint_cls(tx_hash, i), script_sig, 0xffffffff)
+            tx_outs = [tx_out_cls(height * tx_count + i, script_pubkey), tx_out_cls(1, script_pubkey)]
+            txs.append(tx_cls(1, [tx_in], tx_outs, 0))
+        blocks.append(block_cls(1, tx_hash, tx_hash, height, 0x1f00ffff, 0, txs))
+    return blocks
+
+
+def measure(classes, block_count: int, tx_count: int) -> int:
+    gc.collect()
+    tracemalloc.start()
+    blocks = build_chain(classes, block_count, tx_count)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del blocks
+    return size
+
+
+def main() -> None:
+    block_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    tx_count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    # 1Txあたり OutPoint、TxIn、TxOut 2つ、Tx の5オブジェクト
+    objects = block_count * (tx_count * 5 + 1)
+
+    before = measure((DictOutPoint, DictTxIn, DictTxOut, DictTx, DictBlock), block_count, tx_count)
+    after = measure((OutPoint, TxIn, TxOut, Tx, Block), block_count, tx_count)
+    print(f"{block_count} blocks x {tx_count} txs, {objects:,} objects")
+    print(f"dataclass with __dict__: {before:,} bytes ({before / objects:.1f} bytes/object)")
+    print(f"__slots__:               {after:,} bytes ({after / objects:.1f} bytes/object)")
+    print(f"saved: {1 - after / before:.1%}")
+    for cls in (OutPoint, TxIn, TxOut, Tx, Block):
+        print(f"  sizeof {cls.__name__}: {sys.getsizeof(object.__new__(cls))} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+merkle rootの計算、包含証明の生成と検証、coinbaseだけを書き換えたときの再計算の速さを測る。
+リポジトリのルートで `python -m bench.merkle` のように実行する。
+"""
+from hb.merkle import MerkleTree, merkle_root, merkle_branch, merkle_root_from_branch, verify_merkle_proof
+from hb.util import sha256d
+
+from typing import List
+
+import os
+import time
+
+
+def recursive_merkle_root(txs: List[bytes]) -> bytes:
+    """
+    以前のutil.made_merkle_root(レベルごとに再帰し、リストを作り直す)
+    """
+    result = []
+    one = txs[0]
+    for tx in txs[1:]:
+        if one is not None:
+            result.append(sha256d(one + tx))
+            one = None
+        else:
+            one = tx
+    if one is not None:
+        if result:
+            result.append(sha256d(one + one))
+        else:
+            result.append(one)
+    if len(result) >= 2:
+        return recursive_merkle_root(result)
+    return result[0]
+
+
+def timeit(f, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        f()
+    return (time.perf_counter() - start) / repeat
+
+
+def main() -> None:
+    for count in (10_000, 50_000, 200_000):
+        tx_hashes = [os.urandom(32) for _ in range(count)]
+        repeat = max(1, 200_000 // count)
+        print(f"{count} txs")
+        print(f"  root (recursive):  {timeit(lambda: recursive_merkle_root(tx_hashes), repeat) * 1000:8.2f} ms")
+        print(f"  root (iterative):  {timeit(lambda: merkle_root(tx_hashes), repeat) * 1000:8.2f} ms")
+
+        tree = MerkleTree(tx_hashes)
+        branch = tree.branch(count // 2)
+        print(f"  proof (tree):      {timeit(lambda: tree.branch(count // 2), 1000) * 1e6:8.2f} us")
+        print(f"  proof (from txids):{timeit(lambda: merkle_branch(tx_hashes, count // 2), repeat) * 1000:8.2f} ms")
+        print(f"  verify:            {timeit(lambda: verify_merkle_proof(tx_hashes[count // 2], branch, count // 2, tree.root), 1000) * 1e6:8.2f} us")
+
+        # extranonceを変えたときの再計算(coinbaseだけが変わる)
+        coinbase_branch = tree.branch(0)
+        new_coinbase = os.urandom(32)
+        print(f"  coinbase (full):   {timeit(lambda: merkle_root([new_coinbase] + tx_hashes[1:]), repeat) * 1000:8.2f} ms")
+        print(f"  coinbase (tree):   {timeit(lambda: tree.update(0, new_coinbase), 1000) * 1e6:8.2f} us")
+        print(f"  coinbase (branch): {timeit(lambda: merkle_root_from_branch(new_coinbase, coinbase_branch), 1000) * 1e6:8.2f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+P2PKHの出力を使う入力の検証(verify_input)の速さを測る。
+- スクリプトの解析をキャッシュした場合としない場合
+- 署名の検証を省いた場合(インタプリタ自体のオーバーヘッド)と、実際にECDSAで検証する場合
+- 署名がキャッシュにある場合(メモリプールで検証済みのTxをブロックの接続で検証しなおす場合)
+リポジトリのルートで `python -m bench.script` のように実行する。
+"""
+from hb.address import address_to_script, hash160_to_b58_address
+from hb.ecc import encode_pubkey, private_to_public
+from hb.interpreter import parse_script, verify_input, SignatureChecker
+from hb.sigcache import CachingSignatureChecker, SignatureCache
+from hb.sighash import sign_p2pkh_input
+from hb.tx import Tx, TxIn, TxOut, OutPoint
+from hb.util import hash160
+
+import os
+import time
+
+
+class AcceptAllChecker(SignatureChecker):
+    def check_sig(self, sig: bytes, pubkey: bytes, script_code: bytes) -> bool:
+        return True
+
+
+def p2pkh_address(private_key: int) -> str:
+    return hash160_to_b58_address(hash160(encode_pubkey(private_to_public(private_key))))
+
+
+def measure(label: str, count: int, f) -> None:
+    start = time.perf_counter()
+    for _ in range(count):
+        f()
+    elapsed = time.perf_counter() - start
+    print(f"  {label}: {elapsed / count * 1e6:.1f} us/input")
+
+
+def main() -> None:
+    private_key = int.from_bytes(os.urandom(32), "big") % (1 << 255) + 1
+    script_pubkey = address_to_script(p2pkh_address(private_key))
+    tx = Tx(1, [TxIn(OutPoint(os.urandom(32), 0), b"", 0xffffffff)], [TxOut(5000, script_pubkey)], 0)
+    sign_p2pkh_input(tx, 0, private_key, script_pubkey)
+    verify_input(tx, 0, script_pubkey)
+
+    accept_all = AcceptAllChecker()
+    print("P2PKH spend")
+    measure("interpreter only, parse cached  ", 20000, lambda: verify_input(tx, 0, script_pubkey, accept_all))
+
+    def uncached() -> None:
+        parse_script.cache_clear()
+        verify_input(tx, 0, script_pubkey, accept_all)
+    measure("interpreter only, parse uncached", 20000, uncached)
+    measure("with ECDSA verification         ", 200, lambda: verify_input(tx, 0, script_pubkey))
+    cache = SignatureCache()
+    verify_input(tx, 0, script_pubkey, CachingSignatureChecker(tx, 0, cache))
+    measure("signature cache hit             ", 20000,
+            lambda: verify_input(tx, 0, script_pubkey, CachingSignatureChecker(tx, 0, cache)))
+
+
+if __name__ == "__main__":
+    main()
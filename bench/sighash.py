@@ -0,0 +1,34 @@
+"""
+入力の多いTxの全入力のsighashを計算する時間を、legacy_signature_hashとSignatureHasherで比べる。
+リポジトリのルートで `python -m bench.sighash` のように実行する。
+"""
+from hb.sighash import legacy_signature_hash, SignatureHasher, SIGHASH_ALL
+from hb.tx import Tx, TxIn, TxOut, OutPoint
+
+import os
+import time
+
+
+def consolidation_tx(input_count: int) -> Tx:
+    """多数の出力を1つにまとめるTx。script_sigは署名済みと同じくらいの大きさにしておく"""
+    tx_ins = [TxIn(OutPoint(os.urandom(32), 0), os.urandom(106), 0xffffffff) for _ in range(input_count)]
+    return Tx(1, tx_ins, [TxOut(input_count * 1000, b"\x76\xa9\x14" + os.urandom(20) + b"\x88\xac")], 0)
+
+
+def main() -> None:
+    script_code = b"\x76\xa9\x14" + os.urandom(20) + b"\x88\xac"
+    for input_count in (10, 100, 500):
+        tx = consolidation_tx(input_count)
+        start = time.perf_counter()
+        legacy = [legacy_signature_hash(tx, i, script_code, SIGHASH_ALL) for i in range(input_count)]
+        legacy_time = time.perf_counter() - start
+        start = time.perf_counter()
+        hasher = SignatureHasher(tx)
+        digests = [hasher.hash(i, script_code, SIGHASH_ALL) for i in range(input_count)]
+        precomputed_time = time.perf_counter() - start
+        assert len(set(legacy)) == len(set(digests)) == input_count
+        print(f"{input_count} inputs: legacy {legacy_time * 1e3:.1f} ms, precomputed {precomputed_time * 1e3:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
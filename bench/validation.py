@@ -0,0 +1,68 @@
+"""
+validate_storeの速さをプロセス数ごとに測る。
+多数のTxを含むブロックのチェーンを一時ディレクトリに作り(難易度は低くしてある)、それを検証する。
+リポジトリのルートで `python -m bench.validation` のように実行する。
+"""
+from hb.block import Block
+from hb.merkle import merkle_root
+from hb.mining import create_coinbase_tx
+from hb.storage import BlockStore
+from hb.tx import Tx, TxIn, TxOut, OutPoint
+from hb.util import bits_to_target, HeaderHasher
+from hb.utxo import UtxoSet
+from hb.validation import validate_store
+
+import multiprocessing
+import os
+import tempfile
+import time
+
+
+bits = 0x1f7fffff
+
+
+def random_script() -> bytes:
+    """P2PKHと同じ形のscript_pubkey(先頭がOP_RETURNになって使えない出力にならないようにする)"""
+    return b"\x76\xa9\x14" + os.urandom(20) + b"\x88\xac"
+
+
+def build_chain(store: BlockStore, block_count: int, tx_count: int) -> None:
+    target = bits_to_target(bits)
+    prev = bytes([0]) * 32
+    outputs = []  # まだ使っていない(tx_hash, value)
+    for height in range(block_count):
+        coinbase = create_coinbase_tx(height.to_bytes(4, "little"), random_script())
+        txs = [coinbase]
+        next_outputs = [(coinbase.tx_hash(), coinbase.tx_outs[0].value)]
+        for tx_hash, value in outputs[:tx_count]:
+            # 1つの出力を2つに分けていくので、Txの数は高さとともに増える
+            tx = Tx(1, [TxIn(OutPoint(tx_hash, 0), os.urandom(72), 0xffffffff)],
+                    [TxOut(value // 2, random_script()), TxOut(value - value // 2, random_script())], 0)
+            txs.append(tx)
+            next_outputs.append((tx.tx_hash(), value // 2))
+        outputs = outputs[tx_count:] + next_outputs
+        block = Block(1, prev, merkle_root([tx.tx_hash() for tx in txs]), int(time.time()), bits, 0, txs)
+        hasher = HeaderHasher(block.header_prefix())
+        while hasher.hash_int(block.nonce) >= target:
+            block.nonce += 1
+        store.append(block)
+        prev = block.block_hash()
+
+
+def main() -> None:
+    with tempfile.TemporaryDirectory() as path:
+        with BlockStore(path) as store:
+            build_chain(store, 300, 1000)
+            tx_total = sum(store.get_block_view_by_height(h).tx_count for h in range(store.tip_height + 1))
+            print(f"{store.tip_height + 1} blocks, {tx_total} txs, {multiprocessing.cpu_count()} cpus")
+            for workers in sorted({1, 2, multiprocessing.cpu_count()}):
+                start = time.perf_counter()
+                validate_store(store, workers=workers)
+                print(f"  headers/merkle, {workers} process(es): {time.perf_counter() - start:.2f} s")
+            start = time.perf_counter()
+            validate_store(store, utxo=UtxoSet(":memory:"))
+            print(f"  with UTXO spends, all cpus:      {time.perf_counter() - start:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
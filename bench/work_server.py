@@ -0,0 +1,69 @@
+"""
+WorkServerの負荷試験。ローカルにサーバーを立て、複数のワーカープロセスから同時にテンプレートの取得と解の提出を行う。
+リポジトリのルートで `python -m bench.work_server [ワーカー数] [秒数]` のように実行する。
+"""
+from hb import work_server
+from hb.address import hash160_to_b58_address
+from hb.chainstate import ChainState
+
+import multiprocessing
+import sys
+import threading
+import time
+
+
+# テスト用に易しい難易度を使う。shareはブロックよりさらに易しい
+block_bits = 0x1e0fffff
+share_bits = 0x1f00ffff
+
+
+def worker(address, stop, queue) -> None:
+    queue.put(work_server.run_worker(address, stop))
+
+
+def main() -> None:
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else multiprocessing.cpu_count()
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 20.0
+    work_server.job_refresh_interval = 1.0
+
+    found_at = []
+    server = work_server.WorkServer(
+        receive_address=hash160_to_b58_address(bytes(20)),
+        height=1,
+        bits=block_bits,
+        share_bits=share_bits,
+        on_block=lambda block: found_at.append(time.monotonic()),
+        chain_state=ChainState()  # 空のチェーンの上に積む
+    )
+    address = server.serve_tcp()
+
+    stop = multiprocessing.Event()
+    queue = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=worker, args=(address, stop, queue)) for _ in range(workers)]
+    started = time.monotonic()
+    for process in processes:
+        process.start()
+    threading.Timer(duration, stop.set).start()
+
+    totals = {"block": 0, "share": 0, "stale": 0, "rejected": 0}
+    for _ in processes:
+        for key, value in queue.get().items():
+            totals[key] += value
+    for process in processes:
+        process.join()
+    elapsed = time.monotonic() - started
+    server.shutdown()
+
+    submissions = sum(totals.values())
+    print(f"workers: {workers}, elapsed: {elapsed:.1f}s")
+    print(f"submissions: {submissions} ({submissions / elapsed:.1f}/s) {totals}")
+    print(f"blocks accepted by server: {len(server.blocks)}, final height: {server.height}")
+    if submissions:
+        print(f"stale rate: {totals['stale'] / submissions:.1%}")
+    # 受け付けたブロックが前のブロックにつながっていることを確認する
+    for prev, block in zip(server.blocks, server.blocks[1:]):
+        assert block.hash_prev_block == prev.block_hash()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
-from typing import Tuple, Optional
+from functools import lru_cache
+from typing import Iterable, List, Tuple, Optional
 
 from .util import sha256d
 from .script import Opcodes
@@ -6,85 +7,110 @@ from .script import Opcodes
 
 __b58chars = b"123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
 assert len(__b58chars) == 58
+# 文字(のバイト値)から数値を引く表。base58で使わない文字は-1
+__b58digits = [__b58chars.find(bytes([c])) for c in range(256)]
+address_cache_size = 1 << 14
 
 
 def base58_decode(v: bytes, length: int = None) -> Optional[bytes]:
     """decode v into a string of len bytes."""
-    chars = __b58chars
+    digits = __b58digits
     long_value = 0
-    for (i, c) in enumerate(v[::-1]):
-        digit = chars.find(bytes([c]))
+    for c in v:
+        digit = digits[c]
         if digit == -1:
             raise ValueError("Forbidden character {}".format(c))
-        long_value += digit * (58 ** i)
-    result = bytearray()
-    while long_value >= 256:
-        div, mod = divmod(long_value, 256)
-        result.append(mod)
-        long_value = div
-    result.append(long_value)
-    n_pad = 0
-    for c in v:
-        if c == chars[0]:
-            n_pad += 1
-        else:
-            break
-    result.extend(b"\x00" * n_pad)
+        long_value = long_value * 58 + digit
+    # 先頭の'1'は0x00のバイトに戻す
+    n_pad = len(v) - len(bytes(v).lstrip(__b58chars[:1]))
+    result = bytes(n_pad) + long_value.to_bytes((long_value.bit_length() + 7) // 8, "big")
     if length is not None and len(result) != length:
         return None
-    result.reverse()
-    return bytes(result)
+    return result
 
 
 def base_encode(v: bytes) -> str:
     chars = __b58chars
-    long_value = 0
-    for (i, c) in enumerate(v[::-1]):
-        long_value += (256 ** i) * c
+    long_value = int.from_bytes(v, "big")
     result = bytearray()
-    while long_value >= 58:
-        div, mod = divmod(long_value, 58)
+    while long_value:
+        long_value, mod = divmod(long_value, 58)
         result.append(chars[mod])
-        long_value = div
-    result.append(chars[long_value])
     # Bitcoin does a little leading-zero-compression:
     # leading 0-bytes in the input become leading-1s
-    n_pad = 0
-    for c in v:
-        if c == 0x00:
-            n_pad += 1
-        else:
-            break
-    result.extend([chars[0]] * n_pad)
+    n_pad = len(v) - len(bytes(v).lstrip(b"\x00"))
+    result.extend(chars[:1] * n_pad)
     result.reverse()
     return result.decode("ascii")
 
 
+def base58check_encode(payload: bytes) -> str:
+    """
+    payloadの後ろにsha256dの先頭4bytesのチェックサムを付けてbase58にする
+    """
+    return base_encode(payload + sha256d(payload)[:4])
+
+
+def base58check_decode(s: str, length: int = None) -> bytes:
+    """
+    base58check_encodeの逆。チェックサムが合わない場合や、ペイロードの長さがlengthと違う場合は例外を送出する
+    """
+    data = base58_decode(s.encode("ascii"))
+    if len(data) < 4:
+        raise Exception("base58check data is too short")
+    payload, checksum = data[:-4], data[-4:]
+    if sha256d(payload)[:4] != checksum:
+        raise Exception("base58check checksum mismatch")
+    if length is not None and len(payload) != length:
+        raise Exception(f"expected {length} bytes in base58check payload")
+    return payload
+
+
 def b58_address_to_hash160(addr: str) -> Tuple[int, bytes]:
-    addr = addr.encode('ascii')
-    _bytes = base58_decode(addr, 25)
-    if len(_bytes) != 21:
-        raise Exception(f'expected 21 payload bytes in base58 address. got: {len(_bytes)}')
+    _bytes = base58check_decode(addr, 21)  # 1byteのバージョンと20bytesのhash160
     return _bytes[0], _bytes[1:21]
 
 
 def hash160_to_b58_address(h160: bytes) -> str:
-    s = bytes([0]) + h160
-    s = s + sha256d(s)[0:4]
-    return base_encode(s)
+    return base58check_encode(bytes([0]) + h160)
+
+
+def b58_addresses_to_hash160s(addrs: Iterable[str]) -> List[bytes]:
+    """
+    アドレスのリストをまとめてhash160のリストにする。途中で不正なアドレスがあれば例外を送出する
+    """
+    return [b58_address_to_hash160(addr)[1] for addr in addrs]
 
 
+def hash160s_to_b58_addresses(h160s: Iterable[bytes]) -> List[str]:
+    """
+    hash160のリストをまとめてアドレスのリストにする
+    """
+    return [hash160_to_b58_address(h160) for h160 in h160s]
+
+
+@lru_cache(maxsize=address_cache_size)
 def address_to_script(addr: str) -> bytes:
-    script = bytes([Opcodes.OP_DUP, Opcodes.OP_HASH160])
+    """
+    P2PKHのscript_pubkey: OP_DUP OP_HASH160 <hash160(20bytesのpush)> OP_EQUALVERIFY OP_CHECKSIG。
+    同じアドレスを何度も変換することが多いので、結果をキャッシュする(script_to_addressも同じ)
+    """
+    script = bytes([Opcodes.OP_DUP, Opcodes.OP_HASH160, 20])
     script += b58_address_to_hash160(addr)[1]
     script += bytes([Opcodes.OP_EQUALVERIFY, Opcodes.OP_CHECKSIG])
     return script
 
 
 def script_to_address(script: bytes) -> str:
+    return _script_to_address(bytes(script))
+
+
+@lru_cache(maxsize=address_cache_size)
+def _script_to_address(script: bytes) -> str:
     if (
-            (script_hex := script.hex()).startswith(bytes([Opcodes.OP_DUP, Opcodes.OP_HASH160]).hex()) and
-            script_hex.endswith(bytes([Opcodes.OP_EQUALVERIFY, Opcodes.OP_CHECKSIG]).hex())
+            len(script) == 25 and
+            script[:3] == bytes([Opcodes.OP_DUP, Opcodes.OP_HASH160, 20]) and
+            script[-2:] == bytes([Opcodes.OP_EQUALVERIFY, Opcodes.OP_CHECKSIG])
     ):
-        return hash160_to_b58_address(script[2:-2])
+        return hash160_to_b58_address(script[3:-2])
     raise Exception("入力値はP2PKHアドレスではない")
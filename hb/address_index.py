@@ -0,0 +1,195 @@
+"""
+アドレス(script_pubkey)ごとの入出金の履歴と残高のインデックス。
+チェーン全体の出力をscript_to_addressで調べ直さなくても、あるアドレスの残高、履歴、未使用の出力がわかる。
+
+キーはscript_pubkeyのsha256(スクリプトハッシュ)なので、P2PKH以外のスクリプトも同じように扱える。
+アドレスを渡した場合はaddress_to_scriptでscript_pubkeyに変換してから引く。
+
+ブロックを接続するときは、UtxoSet.connect_blockが返す使われた出力を一緒に渡す(入力のscript_pubkeyと金額はそこからわかる)。
+切断するときは、その高さの行を消して残高を戻すだけでよい。
+"""
+from .address import address_to_script
+from .block import Block
+from .utxo import SpentCoins, is_unspendable
+from .util import sha256
+
+from typing import Iterator, List, NamedTuple, Union
+
+import sqlite3
+
+
+default_page_size = 100
+
+
+class HistoryEntry(NamedTuple):
+    height: int
+    tx_hash: bytes  # 入金ならその出力を作ったTx、出金ならその出力を使ったTx
+    index: int  # 入金なら出力の番号、出金なら入力の番号
+    value: int
+    is_spend: bool
+    funding_tx_hash: bytes  # 入金、出金のどちらでも、対象の出力(OutPoint)を指す
+    funding_index: int
+
+
+def script_hash(address_or_script: Union[str, bytes]) -> bytes:
+    if isinstance(address_or_script, str):
+        address_or_script = address_to_script(address_or_script)
+    return sha256(address_or_script)
+
+
+class AddressIndex:
+    def __init__(self, path: str = "../blockchain_data/address_index.sqlite"):
+        self._db = sqlite3.connect(path)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS history (
+                script_hash BLOB NOT NULL,
+                height INTEGER NOT NULL,
+                tx_pos INTEGER NOT NULL,
+                is_spend INTEGER NOT NULL,
+                io_index INTEGER NOT NULL,
+                tx_hash BLOB NOT NULL,
+                value INTEGER NOT NULL,
+                funding_tx_hash BLOB NOT NULL,
+                funding_index INTEGER NOT NULL,
+                PRIMARY KEY (script_hash, height, tx_pos, is_spend, io_index)
+            );
+            CREATE INDEX IF NOT EXISTS history_height ON history (height);
+            CREATE INDEX IF NOT EXISTS history_funding ON history (funding_tx_hash, funding_index, is_spend);
+            CREATE TABLE IF NOT EXISTS balance (
+                script_hash BLOB PRIMARY KEY,
+                balance INTEGER NOT NULL,
+                entries INTEGER NOT NULL
+            );
+        """)
+        self._db.commit()
+
+    def connect_block(self, block: Block, height: int, spent: SpentCoins) -> None:
+        """
+        ブロックの入出金を記録する。spentはUtxoSet.connect_blockが返した、このブロックで使われた出力の一覧
+        """
+        rows = []
+        spent_coins = iter(spent)
+        for tx_pos, tx in enumerate(block.transactions):
+            tx_hash = tx.tx_hash()
+            if tx_pos > 0:
+                for index in range(len(tx.tx_ins)):
+                    key, coin = next(spent_coins)
+                    rows.append((
+                        sha256(coin.script_pubkey), height, tx_pos, 1, index, tx_hash, coin.value,
+                        key[:32], int.from_bytes(key[32:], "little")
+                    ))
+            for index, tx_out in enumerate(tx.tx_outs):
+                if is_unspendable(tx_out.script_pubkey):
+                    continue
+                rows.append((
+                    sha256(tx_out.script_pubkey), height, tx_pos, 0, index, tx_hash, tx_out.value, tx_hash, index
+                ))
+
+        with self._db:
+            self._db.executemany("INSERT INTO history VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._db.executemany(
+                """
+                INSERT INTO balance VALUES (?, ?, 1)
+                ON CONFLICT (script_hash) DO UPDATE SET balance = balance + excluded.balance, entries = entries + 1
+                """,
+                [(row[0], -row[6] if row[3] else row[6]) for row in rows]
+            )
+
+    def disconnect_block(self, height: int) -> None:
+        """
+        heightのブロックの入出金を取り消す。先頭のブロックから順に切断すること
+        """
+        with self._db:
+            changes = self._db.execute(
+                """
+                SELECT script_hash, SUM(CASE WHEN is_spend THEN -value ELSE value END), COUNT(*)
+                FROM history WHERE height = ? GROUP BY script_hash
+                """,
+                (height,)
+            ).fetchall()
+            self._db.executemany(
+                "UPDATE balance SET balance = balance - ?, entries = entries - ? WHERE script_hash = ?",
+                [(change, count, key) for key, change, count in changes]
+            )
+            self._db.execute("DELETE FROM balance WHERE entries = 0")
+            self._db.execute("DELETE FROM history WHERE height = ?", (height,))
+
+    def rewind(self, height: int) -> None:
+        """
+        heightより上のブロックの入出金をすべて取り消す(ブロックの保存より先に記録されたまま終了した場合など)
+        """
+        top = self._db.execute("SELECT MAX(height) FROM history").fetchone()[0]
+        if top is None:
+            return
+        for h in range(top, height, -1):
+            self.disconnect_block(h)
+
+    def balance(self, address_or_script: Union[str, bytes]) -> int:
+        row = self._db.execute(
+            "SELECT balance FROM balance WHERE script_hash = ?", (script_hash(address_or_script),)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def history_count(self, address_or_script: Union[str, bytes]) -> int:
+        row = self._db.execute(
+            "SELECT entries FROM balance WHERE script_hash = ?", (script_hash(address_or_script),)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def history(
+            self,
+            address_or_script: Union[str, bytes],
+            offset: int = 0,
+            limit: int = default_page_size
+    ) -> List[HistoryEntry]:
+        """
+        入金と出金をチェーン上の順(古いものから)に、offset件目からlimit件まで返す
+        """
+        rows = self._db.execute(
+            """
+            SELECT height, tx_hash, io_index, value, is_spend, funding_tx_hash, funding_index FROM history
+            WHERE script_hash = ? ORDER BY height, tx_pos, is_spend, io_index LIMIT ? OFFSET ?
+            """,
+            (script_hash(address_or_script), limit, offset)
+        )
+        return [HistoryEntry(*row[:4], bool(row[4]), *row[5:]) for row in rows]
+
+    def unspent(
+            self,
+            address_or_script: Union[str, bytes],
+            offset: int = 0,
+            limit: int = default_page_size
+    ) -> List[HistoryEntry]:
+        """
+        まだ使われていない入金だけを、history()と同じ順に返す
+        """
+        rows = self._db.execute(
+            """
+            SELECT height, tx_hash, io_index, value, is_spend, funding_tx_hash, funding_index FROM history AS f
+            WHERE script_hash = ? AND is_spend = 0 AND NOT EXISTS (
+                SELECT 1 FROM history AS s
+                WHERE s.funding_tx_hash = f.tx_hash AND s.funding_index = f.io_index AND s.is_spend = 1
+            )
+            ORDER BY height, tx_pos, io_index LIMIT ? OFFSET ?
+            """,
+            (script_hash(address_or_script), limit, offset)
+        )
+        return [HistoryEntry(*row[:4], bool(row[4]), *row[5:]) for row in rows]
+
+    def iter_history(self, address_or_script: Union[str, bytes], page_size: int = default_page_size) -> Iterator[HistoryEntry]:
+        """
+        履歴をpage_size件ずつ読みながら、すべて返す
+        """
+        offset = 0
+        while page := self.history(address_or_script, offset, page_size):
+            yield from page
+            offset += len(page)
+
+    def close(self) -> None:
+        self._db.close()
+
+    def __enter__(self) -> "AddressIndex":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
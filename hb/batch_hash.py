@@ -0,0 +1,152 @@
+"""
+NumPyを用いてブロックヘッダのSHA-256dを多数まとめて計算する。
+各候補を1レーンとして、uint32配列の演算でSHA-256の圧縮関数を一斉に実行する。
+NumPyはオプションの依存なので、インストールされていない場合はavailable()がFalseを返す。
+"""
+from typing import List, Sequence
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+
+_K = [
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+    0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+    0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+    0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+    0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+    0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2,
+]
+
+_H0 = [0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19]
+
+# 1回目のハッシュの2ブロック目は、ヘッダの残り16bytesの後ろにパディングと長さ(80bytes = 640bits)が続く
+_HEADER_LENGTH_BITS = 640
+# 2回目のハッシュは32bytes(= 256bits)のダイジェストを1ブロックでハッシュする
+_DIGEST_LENGTH_BITS = 256
+
+# 1回の呼び出しでまとめて計算するレーン数の既定値
+default_batch_size = 1 << 14
+
+
+def available() -> bool:
+    return np is not None
+
+
+def _rotr(x, n: int):
+    return (x >> np.uint32(n)) | (x << np.uint32(32 - n))
+
+
+def _compress(state: List, w: List) -> List:
+    """
+    SHA-256の圧縮関数。stateは8個、wは16個のuint32配列(またはスカラー)で、各要素がレーンに対応する。
+    """
+    k = [np.uint32(x) for x in _K]
+    w = list(w)
+    a, b, c, d, e, f, g, h = state
+    for i in range(64):
+        if i >= 16:
+            w15 = w[(i - 15) % 16]
+            w2 = w[(i - 2) % 16]
+            s0 = _rotr(w15, 7) ^ _rotr(w15, 18) ^ (w15 >> np.uint32(3))
+            s1 = _rotr(w2, 17) ^ _rotr(w2, 19) ^ (w2 >> np.uint32(10))
+            w[i % 16] = w[i % 16] + s0 + w[(i - 7) % 16] + s1
+        s1 = _rotr(e, 6) ^ _rotr(e, 11) ^ _rotr(e, 25)
+        ch = (e & f) ^ (~e & g)
+        t1 = h + s1 + ch + k[i] + w[i % 16]
+        s0 = _rotr(a, 2) ^ _rotr(a, 13) ^ _rotr(a, 22)
+        maj = (a & b) ^ (a & c) ^ (b & c)
+        t2 = s0 + maj
+        h, g, f, e, d, c, b, a = g, f, e, d + t1, c, b, a, t1 + t2
+    return [x + y for x, y in zip(state, [a, b, c, d, e, f, g, h])]
+
+
+def _bswap32(x):
+    return (
+        ((x & np.uint32(0xff)) << np.uint32(24)) |
+        ((x & np.uint32(0xff00)) << np.uint32(8)) |
+        ((x >> np.uint32(8)) & np.uint32(0xff00)) |
+        (x >> np.uint32(24))
+    )
+
+
+def _sha256d_second_block(midstate: List, tail_words: List) -> List:
+    """
+    midstate(先頭64bytes処理後の状態)とヘッダ末尾16bytes分のワードから、SHA-256dのダイジェスト8ワードを求める。
+    """
+    zero = np.uint32(0)
+    block = list(tail_words) + [np.uint32(0x80000000)] + [zero] * 10 + [np.uint32(_HEADER_LENGTH_BITS)]
+    first = _compress(midstate, block)
+    block = first + [np.uint32(0x80000000)] + [zero] * 6 + [np.uint32(_DIGEST_LENGTH_BITS)]
+    return _compress([np.uint32(x) for x in _H0], block)
+
+
+def _less_than(digest: List, target: List):
+    """
+    ダイジェストをbig endianの256bit整数とみなし、レーンごとにtargetより小さいかを判定する
+    """
+    result = np.zeros(np.broadcast(digest[0], target[0]).shape, dtype=bool)
+    for d, t in zip(reversed(digest), reversed(target)):
+        result = (d < t) | ((d == t) & result)
+    return result
+
+
+def _target_words(target: int) -> List:
+    return [np.uint32((target >> (32 * (7 - i))) & 0xffffffff) for i in range(8)]
+
+
+def _header_words(header: bytes) -> List:
+    return [np.uint32(int.from_bytes(header[i:i + 4], "big")) for i in range(0, len(header), 4)]
+
+
+def search_nonces(header_prefix: bytes, target: int, start: int, count: int) -> List[int]:
+    """
+    nonceを除いたヘッダ76bytesと探索範囲[start, start + count)を受け取り、ハッシュがtargetを下回るnonceをすべて返す
+    """
+    if len(header_prefix) != 76:
+        raise Exception(f"header prefix must be 76 bytes. got: {len(header_prefix)}")
+    words = _header_words(header_prefix)
+    target_words = _target_words(target)
+
+    with np.errstate(over="ignore"):
+        # 先頭64bytesはすべてのレーンで共通なので1回だけ計算する
+        midstate = _compress([np.uint32(x) for x in _H0], words[:16])
+        nonces = np.arange(start, start + count, dtype=np.uint64).astype(np.uint32)
+        # ヘッダ上のnonceはlittle endianなので、big endianのワードとして読むとバイトが反転する
+        digest = _sha256d_second_block(midstate, words[16:19] + [_bswap32(nonces)])
+        found = _less_than(digest, target_words)
+    return [int(n) for n in nonces[found]]
+
+
+def sha256d_headers(headers: Sequence[bytes]) -> List[bytes]:
+    """
+    80bytesのヘッダを複数受け取り、それぞれのSHA-256dをまとめて計算する
+    """
+    data = np.frombuffer(b"".join(headers), dtype=">u4").reshape(len(headers), 20).astype(np.uint32)
+    columns = [data[:, i] for i in range(20)]
+    with np.errstate(over="ignore"):
+        midstate = _compress([np.uint32(x) for x in _H0], columns[:16])
+        digest = _sha256d_second_block(midstate, columns[16:])
+    digest = np.stack(digest, axis=1).astype(">u4")
+    return [row.tobytes() for row in digest]
+
+
+def check_headers_pow(headers: Sequence[bytes], targets: Sequence[int]) -> List[bool]:
+    """
+    複数のブロックヘッダについて、ハッシュがそれぞれのtargetを下回っているか(Proof of Workを満たすか)をまとめて判定する
+    """
+    if not headers:
+        return []
+    data = np.frombuffer(b"".join(headers), dtype=">u4").reshape(len(headers), 20).astype(np.uint32)
+    columns = [data[:, i] for i in range(20)]
+    target_bin = b"".join(target.to_bytes(32, "big") for target in targets)
+    target_data = np.frombuffer(target_bin, dtype=">u4").reshape(len(targets), 8).astype(np.uint32)
+    with np.errstate(over="ignore"):
+        midstate = _compress([np.uint32(x) for x in _H0], columns[:16])
+        digest = _sha256d_second_block(midstate, columns[16:])
+        result = _less_than(digest, [target_data[:, i] for i in range(8)])
+    return [bool(x) for x in result]
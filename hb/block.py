@@ -1,16 +1,24 @@
-from dataclasses import dataclass, asdict
-from typing import Dict, List, Tuple, Union
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Tuple, Union
 
 from .tx import Tx
-from .util import int_to_bytes, sha256d, bits_to_target, target_to_bits
+from .util import int_size, write_int, bytes_to_int, sha256d, shallow_asdict, bits_to_target, target_to_bits, iter_json_array
 from .config import retarget_block_count, retarget_time_span
+from .cache import Cacheable
 
 import binascii
 import json
+import struct
+
+
+_uint32 = struct.Struct("<I")
+_header_tail = struct.Struct("<III")  # time、bits、nonce
 
 
 @dataclass
-class Block:
+class Block(Cacheable):
+    __slots__ = ("version", "hash_prev_block", "hash_merkle_root", "time", "bits", "nonce", "transactions")
+    _child_fields = ("transactions",)
     version: int
     hash_prev_block: bytes
     hash_merkle_root: bytes
@@ -56,7 +64,7 @@ class Block:
         return block
 
     def as_dict(self) -> Dict:
-        result = asdict(self)
+        result = shallow_asdict(self)
         result["hash_prev_block"] = result["hash_prev_block"][::-1].hex()
         result["hash_merkle_root"] = result["hash_merkle_root"][::-1].hex()
         txs = result["transactions"]
@@ -74,13 +82,19 @@ class Block:
         バージョン(little、4bytes)、前ブロックのハッシュ(little)、マークルルート(little)、時間(little、4bytes)、
         bits(難易度のやつ、little、4bytes)、nonce(little、4bytes)で構成される
         """
-        block_bin = self.version.to_bytes(4, byteorder="little")
-        block_bin += self.hash_prev_block
-        block_bin += self.hash_merkle_root
-        block_bin += self.time.to_bytes(4, byteorder="little")
-        block_bin += self.bits.to_bytes(4, byteorder="little")
-        block_bin += self.nonce.to_bytes(4, byteorder="little")
-        return block_bin
+        return self.header_prefix() + self.nonce.to_bytes(4, byteorder="little")
+
+    def header_prefix(self) -> bytes:
+        """
+        ヘッダのうちnonceを除いた76bytes。マイニング中はこの部分が変化しないので、一度だけ生成して使いまわす
+        """
+        return b"".join((
+            self.version.to_bytes(4, byteorder="little"),
+            self.hash_prev_block,
+            self.hash_merkle_root,
+            self.time.to_bytes(4, byteorder="little"),
+            self.bits.to_bytes(4, byteorder="little"),
+        ))
 
     def as_bin(self) -> bytes:
         """
@@ -89,26 +103,104 @@ class Block:
         transaction count(1byte、254を超える場合はBitcoin ScriptのPUSHDATAと似た扱い)
         transactions(transaction count分のtransactionがざっと並ぶ)という、以上の要素で成り立つ。
         """
-        block_bin = self._as_bin()
-        tx_len = len(self.transactions)
-        block_bin += int_to_bytes(tx_len)
+        return self._cached("block_bin", self._as_bin_uncached)
+
+    def _as_bin_uncached(self) -> bytes:
+        buf = bytearray(self.serialized_size())
+        self.serialize_into(buf, 0)
+        return bytes(buf)
+
+    def serialized_size(self) -> int:
+        return self._cached("block_size", self._serialized_size)
+
+    def _serialized_size(self) -> int:
+        size = 80 + int_size(len(self.transactions))
         for tx in self.transactions:
-            block_bin += tx
+            size += tx.serialized_size()
+        return size
 
-        return block_bin
+    def serialize_into(self, buf, offset: int) -> int:
+        """
+        書き込み可能なバッファ(bytearrayなど)のoffsetの位置にブロック全体を書き込み、書き終わった位置を返す。
+        大きさはserialized_size()で事前に求められるので、バッファは一度確保するだけでよい
+        """
+        buf[offset:offset + 80] = self._as_bin()
+        offset = write_int(buf, offset + 80, len(self.transactions))
+        for tx in self.transactions:
+            offset = tx.serialize_into(buf, offset)
+        return offset
 
     def block_hash(self) -> bytes:
-        block_bin = self._as_bin()
-        return sha256d(block_bin)
+        """
+        ブロックハッシュはキャッシュされ、nonceなどのフィールドが書き換えられると計算しなおされる
+        """
+        return self._cached("block_hash", lambda: sha256d(self._as_bin()))
+
+    @classmethod
+    def from_bin(cls, data: bytes) -> "Block":
+        block, offset = cls.read_from(memoryview(data), 0)
+        if offset != len(data):
+            raise Exception("Block data has trailing bytes")
+        return block
+
+    @classmethod
+    def read_from(cls, view: memoryview, offset: int) -> Tuple["Block", int]:
+        """
+        viewのoffsetの位置から生のブロック(as_binの形式)を読み取り、読み終わった位置とともに返す
+        """
+        if offset + 80 > len(view):
+            raise Exception("Data is truncated")
+        version, = _uint32.unpack_from(view, offset)
+        hash_prev_block = bytes(view[offset + 4:offset + 36])
+        hash_merkle_root = bytes(view[offset + 36:offset + 68])
+        time, bits, nonce = _header_tail.unpack_from(view, offset + 68)
+        tx_len, offset = bytes_to_int(view, offset + 80)
+        transactions = []
+        for _ in range(tx_len):
+            tx, offset = Tx.read_from(view, offset)
+            transactions.append(tx)
+        block = cls(
+            version=version,
+            hash_prev_block=hash_prev_block,
+            hash_merkle_root=hash_merkle_root,
+            time=time,
+            bits=bits,
+            nonce=nonce,
+            transactions=transactions
+        )
+        return block, offset
+
+
+def parse_blocks(data: bytes) -> Iterator[Block]:
+    """
+    生のブロックが連続して並んだバイト列から、ブロックを1つずつ取り出す
+    """
+    view = memoryview(data)
+    offset = 0
+    while offset < len(view):
+        block, offset = Block.read_from(view, offset)
+        yield block
+
+
+def iter_blocks(
+        start_height: int = 0,
+        end_height: int = None,
+        path: str = "../blockchain_data/blockchain.json"
+) -> Iterator[Block]:
+    """
+    blockchain.jsonからブロックを1つずつ読み出す。ファイル全体を読み込まないので、チェーンが長くなってもメモリ使用量は増えない。
+    start_height以上end_height未満(end_heightを省略した場合は最後まで)のブロックを返す
+    """
+    with open(path) as f:
+        for height, block in enumerate(iter_json_array(f)):
+            if end_height is not None and height >= end_height:
+                break
+            if height >= start_height:
+                yield Block.from_dict(block)
 
 
 def load_blocks() -> List[Block]:
-    result = []
-    with open(f"../blockchain_data/blockchain.json") as f:
-        blocks = json.loads(f.read())
-    for block in blocks:
-        result.append(Block.from_dict(block))
-    return result
+    return list(iter_blocks())
 
 
 def dump_blocks(blocks: List[Block]) -> None:
@@ -126,15 +218,20 @@ def get_target(blocks: List[Block]) -> int:
     指定された時間よりも短ければ難易度を上げる
     """
     if len(blocks) % retarget_block_count == 0:
-        first = blocks[-(retarget_block_count-1)]
-        last = blocks[-1]
-        target = bits_to_target(last.bits)
-        n_actual_timespan = last.time - first.time
-        n_actual_timespan = max(n_actual_timespan, retarget_time_span // 4)
-        n_actual_timespan = min(n_actual_timespan, retarget_time_span * 4)
-        new_target = min(0x0000ffff00000000000000000000000000000000000000000000000000000000, (target * n_actual_timespan) // retarget_time_span)
+        return retarget(blocks[-(retarget_block_count-1)].time, blocks[-1].time, blocks[-1].bits)
     else:
         return bits_to_target(blocks[-1].bits)
 
+
+def retarget(first_time: int, last_time: int, last_bits: int) -> int:
+    """
+    難易度調整の期間の最初と最後のブロックの時間、最後のブロックのbitsから、新しいtargetを求める
+    """
+    target = bits_to_target(last_bits)
+    n_actual_timespan = last_time - first_time
+    n_actual_timespan = max(n_actual_timespan, retarget_time_span // 4)
+    n_actual_timespan = min(n_actual_timespan, retarget_time_span * 4)
+    new_target = min(0x0000ffff00000000000000000000000000000000000000000000000000000000, (target * n_actual_timespan) // retarget_time_span)
+
     new_target = bits_to_target(target_to_bits(new_target))
     return new_target
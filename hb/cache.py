@@ -0,0 +1,226 @@
+"""
+Tx、Blockのハッシュやシリアライズ結果をオブジェクトごとにキャッシュするための仕組み。
+
+OutPoint、TxIn、TxOut、Tx、Blockのいずれかのフィールドが書き換えられたり、tx_insやtransactionsなどのリストが変更されたりすると、
+それを含むTx、Blockのキャッシュだけを捨てる。入れ子になったオブジェクト(たとえばcoinbaseのscript_sig)を書き換えても
+親のハッシュが古いまま返されることはなく、関係のないTxやBlockのキャッシュはそのまま使える。
+
+書き換えを親に伝えるため、各オブジェクトはキャッシュを持つ最も近い祖先(TxIn、TxOut、OutPointならTx、TxならBlock)を弱参照で覚える。
+覚えるのは祖先が初めてキャッシュを作るときなので、ハッシュを求めないオブジェクトには弱参照を作らない。
+同じTxがメモリプールと複数のブロックのテンプレートに入ることもあるので親は複数覚えられ、弱参照なので子が親を生かし続けることはない。
+
+計算中に別のスレッドが書き換えた場合に古い値を保存しないよう、値は計算を始める前のキャッシュの辞書に保存する。
+書き換えでは辞書ごと捨てるので、その間に計算した値も一緒に捨てられる。
+"""
+from dataclasses import fields
+from typing import Callable, Dict
+
+import weakref
+
+
+class CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def reset(self) -> None:
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self) -> str:
+        return f"CacheStats(hits={self.hits}, misses={self.misses})"
+
+
+stats: Dict[str, CacheStats] = {
+    "tx_hash": CacheStats(),
+    "tx_bin": CacheStats(),
+    "tx_size": CacheStats(),
+    "block_hash": CacheStats(),
+    "block_bin": CacheStats(),
+    "block_size": CacheStats(),
+}
+
+
+def reset_stats() -> None:
+    for s in stats.values():
+        s.reset()
+
+
+def _link(child: "Tracked", parent_ref: weakref.ref) -> None:
+    """
+    childの親としてparent_ref(親の弱参照)を覚える。親が1つならその弱参照を、複数ならそのリストを持つ
+    """
+    parents = child._parents
+    if parents is None:
+        object.__setattr__(child, "_parents", parent_ref)
+    elif type(parents) is list:
+        if not any(ref is parent_ref for ref in parents):
+            # 使い終わったテンプレートなど、なくなった親はここで取り除く
+            parents[:] = [ref for ref in parents if ref() is not None]
+            parents.append(parent_ref)
+    elif parents is not parent_ref:
+        if parents() is None:
+            object.__setattr__(child, "_parents", parent_ref)
+        else:
+            object.__setattr__(child, "_parents", [parents, parent_ref])
+
+
+def _link_descendants(obj: "Cacheable") -> None:
+    """
+    objの子孫に、キャッシュを持つ最も近い祖先を覚えさせる。キャッシュが残っているTxの子孫は、そのキャッシュを作ったときに結びつけ済み
+    """
+    pending = [(obj, weakref.ref(obj))]
+    while pending:
+        obj, ref = pending.pop()
+        for name in obj._child_fields:
+            value = getattr(obj, name)
+            if isinstance(value, TrackedList):
+                value._owner = ref
+                items = value
+            else:
+                items = (value,)
+            for item in items:
+                if isinstance(item, Cacheable):
+                    _link(item, ref)
+                    if item._cache is None:
+                        pending.append((item, weakref.ref(item)))
+                elif isinstance(item, Tracked):
+                    _link(item, ref)
+                    if item._child_fields:
+                        pending.append((item, ref))
+
+
+def _invalidate(obj: "Tracked") -> None:
+    """
+    objとその祖先のキャッシュを捨てる
+    """
+    pending = [obj]
+    while pending:
+        obj = pending.pop()
+        if isinstance(obj, Cacheable):
+            object.__setattr__(obj, "_cache", None)
+        parents = obj._parents
+        if parents is None:
+            continue
+        for ref in parents if type(parents) is list else (parents,):
+            parent = ref()
+            if parent is not None:
+                pending.append(parent)
+
+
+class TrackedList(list):
+    """
+    モデルのリスト型のフィールドはすべてこれに置き換えられる。変更されるとowner(リストを持つオブジェクト)と祖先のキャッシュを捨てる。
+    ownerはキャッシュを作るときに設定されるので、それまでは捨てるものがなく何もしない
+    """
+    __slots__ = ("_owner",)
+
+    def __init__(self, iterable=()):
+        super().__init__(iterable)
+        self._owner = None
+
+    def _mutating(name: str):
+        method = getattr(list, name)
+
+        def wrapper(self, *args, **kwargs):
+            result = method(self, *args, **kwargs)
+            owner = None if self._owner is None else self._owner()
+            if owner is not None:
+                _invalidate(owner)
+            return result
+
+        wrapper.__name__ = name
+        return wrapper
+
+    __setitem__ = _mutating("__setitem__")
+    __delitem__ = _mutating("__delitem__")
+    __iadd__ = _mutating("__iadd__")
+    __imul__ = _mutating("__imul__")
+    append = _mutating("append")
+    extend = _mutating("extend")
+    insert = _mutating("insert")
+    pop = _mutating("pop")
+    remove = _mutating("remove")
+    clear = _mutating("clear")
+    sort = _mutating("sort")
+    reverse = _mutating("reverse")
+    del _mutating
+
+    def __reduce_ex__(self, protocol):
+        # ownerの弱参照はpickleできないので、普通のリストとして渡す(受け取ったモデルの__setstate__で置き換える)
+        return list, (list(self),)
+
+
+class Tracked:
+    """
+    dataclassのモデルに継承させる。__post_init__以降のフィールドの書き換えを検知して、キャッシュを持つ祖先のキャッシュを捨てる。
+    これ自体はキャッシュを持たない(OutPoint、TxIn、TxOut)。メモリを節約するため、継承するクラスは__slots__を定義する。
+    _child_fieldsには、モデルのオブジェクトかそのリストが入るフィールドの名前を並べる
+    """
+    __slots__ = ("_parents",)
+    _child_fields = ()
+
+    def __setattr__(self, name: str, value) -> None:
+        if isinstance(value, list):
+            value = TrackedList(value)
+        object.__setattr__(self, name, value)
+        try:
+            self._parents
+        except AttributeError:
+            return  # __init__の途中
+        _invalidate(self)
+
+    def __post_init__(self) -> None:
+        object.__setattr__(self, "_parents", None)
+
+    def __getstate__(self):
+        return {f.name: getattr(self, f.name) for f in fields(self)}
+
+    def __setstate__(self, state) -> None:
+        for name, value in state.items():
+            if isinstance(value, list):
+                value = TrackedList(value)
+            object.__setattr__(self, name, value)
+        object.__setattr__(self, "_parents", None)
+
+
+class Cacheable(Tracked):
+    """
+    キャッシュを持つモデル(Tx、Block)。キャッシュ用の辞書は実際にキャッシュするときまで作らない
+    """
+    __slots__ = ("_cache", "__weakref__")
+
+    def __post_init__(self) -> None:
+        object.__setattr__(self, "_cache", None)
+        super().__post_init__()
+
+    def _cached(self, key: str, compute: Callable):
+        cache = self._cache
+        if cache is None:
+            # 計算中の書き換えもこのオブジェクトに伝わるよう、計算を始める前に子孫と結びつける
+            _link_descendants(self)
+            cache = {}
+            object.__setattr__(self, "_cache", cache)
+        if key in cache:
+            stats[key].hits += 1
+            return cache[key]
+        stats[key].misses += 1
+        value = compute()
+        cache[key] = value
+        return value
+
+    def _cached_value(self, key: str):
+        """
+        キャッシュがあればその値を、なければNoneを返す(統計には数えない)
+        """
+        cache = self._cache
+        return None if cache is None else cache.get(key)
+
+    def __setstate__(self, state) -> None:
+        super().__setstate__(state)
+        object.__setattr__(self, "_cache", None)
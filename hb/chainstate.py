@@ -0,0 +1,156 @@
+"""
+チェーンの先頭の状態をプロセス内に保持し、ブロックが追加されるたびに差分だけ更新する。
+新しいブロックを作るたびにload_blocks()でチェーン全体を読み直さなくても、
+前のブロックのハッシュ、高さ、次のブロックの難易度(get_targetと同じ規則)、累積の仕事量がわかる。
+"""
+from .block import Block, iter_blocks, retarget
+from .config import median_time_span, retarget_block_count
+from .util import bits_to_target, target_to_bits
+
+from collections import deque
+from typing import Deque, Iterable, Optional
+
+import os
+
+
+def block_work(bits: int) -> int:
+    """
+    そのブロックを見つけるまでに必要なハッシュ計算回数の期待値
+    """
+    return (1 << 256) // (bits_to_target(bits) + 1)
+
+
+class ChainState:
+    def __init__(self):
+        self.tip_hash: Optional[bytes] = None
+        self.height = -1
+        self.tip_bits: Optional[int] = None
+        self.cumulative_work = 0
+        # 難易度調整には直近 retarget_block_count - 1 個のブロックの時間だけが必要
+        self._times: Deque[int] = deque(maxlen=retarget_block_count - 1)
+
+    @classmethod
+    def from_blocks(cls, blocks: Iterable[Block]) -> "ChainState":
+        state = cls()
+        for block in blocks:
+            state.connect(block)
+        return state
+
+    @classmethod
+    def from_store(cls, store) -> "ChainState":
+        """
+        BlockStoreから状態を作る。ヘッダだけを読めばよいので、ブロック全体はパースしない
+        """
+        state = cls()
+        for height in range(store.tip_height + 1):
+            view = store.get_block_view_by_height(height)
+            state._connect_header(view.block_hash(), view.hash_prev_block, view.time, view.bits)
+        return state
+
+    @classmethod
+    def from_window(cls, store, block_hash: bytes, cumulative_work: int = 0) -> "ChainState":
+        """
+        保存済みのブロック(分岐したチェーンのものでもよい)を先頭とする状態を作る。
+        前のブロックは難易度調整に必要な数だけたどるので、かかる時間はチェーンの長さによらない。
+        それより前のブロックは読まないので、cumulative_work(先頭までの累積の仕事量)はわかっていれば渡す
+        """
+        location = store.location(block_hash)
+        if location is None:
+            raise Exception("Block is not in the store")
+        state = cls()
+        view = store.get_block_view(block_hash)
+        state.tip_hash = block_hash
+        state.height = location.height
+        state.tip_bits = view.bits
+        state.cumulative_work = cumulative_work
+        times = [view.time]
+        while len(times) < min(state._times.maxlen, location.height + 1):
+            view = store.get_block_view(view.hash_prev_block)
+            times.append(view.time)
+        state._times.extend(reversed(times))
+        return state
+
+    def connect(self, block: Block) -> None:
+        """
+        先頭にブロックを追加する。前のブロックのハッシュが今の先頭と一致しなければ例外を送出する
+        """
+        self._connect_header(block.block_hash(), block.hash_prev_block, block.time, block.bits)
+
+    def _connect_header(self, block_hash: bytes, hash_prev_block: bytes, time: int, bits: int) -> None:
+        if self.tip_hash is not None and hash_prev_block != self.tip_hash:
+            raise Exception("Block does not connect to the tip")
+        self.tip_hash = block_hash
+        self.height += 1
+        self.tip_bits = bits
+        self.cumulative_work += block_work(bits)
+        self._times.append(time)
+
+    def disconnect(self, block: Block, store) -> None:
+        """
+        先頭のブロックを取り除く。一つ前のブロックのbitsと、難易度調整の窓から押し出されていた時間は
+        BlockStore(の有効なチェーン)から読むので、ブロックを取り除く前に呼ぶこと
+        """
+        if block.block_hash() != self.tip_hash:
+            raise Exception("Block is not the tip")
+        self.cumulative_work -= block_work(block.bits)
+        self.height -= 1
+        self._times.pop()
+        if self.height < 0:
+            self.tip_hash = None
+            self.tip_bits = None
+            return
+        self.tip_hash = block.hash_prev_block
+        self.tip_bits = store.get_block_view(block.hash_prev_block).bits
+        first = self.height - len(self._times)
+        if first >= 0:
+            self._times.appendleft(store.get_block_view_by_height(first).time)
+
+    @property
+    def hash_prev_block(self) -> bytes:
+        """次のブロックのhash_prev_blockに入れる値。ジェネシスブロックの場合は32bytes分の0"""
+        return self.tip_hash if self.tip_hash is not None else bytes([0]) * 32
+
+    def next_target(self) -> int:
+        """
+        次のブロックのtarget。get_target(チェーン全体)と同じ値になる
+        """
+        if self.tip_hash is None:
+            raise Exception("Chain is empty")
+        if (self.height + 1) % retarget_block_count == 0:
+            return retarget(self._times[0], self._times[-1], self.tip_bits)
+        return bits_to_target(self.tip_bits)
+
+    def next_bits(self) -> int:
+        return target_to_bits(self.next_target())
+
+    def median_time_past(self) -> int:
+        """
+        直近median_time_span個のブロックの時間の中央値。次のブロックの時間はこれより前であってはならない
+        """
+        if self.tip_hash is None:
+            raise Exception("Chain is empty")
+        times = sorted(list(self._times)[-median_time_span:])
+        return times[len(times) // 2]
+
+
+# 実行時のカレントディレクトリによらないよう、パッケージの位置から求める
+default_blockchain_path = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "blockchain_data", "blockchain.json"
+)
+_chain_state: Optional[ChainState] = None
+
+
+def get_chain_state() -> ChainState:
+    """
+    プロセス内で共有するChainState。最初に呼ばれたときに一度だけdefault_blockchain_pathのblockchain.jsonから作る。
+    別のチェーンを使う場合は、set_chain_stateで設定するか、ChainStateを明示的に渡すこと
+    """
+    global _chain_state
+    if _chain_state is None:
+        _chain_state = ChainState.from_blocks(iter_blocks(path=default_blockchain_path))
+    return _chain_state
+
+
+def set_chain_state(state: Optional[ChainState]) -> None:
+    global _chain_state
+    _chain_state = state
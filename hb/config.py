@@ -2,3 +2,7 @@ address_prefix = b"\x00"
 block_time_span = 30
 retarget_block_count = 2016
 retarget_time_span = block_time_span * retarget_block_count
+max_future_block_time = 2 * 60 * 60
+max_block_size = 1000000
+block_reward = 50 * 10 ** 9
+median_time_span = 11
@@ -0,0 +1,218 @@
+"""
+secp256k1上のECDSA(署名の生成と検証)を標準ライブラリだけで実装したもの。
+点の計算はヤコビアン座標で行い、逆元の計算を最後の1回だけにする。
+検証ではu1*G + u2*Qを2つ同時に計算する(Shamir's trick)ので、スカラー倍2回分より速い。
+署名のkはRFC 6979で秘密鍵とメッセージから決める(乱数を使わない)。sは常に小さい方(low-S)にする。
+"""
+from typing import Optional, Tuple
+
+import hashlib
+import hmac
+
+
+p = 0xfffffffffffffffffffffffffffffffffffffffffffffffffffffffefffffc2f
+n = 0xfffffffffffffffffffffffffffffffebaaedce6af48a03bbfd25e8cd0364141
+g = (
+    0x79be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798,
+    0x483ada7726a3c4655da4fbfc0e1108a8fd17b448a68554199c47d08ffb10d4b8
+)
+
+Point = Optional[Tuple[int, int]]  # Noneは無限遠点
+_Jacobian = Tuple[int, int, int]  # (X, Y, Z)。Z == 0は無限遠点
+
+
+def _double(point: _Jacobian) -> _Jacobian:
+    x, y, z = point
+    if y == 0 or z == 0:
+        return 0, 1, 0
+    ysq = y * y % p
+    s = 4 * x * ysq % p
+    m = 3 * x * x % p  # a = 0
+    nx = (m * m - 2 * s) % p
+    ny = (m * (s - nx) - 8 * ysq * ysq) % p
+    nz = 2 * y * z % p
+    return nx, ny, nz
+
+
+def _add(a: _Jacobian, b: _Jacobian) -> _Jacobian:
+    if a[2] == 0:
+        return b
+    if b[2] == 0:
+        return a
+    x1, y1, z1 = a
+    x2, y2, z2 = b
+    z1z1 = z1 * z1 % p
+    z2z2 = z2 * z2 % p
+    u1 = x1 * z2z2 % p
+    u2 = x2 * z1z1 % p
+    s1 = y1 * z2 * z2z2 % p
+    s2 = y2 * z1 * z1z1 % p
+    if u1 == u2:
+        if s1 != s2:
+            return 0, 1, 0
+        return _double(a)
+    h = (u2 - u1) % p
+    r = (s2 - s1) % p
+    hh = h * h % p
+    hhh = h * hh % p
+    v = u1 * hh % p
+    nx = (r * r - hhh - 2 * v) % p
+    ny = (r * (v - nx) - s1 * hhh) % p
+    nz = h * z1 * z2 % p
+    return nx, ny, nz
+
+
+def _to_affine(point: _Jacobian) -> Point:
+    x, y, z = point
+    if z == 0:
+        return None
+    z_inv = pow(z, -1, p)
+    z_inv2 = z_inv * z_inv % p
+    return x * z_inv2 % p, y * z_inv2 * z_inv % p
+
+
+def _to_jacobian(point: Point) -> _Jacobian:
+    if point is None:
+        return 0, 1, 0
+    return point[0], point[1], 1
+
+
+def _multiply(k: int, point: Point) -> _Jacobian:
+    result = (0, 1, 0)
+    addend = _to_jacobian(point)
+    while k:
+        if k & 1:
+            result = _add(result, addend)
+        addend = _double(addend)
+        k >>= 1
+    return result
+
+
+def _double_multiply(k1: int, p1: Point, k2: int, p2: Point) -> _Jacobian:
+    """
+    k1*p1 + k2*p2を、ビットを上から見ながら1回の倍算の列で求める
+    """
+    j1, j2 = _to_jacobian(p1), _to_jacobian(p2)
+    j12 = _add(j1, j2)
+    table = {(1, 0): j1, (0, 1): j2, (1, 1): j12}
+    result = (0, 1, 0)
+    for i in range(max(k1.bit_length(), k2.bit_length()) - 1, -1, -1):
+        result = _double(result)
+        bits = ((k1 >> i) & 1, (k2 >> i) & 1)
+        if bits != (0, 0):
+            result = _add(result, table[bits])
+    return result
+
+
+def is_on_curve(point: Point) -> bool:
+    if point is None:
+        return False
+    x, y = point
+    return 0 <= x < p and 0 <= y < p and (y * y - x * x * x - 7) % p == 0
+
+
+def private_to_public(private_key: int) -> Point:
+    if not 0 < private_key < n:
+        raise ValueError("Private key is out of range")
+    return _to_affine(_multiply(private_key, g))
+
+
+def encode_pubkey(point: Point, compressed: bool = True) -> bytes:
+    x, y = point
+    if compressed:
+        return bytes([2 + (y & 1)]) + x.to_bytes(32, "big")
+    return b"\x04" + x.to_bytes(32, "big") + y.to_bytes(32, "big")
+
+
+def decode_pubkey(data: bytes) -> Point:
+    """
+    SEC1形式(圧縮33bytes、非圧縮65bytes)の公開鍵を点に戻す。曲線上にない場合はValueErrorを送出する
+    """
+    if len(data) == 33 and data[0] in (2, 3):
+        x = int.from_bytes(data[1:], "big")
+        if x >= p:
+            raise ValueError("Invalid public key")
+        y = pow((x * x * x + 7) % p, (p + 1) // 4, p)  # p ≡ 3 (mod 4) なので平方根はこれで求まる
+        if (y & 1) != (data[0] & 1):
+            y = p - y
+        point = (x, y)
+    elif len(data) == 65 and data[0] == 4:
+        point = (int.from_bytes(data[1:33], "big"), int.from_bytes(data[33:], "big"))
+    else:
+        raise ValueError("Invalid public key encoding")
+    if not is_on_curve(point):
+        raise ValueError("Public key is not on the curve")
+    return point
+
+
+def encode_der(r: int, s: int) -> bytes:
+    def encode_int(v: int) -> bytes:
+        data = v.to_bytes((v.bit_length() + 7) // 8 or 1, "big")
+        if data[0] & 0x80:
+            data = b"\x00" + data
+        return b"\x02" + bytes([len(data)]) + data
+
+    body = encode_int(r) + encode_int(s)
+    return b"\x30" + bytes([len(body)]) + body
+
+
+def decode_der(sig: bytes) -> Tuple[int, int]:
+    """
+    DER形式の署名から(r, s)を取り出す。形式が厳密に正しくなければValueErrorを送出する
+    """
+    if len(sig) < 8 or len(sig) > 72 or sig[0] != 0x30 or sig[1] != len(sig) - 2:
+        raise ValueError("Invalid DER signature")
+    values = []
+    offset = 2
+    for _ in range(2):
+        if offset + 2 > len(sig) or sig[offset] != 0x02:
+            raise ValueError("Invalid DER signature")
+        length = sig[offset + 1]
+        data = sig[offset + 2:offset + 2 + length]
+        if length == 0 or len(data) != length or data[0] & 0x80 or (length > 1 and data[0] == 0 and not data[1] & 0x80):
+            raise ValueError("Invalid DER integer")
+        values.append(int.from_bytes(data, "big"))
+        offset += 2 + length
+    if offset != len(sig):
+        raise ValueError("Invalid DER signature")
+    return values[0], values[1]
+
+
+def _deterministic_k(private_key: int, z: int):
+    """RFC 6979 (HMAC-SHA256) でkの候補を順に生成する"""
+    x = private_key.to_bytes(32, "big")
+    h = (z % n).to_bytes(32, "big")
+    v = b"\x01" * 32
+    k = b"\x00" * 32
+    k = hmac.new(k, v + b"\x00" + x + h, hashlib.sha256).digest()
+    v = hmac.new(k, v, hashlib.sha256).digest()
+    k = hmac.new(k, v + b"\x01" + x + h, hashlib.sha256).digest()
+    v = hmac.new(k, v, hashlib.sha256).digest()
+    while True:
+        v = hmac.new(k, v, hashlib.sha256).digest()
+        candidate = int.from_bytes(v, "big")
+        if 0 < candidate < n:
+            yield candidate
+        k = hmac.new(k, v + b"\x00", hashlib.sha256).digest()
+        v = hmac.new(k, v, hashlib.sha256).digest()
+
+
+def sign(private_key: int, msg_hash: bytes) -> Tuple[int, int]:
+    z = int.from_bytes(msg_hash, "big")
+    for k in _deterministic_k(private_key, z):
+        r = _to_affine(_multiply(k, g))[0] % n
+        if r == 0:
+            continue
+        s = pow(k, -1, n) * (z + r * private_key) % n
+        if s == 0:
+            continue
+        return r, min(s, n - s)
+
+
+def verify(public_key: Point, msg_hash: bytes, r: int, s: int) -> bool:
+    if not (0 < r < n and 0 < s < n):
+        return False
+    z = int.from_bytes(msg_hash, "big")
+    w = pow(s, -1, n)
+    point = _to_affine(_double_multiply(z * w % n, g, r * w % n, public_key))
+    return point is not None and point[0] % n == r
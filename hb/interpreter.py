@@ -0,0 +1,571 @@
+"""
+Bitcoin Scriptのインタプリタ。
+
+スクリプトはまずparse_scriptで(opcode, pushするデータ)のタプルの列に変換する。結果はキャッシュされるので、
+address_to_scriptが作るP2PKHのscript_pubkeyのように何度も現れるスクリプトは、一度しかデコードしない。
+実行時はopcodeを添字にした256要素の表(_dispatch)から処理を引くので、IntEnumとのif文の連鎖にはならない。
+
+スタックの深さ、要素の大きさ、スクリプトの大きさ、実行するopcodeの数にはBitcoinと同じ上限を設ける。
+OP_CHECKSIGの署名の検証はSignatureChecker(通常はTxSignatureChecker)に任せる。
+"""
+from .ecc import decode_der, decode_pubkey, verify
+from .script import Opcodes
+from .sighash import SignatureHasher
+from .tx import Tx
+from .util import sha256, sha256d, ripemd160, hash160
+
+from functools import lru_cache
+from typing import Callable, List, Optional, Tuple
+
+import hashlib
+
+
+max_script_size = 10000
+max_ops_per_script = 201
+max_stack_size = 1000
+max_element_size = 520
+max_num_size = 4
+max_pubkeys_per_multisig = 20
+parse_cache_size = 1 << 14
+
+ParsedScript = Tuple[Tuple[int, Optional[bytes]], ...]
+
+
+class ScriptError(Exception):
+    pass
+
+
+@lru_cache(maxsize=parse_cache_size)
+def parse_script(script: bytes) -> ParsedScript:
+    """
+    スクリプトを(opcode, データ)のタプルに分解する。pushでないopcodeのデータはNone。
+    OP_0は空のバイト列をpushするものとして扱う
+    """
+    if len(script) > max_script_size:
+        raise ScriptError("Script is too large")
+    ops = []
+    offset = 0
+    end = len(script)
+    while offset < end:
+        op = script[offset]
+        offset += 1
+        if op > Opcodes.OP_PUSHDATA4:
+            ops.append((op, None))
+            continue
+        if op < Opcodes.OP_PUSHDATA1:
+            length = op
+        else:
+            size = {Opcodes.OP_PUSHDATA1: 1, Opcodes.OP_PUSHDATA2: 2, Opcodes.OP_PUSHDATA4: 4}[op]
+            if offset + size > end:
+                raise ScriptError("Push length is truncated")
+            length = int.from_bytes(script[offset:offset + size], "little")
+            offset += size
+        if offset + length > end:
+            raise ScriptError("Push data is truncated")
+        ops.append((op, script[offset:offset + length]))
+        offset += length
+    return tuple(ops)
+
+
+def serialize_ops(ops) -> bytes:
+    result = bytearray()
+    for op, data in ops:
+        result.append(op)
+        if data is not None and op >= Opcodes.OP_PUSHDATA1:
+            size = {Opcodes.OP_PUSHDATA1: 1, Opcodes.OP_PUSHDATA2: 2, Opcodes.OP_PUSHDATA4: 4}[op]
+            result += len(data).to_bytes(size, "little")
+        if data is not None:
+            result += data
+    return bytes(result)
+
+
+def decode_num(data: bytes, max_size: int = max_num_size) -> int:
+    """
+    スクリプト中の数値(little endian、最上位ビットが符号)を整数にする
+    """
+    if len(data) > max_size:
+        raise ScriptError("Number is too large")
+    if not data:
+        return 0
+    value = int.from_bytes(data, "little")
+    if data[-1] & 0x80:
+        return -(value & ~(0x80 << (8 * (len(data) - 1))))
+    return value
+
+
+def encode_num(value: int) -> bytes:
+    if value == 0:
+        return b""
+    negative = value < 0
+    magnitude = abs(value)
+    result = bytearray(magnitude.to_bytes((magnitude.bit_length() + 7) // 8, "little"))
+    if result[-1] & 0x80:
+        result.append(0x80 if negative else 0)
+    elif negative:
+        result[-1] |= 0x80
+    return bytes(result)
+
+
+def cast_to_bool(data: bytes) -> bool:
+    for i, byte in enumerate(data):
+        if byte != 0:
+            # 負のゼロ(末尾が0x80で他が0)は偽
+            return not (i == len(data) - 1 and byte == 0x80)
+    return False
+
+
+class SignatureChecker:
+    """
+    OP_CHECKSIGの署名の検証方法。既定ではすべての署名を不正とみなす
+    """
+    def check_sig(self, sig: bytes, pubkey: bytes, script_code: bytes) -> bool:
+        return False
+
+
+class TxSignatureChecker(SignatureChecker):
+    """
+    tx.tx_ins[index]の署名として検証する。同じTxの複数の入力を検証する場合は、同じhasherを渡す
+    """
+    def __init__(self, tx: Tx, index: int, hasher: Optional[SignatureHasher] = None):
+        self.tx = tx
+        self.index = index
+        self.hasher = SignatureHasher(tx) if hasher is None else hasher
+
+    def signature_hash(self, script_code: bytes, hash_type: int) -> bytes:
+        return self.hasher.hash(self.index, script_code, hash_type)
+
+    def verify_signature(self, digest: bytes, sig: bytes, pubkey: bytes) -> bool:
+        try:
+            r, s = decode_der(sig)
+            point = decode_pubkey(pubkey)
+        except ValueError:
+            return False
+        return verify(point, digest, r, s)
+
+    def check_sig(self, sig: bytes, pubkey: bytes, script_code: bytes) -> bool:
+        if not sig:
+            return False
+        return self.verify_signature(self.signature_hash(script_code, sig[-1]), sig[:-1], pubkey)
+
+
+class _Context:
+    __slots__ = ("stack", "altstack", "conditions", "false_count", "checker", "ops", "codesep", "op_count", "pc", "op")
+
+    def __init__(self, stack: List[bytes], checker: SignatureChecker, ops: ParsedScript):
+        self.stack = stack
+        self.altstack: List[bytes] = []
+        self.conditions: List[bool] = []
+        self.false_count = 0  # conditionsのうちFalseの数。0のときだけ実行する
+        self.checker = checker
+        self.ops = ops
+        self.codesep = 0  # 最後に実行したOP_CODESEPARATORの次のopの位置
+        self.op_count = 0
+        self.pc = 0  # 実行中のopの位置
+        self.op = 0  # 実行中のopcode(1つの処理を複数のopcodeで共有するため)
+
+    def pop(self) -> bytes:
+        if not self.stack:
+            raise ScriptError("Stack is empty")
+        return self.stack.pop()
+
+    def pop_num(self) -> int:
+        return decode_num(self.pop())
+
+    def need(self, count: int) -> None:
+        if len(self.stack) < count:
+            raise ScriptError("Not enough items on the stack")
+
+    def script_code(self, remove: List[bytes]) -> bytes:
+        """
+        署名の対象にするスクリプト。最後のOP_CODESEPARATORより後ろで、署名自身のpushを取り除いたもの
+        """
+        return serialize_ops(
+            (op, data) for op, data in self.ops[self.codesep:]
+            if op != Opcodes.OP_CODESEPARATOR and (data is None or data not in remove)
+        )
+
+
+_dispatch: List[Optional[Callable[[_Context], None]]] = [None] * 256
+_disabled = {
+    Opcodes.OP_CAT, Opcodes.OP_SUBSTR, Opcodes.OP_LEFT, Opcodes.OP_RIGHT,
+    Opcodes.OP_INVERT, Opcodes.OP_AND, Opcodes.OP_OR, Opcodes.OP_XOR,
+    Opcodes.OP_2MUL, Opcodes.OP_2DIV, Opcodes.OP_MUL, Opcodes.OP_DIV, Opcodes.OP_MOD,
+    Opcodes.OP_LSHIFT, Opcodes.OP_RSHIFT
+}
+_flow_control = range(Opcodes.OP_IF, Opcodes.OP_ENDIF + 1)
+
+
+def _opcode(*ops: int):
+    def register(handler: Callable[[_Context], None]):
+        for op in ops:
+            _dispatch[op] = handler
+        return handler
+    return register
+
+
+def _push_small_int(value: int) -> Callable[[_Context], None]:
+    data = encode_num(value)
+
+    def handler(ctx: _Context) -> None:
+        ctx.stack.append(data)
+    return handler
+
+
+_dispatch[Opcodes.OP_1NEGATE] = _push_small_int(-1)
+for _n in range(1, 17):
+    _dispatch[Opcodes.OP_1 + _n - 1] = _push_small_int(_n)
+
+
+@_opcode(
+    Opcodes.OP_NOP, Opcodes.OP_NOP1, Opcodes.OP_CHECKLOCKTIMEVERIFY, Opcodes.OP_CHECKSEQUENCEVERIFY,
+    Opcodes.OP_NOP4, Opcodes.OP_NOP5, Opcodes.OP_NOP6, Opcodes.OP_NOP7, Opcodes.OP_NOP8, Opcodes.OP_NOP9, Opcodes.OP_NOP10
+)
+def _op_nop(ctx: _Context) -> None:
+    pass
+
+
+@_opcode(Opcodes.OP_IF, Opcodes.OP_NOTIF)
+def _op_if(ctx: _Context) -> None:
+    # 実行していない分岐の中のIFは、対応するENDIFまでを読み飛ばすためだけに積む
+    value = False
+    if ctx.false_count == 0:
+        value = cast_to_bool(ctx.pop())
+        if ctx.op == Opcodes.OP_NOTIF:
+            value = not value
+    ctx.conditions.append(value)
+    if not value:
+        ctx.false_count += 1
+
+
+@_opcode(Opcodes.OP_ELSE)
+def _op_else(ctx: _Context) -> None:
+    if not ctx.conditions:
+        raise ScriptError("OP_ELSE without OP_IF")
+    # 外側の分岐が実行されていない場合も反転させるが、false_countが0にならないので実行は再開しない
+    value = ctx.conditions[-1]
+    ctx.conditions[-1] = not value
+    ctx.false_count += 1 if value else -1
+
+
+@_opcode(Opcodes.OP_ENDIF)
+def _op_endif(ctx: _Context) -> None:
+    if not ctx.conditions:
+        raise ScriptError("OP_ENDIF without OP_IF")
+    if not ctx.conditions.pop():
+        ctx.false_count -= 1
+
+
+@_opcode(Opcodes.OP_VERIFY)
+def _op_verify(ctx: _Context) -> None:
+    if not cast_to_bool(ctx.pop()):
+        raise ScriptError("OP_VERIFY failed")
+
+
+@_opcode(Opcodes.OP_RETURN)
+def _op_return(ctx: _Context) -> None:
+    raise ScriptError("OP_RETURN was executed")
+
+
+@_opcode(Opcodes.OP_TOALTSTACK)
+def _op_toaltstack(ctx: _Context) -> None:
+    ctx.altstack.append(ctx.pop())
+
+
+@_opcode(Opcodes.OP_FROMALTSTACK)
+def _op_fromaltstack(ctx: _Context) -> None:
+    if not ctx.altstack:
+        raise ScriptError("Alt stack is empty")
+    ctx.stack.append(ctx.altstack.pop())
+
+
+@_opcode(Opcodes.OP_2DROP)
+def _op_2drop(ctx: _Context) -> None:
+    ctx.need(2)
+    del ctx.stack[-2:]
+
+
+@_opcode(Opcodes.OP_2DUP)
+def _op_2dup(ctx: _Context) -> None:
+    ctx.need(2)
+    ctx.stack.extend(ctx.stack[-2:])
+
+
+@_opcode(Opcodes.OP_3DUP)
+def _op_3dup(ctx: _Context) -> None:
+    ctx.need(3)
+    ctx.stack.extend(ctx.stack[-3:])
+
+
+@_opcode(Opcodes.OP_2OVER)
+def _op_2over(ctx: _Context) -> None:
+    ctx.need(4)
+    ctx.stack.extend(ctx.stack[-4:-2])
+
+
+@_opcode(Opcodes.OP_2ROT)
+def _op_2rot(ctx: _Context) -> None:
+    ctx.need(6)
+    items = ctx.stack[-6:-4]
+    del ctx.stack[-6:-4]
+    ctx.stack.extend(items)
+
+
+@_opcode(Opcodes.OP_2SWAP)
+def _op_2swap(ctx: _Context) -> None:
+    ctx.need(4)
+    s = ctx.stack
+    s[-4], s[-3], s[-2], s[-1] = s[-2], s[-1], s[-4], s[-3]
+
+
+@_opcode(Opcodes.OP_IFDUP)
+def _op_ifdup(ctx: _Context) -> None:
+    ctx.need(1)
+    if cast_to_bool(ctx.stack[-1]):
+        ctx.stack.append(ctx.stack[-1])
+
+
+@_opcode(Opcodes.OP_DEPTH)
+def _op_depth(ctx: _Context) -> None:
+    ctx.stack.append(encode_num(len(ctx.stack)))
+
+
+@_opcode(Opcodes.OP_DROP)
+def _op_drop(ctx: _Context) -> None:
+    ctx.pop()
+
+
+@_opcode(Opcodes.OP_DUP)
+def _op_dup(ctx: _Context) -> None:
+    ctx.need(1)
+    ctx.stack.append(ctx.stack[-1])
+
+
+@_opcode(Opcodes.OP_NIP)
+def _op_nip(ctx: _Context) -> None:
+    ctx.need(2)
+    del ctx.stack[-2]
+
+
+@_opcode(Opcodes.OP_OVER)
+def _op_over(ctx: _Context) -> None:
+    ctx.need(2)
+    ctx.stack.append(ctx.stack[-2])
+
+
+@_opcode(Opcodes.OP_PICK, Opcodes.OP_ROLL)
+def _op_pick(ctx: _Context) -> None:
+    n = ctx.pop_num()
+    if n < 0 or n >= len(ctx.stack):
+        raise ScriptError("Invalid stack index")
+    item = ctx.stack[-n - 1]
+    if ctx.op == Opcodes.OP_ROLL:
+        del ctx.stack[-n - 1]
+    ctx.stack.append(item)
+
+
+@_opcode(Opcodes.OP_ROT)
+def _op_rot(ctx: _Context) -> None:
+    ctx.need(3)
+    ctx.stack.append(ctx.stack.pop(-3))
+
+
+@_opcode(Opcodes.OP_SWAP)
+def _op_swap(ctx: _Context) -> None:
+    ctx.need(2)
+    s = ctx.stack
+    s[-2], s[-1] = s[-1], s[-2]
+
+
+@_opcode(Opcodes.OP_TUCK)
+def _op_tuck(ctx: _Context) -> None:
+    ctx.need(2)
+    ctx.stack.insert(-2, ctx.stack[-1])
+
+
+@_opcode(Opcodes.OP_SIZE)
+def _op_size(ctx: _Context) -> None:
+    ctx.need(1)
+    ctx.stack.append(encode_num(len(ctx.stack[-1])))
+
+
+@_opcode(Opcodes.OP_EQUAL)
+def _op_equal(ctx: _Context) -> None:
+    b, a = ctx.pop(), ctx.pop()
+    ctx.stack.append(encode_num(a == b))
+
+
+@_opcode(Opcodes.OP_EQUALVERIFY)
+def _op_equalverify(ctx: _Context) -> None:
+    if ctx.pop() != ctx.pop():
+        raise ScriptError("OP_EQUALVERIFY failed")
+
+
+def _unary(f: Callable[[int], int]) -> Callable[[_Context], None]:
+    def handler(ctx: _Context) -> None:
+        ctx.stack.append(encode_num(f(ctx.pop_num())))
+    return handler
+
+
+def _binary(f: Callable[[int, int], int]) -> Callable[[_Context], None]:
+    def handler(ctx: _Context) -> None:
+        b = ctx.pop_num()
+        a = ctx.pop_num()
+        ctx.stack.append(encode_num(int(f(a, b))))
+    return handler
+
+
+_dispatch[Opcodes.OP_1ADD] = _unary(lambda a: a + 1)
+_dispatch[Opcodes.OP_1SUB] = _unary(lambda a: a - 1)
+_dispatch[Opcodes.OP_NEGATE] = _unary(lambda a: -a)
+_dispatch[Opcodes.OP_ABS] = _unary(abs)
+_dispatch[Opcodes.OP_NOT] = _unary(lambda a: a == 0)
+_dispatch[Opcodes.OP_0NOTEQUAL] = _unary(lambda a: a != 0)
+_dispatch[Opcodes.OP_ADD] = _binary(lambda a, b: a + b)
+_dispatch[Opcodes.OP_SUB] = _binary(lambda a, b: a - b)
+_dispatch[Opcodes.OP_BOOLAND] = _binary(lambda a, b: a != 0 and b != 0)
+_dispatch[Opcodes.OP_BOOLOR] = _binary(lambda a, b: a != 0 or b != 0)
+_dispatch[Opcodes.OP_NUMEQUAL] = _binary(lambda a, b: a == b)
+_dispatch[Opcodes.OP_NUMNOTEQUAL] = _binary(lambda a, b: a != b)
+_dispatch[Opcodes.OP_LESSTHAN] = _binary(lambda a, b: a < b)
+_dispatch[Opcodes.OP_GREATERTHAN] = _binary(lambda a, b: a > b)
+_dispatch[Opcodes.OP_LESSTHANOREQUAL] = _binary(lambda a, b: a <= b)
+_dispatch[Opcodes.OP_GREATERTHANOREQUAL] = _binary(lambda a, b: a >= b)
+_dispatch[Opcodes.OP_MIN] = _binary(min)
+_dispatch[Opcodes.OP_MAX] = _binary(max)
+
+
+@_opcode(Opcodes.OP_NUMEQUALVERIFY)
+def _op_numequalverify(ctx: _Context) -> None:
+    if ctx.pop_num() != ctx.pop_num():
+        raise ScriptError("OP_NUMEQUALVERIFY failed")
+
+
+@_opcode(Opcodes.OP_WITHIN)
+def _op_within(ctx: _Context) -> None:
+    upper = ctx.pop_num()
+    lower = ctx.pop_num()
+    x = ctx.pop_num()
+    ctx.stack.append(encode_num(lower <= x < upper))
+
+
+def _hash_op(f: Callable[[bytes], bytes]) -> Callable[[_Context], None]:
+    def handler(ctx: _Context) -> None:
+        ctx.stack.append(f(ctx.pop()))
+    return handler
+
+
+_dispatch[Opcodes.OP_RIPEMD160] = _hash_op(ripemd160)
+_dispatch[Opcodes.OP_SHA1] = _hash_op(lambda x: hashlib.sha1(x).digest())
+_dispatch[Opcodes.OP_SHA256] = _hash_op(sha256)
+_dispatch[Opcodes.OP_HASH160] = _hash_op(hash160)
+_dispatch[Opcodes.OP_HASH256] = _hash_op(sha256d)
+
+
+@_opcode(Opcodes.OP_CODESEPARATOR)
+def _op_codeseparator(ctx: _Context) -> None:
+    ctx.codesep = ctx.pc + 1
+
+
+@_opcode(Opcodes.OP_CHECKSIG, Opcodes.OP_CHECKSIGVERIFY)
+def _op_checksig(ctx: _Context) -> None:
+    pubkey = ctx.pop()
+    sig = ctx.pop()
+    ok = ctx.checker.check_sig(sig, pubkey, ctx.script_code([sig]))
+    if ctx.op == Opcodes.OP_CHECKSIGVERIFY:
+        if not ok:
+            raise ScriptError("OP_CHECKSIGVERIFY failed")
+    else:
+        ctx.stack.append(encode_num(ok))
+
+
+@_opcode(Opcodes.OP_CHECKMULTISIG, Opcodes.OP_CHECKMULTISIGVERIFY)
+def _op_checkmultisig(ctx: _Context) -> None:
+    key_count = ctx.pop_num()
+    if not 0 <= key_count <= max_pubkeys_per_multisig:
+        raise ScriptError("Invalid public key count")
+    ctx.op_count += key_count
+    if ctx.op_count > max_ops_per_script:
+        raise ScriptError("Too many operations")
+    pubkeys = [ctx.pop() for _ in range(key_count)]
+    sig_count = ctx.pop_num()
+    if not 0 <= sig_count <= key_count:
+        raise ScriptError("Invalid signature count")
+    sigs = [ctx.pop() for _ in range(sig_count)]
+    ctx.pop()  # Bitcoinの実装の不具合で、余分に1つ取り除く
+    script_code = ctx.script_code(sigs)
+
+    # 署名は公開鍵と同じ順に並んでいる必要がある
+    ok = True
+    key_index = 0
+    for sig in sigs:
+        while key_index < len(pubkeys) and not ctx.checker.check_sig(sig, pubkeys[key_index], script_code):
+            key_index += 1
+        if key_index == len(pubkeys):
+            ok = False
+            break
+        key_index += 1
+    if ctx.op == Opcodes.OP_CHECKMULTISIGVERIFY:
+        if not ok:
+            raise ScriptError("OP_CHECKMULTISIGVERIFY failed")
+    else:
+        ctx.stack.append(encode_num(ok))
+
+
+def eval_script(script: bytes, stack: List[bytes], checker: SignatureChecker = None) -> None:
+    """
+    stackの上でscriptを実行する。失敗した場合はScriptErrorを送出する
+    """
+    ops = parse_script(bytes(script))
+    ctx = _Context(stack, checker or SignatureChecker(), ops)
+    altstack = ctx.altstack
+    for pc, (op, data) in enumerate(ops):
+        if data is not None:
+            if len(data) > max_element_size:
+                raise ScriptError("Push data is too large")
+            if ctx.false_count == 0:
+                stack.append(data)
+        else:
+            if op > Opcodes.OP_16:
+                ctx.op_count += 1
+                if ctx.op_count > max_ops_per_script:
+                    raise ScriptError("Too many operations")
+            if op in _disabled:
+                raise ScriptError(f"Disabled opcode {op:#04x}")
+            if ctx.false_count == 0 or op in _flow_control:
+                handler = _dispatch[op]
+                if handler is None:
+                    raise ScriptError(f"Invalid opcode {op:#04x}")
+                ctx.pc = pc
+                ctx.op = op
+                handler(ctx)
+        if len(stack) + len(altstack) > max_stack_size:
+            raise ScriptError("Stack is too large")
+    if ctx.conditions:
+        raise ScriptError("Unbalanced conditional")
+
+
+def is_push_only(script: bytes) -> bool:
+    return all(data is not None or op <= Opcodes.OP_16 for op, data in parse_script(bytes(script)))
+
+
+def verify_script(script_sig: bytes, script_pubkey: bytes, checker: SignatureChecker = None) -> None:
+    """
+    script_sigを実行した結果のスタックの上でscript_pubkeyを実行し、最後にスタックの一番上が真であることを確かめる。
+    失敗した場合はScriptErrorを送出する
+    """
+    if not is_push_only(script_sig):
+        raise ScriptError("script_sig is not push only")
+    stack: List[bytes] = []
+    eval_script(script_sig, stack, checker)
+    eval_script(script_pubkey, stack, checker)
+    if not stack or not cast_to_bool(stack[-1]):
+        raise ScriptError("Script evaluated to false")
+
+
+def verify_input(tx: Tx, index: int, script_pubkey: bytes, checker: SignatureChecker = None) -> None:
+    """
+    tx.tx_ins[index]が、script_pubkeyの出力を使う権利を持っているかを確かめる
+    """
+    if checker is None:
+        checker = TxSignatureChecker(tx, index)
+    verify_script(tx.tx_ins[index].script_sig, script_pubkey, checker)
@@ -0,0 +1,422 @@
+"""
+まだブロックに含まれていないTxを保持するメモリプール。
+
+- TxのハッシュとTxが使う出力(OutPoint)の両方から引けるので、同じ出力を使う(二重支払いになる)Txはすぐにわかる
+- プール内の親子関係をたどり、各Txについて祖先(自分を含む)と子孫(自分を含む)の手数料と大きさの合計を保持する
+- 大きさの合計がmax_sizeを超えたら、子孫を含めた手数料率が最も低いTxから(子孫ごと)追い出す
+- ブロックのテンプレートは、祖先を含めた手数料率が高い順に、祖先ごとTxを選んで詰める
+- 入力のスクリプトは署名のキャッシュ(sigcache)を通して検証するので、ブロックに含まれたときの検証はキャッシュで済む
+- ディスクへの書き出しは、変更のたびではなくpersist_interval秒ごとにまとめて行う
+"""
+from .block import Block
+from .interpreter import verify_input
+from .sigcache import CachingSignatureChecker
+from .sighash import SignatureHasher
+from .tx import Tx
+from .utxo import UtxoSet, outpoint_key
+from .util import int_to_bytes, bytes_to_int
+
+from time import monotonic
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import heapq
+import logging
+import os
+
+
+logger = logging.getLogger(__name__)
+
+default_max_size = 32 * 1024 * 1024
+default_persist_interval = 15 * 60
+# 1つのTxがプール内に持てる祖先の数(自分を含む)。深い親子関係を作って計算量を増やす攻撃を防ぐ
+max_ancestors = 25
+
+
+class MempoolEntry:
+    __slots__ = (
+        "tx", "tx_hash", "fee", "size", "time", "parents", "children",
+        "ancestor_count", "ancestor_size", "ancestor_fee",
+        "descendant_count", "descendant_size", "descendant_fee",
+        "version"
+    )
+
+    def __init__(self, tx: Tx, tx_hash: bytes, fee: int, size: int, parents: Set[bytes]):
+        self.tx = tx
+        self.tx_hash = tx_hash
+        self.fee = fee
+        self.size = size
+        self.time = monotonic()
+        self.parents = parents
+        self.children: Set[bytes] = set()
+        self.ancestor_count = 1
+        self.ancestor_size = size
+        self.ancestor_fee = fee
+        self.descendant_count = 1
+        self.descendant_size = size
+        self.descendant_fee = fee
+        # 子孫の合計が変わるたびに進める。追い出し用のヒープの古い要素を見分けるのに使う
+        self.version = 0
+
+    @property
+    def fee_rate(self) -> float:
+        return self.fee / self.size
+
+    @property
+    def ancestor_fee_rate(self) -> float:
+        return self.ancestor_fee / self.ancestor_size
+
+    @property
+    def descendant_fee_rate(self) -> float:
+        return self.descendant_fee / self.descendant_size
+
+
+class Mempool:
+    def __init__(
+            self,
+            utxo: UtxoSet,
+            max_size: int = default_max_size,
+            path: Optional[str] = "../blockchain_data/mempool.dat",
+            persist_interval: float = default_persist_interval,
+            verify_scripts: bool = True
+    ):
+        """
+        utxoはプール外の入力の金額を調べるのに使う。pathがNoneならディスクには書き出さない。
+        verify_scriptsがFalseなら入力のスクリプトを検証しない
+        """
+        self.utxo = utxo
+        self.max_size = max_size
+        self.path = path
+        self.persist_interval = persist_interval
+        self.verify_scripts = verify_scripts
+        self.total_size = 0
+        self._entries: Dict[bytes, MempoolEntry] = {}
+        self._spent_by: Dict[bytes, bytes] = {}  # OutPointのキー -> それを使うTxのハッシュ
+        self._eviction_heap: List[Tuple[float, int, bytes, int]] = []
+        self._sequence = 0
+        self._last_persist = monotonic()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, tx_hash: bytes) -> bool:
+        return tx_hash in self._entries
+
+    def get(self, tx_hash: bytes) -> Optional[MempoolEntry]:
+        return self._entries.get(tx_hash)
+
+    def spender(self, tx_hash: bytes, index: int) -> Optional[bytes]:
+        """その出力を使っているプール内のTxのハッシュ"""
+        return self._spent_by.get(outpoint_key(tx_hash, index))
+
+    def txs(self) -> Iterator[Tx]:
+        """
+        プール内のTxを、親が子より先になる順に返す
+        """
+        for entry in sorted(self._entries.values(), key=lambda e: e.ancestor_count):
+            yield entry.tx
+
+    def add(self, tx: Tx) -> MempoolEntry:
+        """
+        Txをプールに加える。使う出力が存在しない、プール内のTxと同じ出力を使う、手数料が負、スクリプトが不正、祖先が多すぎる、
+        プールがいっぱいで手数料率が低すぎる、のいずれかに当てはまれば例外を送出し、何も変更しない
+        """
+        tx_hash = tx.tx_hash()
+        if tx_hash in self._entries:
+            raise Exception("Tx is already in the mempool")
+        if not tx.tx_ins:
+            raise Exception("Tx has no inputs")
+
+        value_in = 0
+        parents = set()
+        keys = []
+        script_pubkeys = []
+        for tx_in in tx.tx_ins:
+            key = tx_in.outpoint.as_bin()
+            if key in self._spent_by or key in keys:
+                spender = self._spent_by.get(key, tx_hash)
+                raise Exception(f"Tx conflicts with {spender[::-1].hex()}")
+            keys.append(key)
+            parent = self._entries.get(tx_in.outpoint.tx_hash)
+            if parent is not None:
+                if tx_in.outpoint.index >= len(parent.tx.tx_outs):
+                    raise Exception("Tx spends a missing output")
+                value_in += parent.tx.tx_outs[tx_in.outpoint.index].value
+                script_pubkeys.append(parent.tx.tx_outs[tx_in.outpoint.index].script_pubkey)
+                parents.add(parent.tx_hash)
+            else:
+                coin = self.utxo.get(tx_in.outpoint.tx_hash, tx_in.outpoint.index)
+                if coin is None:
+                    raise Exception("Tx spends a missing output")
+                value_in += coin.value
+                script_pubkeys.append(coin.script_pubkey)
+        fee = value_in - sum(tx_out.value for tx_out in tx.tx_outs)
+        if fee < 0:
+            raise Exception("Tx spends more than its inputs")
+        if self.verify_scripts:
+            hasher = SignatureHasher(tx)
+            for index, script_pubkey in enumerate(script_pubkeys):
+                verify_input(tx, index, script_pubkey, CachingSignatureChecker(tx, index, hasher=hasher))
+
+        ancestors = self._ancestors(parents)
+        if len(ancestors) + 1 > max_ancestors:
+            raise Exception("Tx has too many unconfirmed ancestors")
+
+        entry = MempoolEntry(tx, tx_hash, fee, tx.serialized_size(), parents)
+        self._insert(entry, ancestors, keys)
+        evicted = self._trim()
+        if tx_hash not in self._entries:
+            # このTxを入れるために追い出したTxを戻してから断る。追い出しは子が先なので、逆順に戻せば親が先になる
+            for evicted_entry in reversed(evicted):
+                if evicted_entry is not entry:
+                    self._restore(evicted_entry)
+            raise Exception("Mempool is full")
+        self.maybe_persist()
+        return entry
+
+    def _insert(self, entry: MempoolEntry, ancestors: Set[bytes], keys: List[bytes]) -> None:
+        tx_hash = entry.tx_hash
+        fee = entry.fee
+        for ancestor_hash in ancestors:
+            ancestor = self._entries[ancestor_hash]
+            entry.ancestor_count += 1
+            entry.ancestor_size += ancestor.size
+            entry.ancestor_fee += ancestor.fee
+            ancestor.descendant_count += 1
+            ancestor.descendant_size += entry.size
+            ancestor.descendant_fee += fee
+            self._push_eviction(ancestor)
+        for parent_hash in entry.parents:
+            self._entries[parent_hash].children.add(tx_hash)
+        for key in keys:
+            self._spent_by[key] = tx_hash
+        self._entries[tx_hash] = entry
+        self.total_size += entry.size
+        self._push_eviction(entry)
+
+    def _restore(self, evicted: MempoolEntry) -> None:
+        """
+        追い出したTxを、検証しなおさずに元の手数料、時刻のまま戻す
+        """
+        tx = evicted.tx
+        parents = {tx_in.outpoint.tx_hash for tx_in in tx.tx_ins if tx_in.outpoint.tx_hash in self._entries}
+        entry = MempoolEntry(tx, evicted.tx_hash, evicted.fee, evicted.size, parents)
+        entry.time = evicted.time
+        self._insert(entry, self._ancestors(parents), [tx_in.outpoint.as_bin() for tx_in in tx.tx_ins])
+
+    def _ancestors(self, parents: Set[bytes]) -> Set[bytes]:
+        result = set()
+        stack = list(parents)
+        while stack:
+            tx_hash = stack.pop()
+            if tx_hash not in result:
+                result.add(tx_hash)
+                stack.extend(self._entries[tx_hash].parents)
+        return result
+
+    def _descendants(self, tx_hash: bytes) -> Set[bytes]:
+        """自分を含まない子孫"""
+        result = set()
+        stack = list(self._entries[tx_hash].children)
+        while stack:
+            child_hash = stack.pop()
+            if child_hash not in result:
+                result.add(child_hash)
+                stack.extend(self._entries[child_hash].children)
+        return result
+
+    def _push_eviction(self, entry: MempoolEntry) -> None:
+        entry.version += 1
+        self._sequence += 1
+        heapq.heappush(self._eviction_heap, (entry.descendant_fee_rate, self._sequence, entry.tx_hash, entry.version))
+        # 古い要素が溜まりすぎたら作り直す
+        if len(self._eviction_heap) > 4 * len(self._entries) + 64:
+            self._eviction_heap = [
+                (e.descendant_fee_rate, i, e.tx_hash, e.version) for i, e in enumerate(self._entries.values())
+            ]
+            heapq.heapify(self._eviction_heap)
+
+    def _trim(self) -> List[MempoolEntry]:
+        """
+        大きさの合計がmax_size以下になるまで追い出し、追い出したエントリを追い出した順(子が先)に返す
+        """
+        evicted: List[MempoolEntry] = []
+        while self.total_size > self.max_size and self._eviction_heap:
+            _, _, tx_hash, version = heapq.heappop(self._eviction_heap)
+            entry = self._entries.get(tx_hash)
+            if entry is None or entry.version != version:
+                continue
+            evicted.extend(self._remove(tx_hash, True))
+        return evicted
+
+    def remove(self, tx_hash: bytes, with_descendants: bool = True) -> List[Tx]:
+        """
+        Txを(with_descendantsなら子孫ごと)取り除き、取り除いたTxを親が先になる順に返す
+        """
+        return [entry.tx for entry in reversed(self._remove(tx_hash, with_descendants))]
+
+    def _remove(self, tx_hash: bytes, with_descendants: bool) -> List[MempoolEntry]:
+        """
+        取り除いたエントリを取り除いた順(子が先)に返す
+        """
+        if tx_hash not in self._entries:
+            return []
+        targets = {tx_hash}
+        if with_descendants:
+            targets |= self._descendants(tx_hash)
+        # 子から先に取り除けば、取り除くTxの子孫の合計を更新しなくて済む
+        ordered = sorted((self._entries[h] for h in targets), key=lambda e: e.ancestor_count, reverse=True)
+        for entry in ordered:
+            self._remove_entry(entry)
+        return ordered
+
+    def _remove_entry(self, entry: MempoolEntry) -> None:
+        for ancestor_hash in self._ancestors(entry.parents):
+            ancestor = self._entries[ancestor_hash]
+            ancestor.descendant_count -= 1
+            ancestor.descendant_size -= entry.size
+            ancestor.descendant_fee -= entry.fee
+            self._push_eviction(ancestor)
+        if entry.children:
+            for descendant_hash in self._descendants(entry.tx_hash):
+                descendant = self._entries[descendant_hash]
+                descendant.ancestor_count -= 1
+                descendant.ancestor_size -= entry.size
+                descendant.ancestor_fee -= entry.fee
+        for parent_hash in entry.parents:
+            self._entries[parent_hash].children.discard(entry.tx_hash)
+        for child_hash in entry.children:
+            self._entries[child_hash].parents.discard(entry.tx_hash)
+        for tx_in in entry.tx.tx_ins:
+            del self._spent_by[tx_in.outpoint.as_bin()]
+        del self._entries[entry.tx_hash]
+        self.total_size -= entry.size
+
+    def remove_for_block(self, block: Block) -> None:
+        """
+        ブロックに含まれたTxを取り除き(子はプールに残る)、ブロックのTxと同じ出力を使うTxを子孫ごと取り除く
+        """
+        for tx in block.transactions:
+            tx_hash = tx.tx_hash()
+            entry = self._entries.get(tx_hash)
+            if entry is not None:
+                self._remove_entry(entry)
+            for tx_in in tx.tx_ins:
+                conflict = self._spent_by.get(tx_in.outpoint.as_bin())
+                if conflict is not None:
+                    self.remove(conflict)
+        self.maybe_persist()
+
+    def readd_block(self, block: Block) -> None:
+        """
+        切断されたブロックのTxをプールに戻す。UtxoSetからブロックを切断した後に呼ぶこと。
+        ブロックのTxの出力を使っていたプール内のTxは、いったん取り除いてから戻したTxの後に加えなおす
+        """
+        removed = []
+        for tx in block.transactions:
+            tx_hash = tx.tx_hash()
+            for index in range(len(tx.tx_outs)):
+                spender = self.spender(tx_hash, index)
+                if spender is not None:
+                    removed.extend(self.remove(spender))
+        for tx in block.transactions[1:] + removed:
+            try:
+                self.add(tx)
+            except Exception:
+                pass  # 新しいチェーンでは有効でなくなったTx
+
+    def block_template(self, max_bytes: int) -> Tuple[List[Tx], int]:
+        """
+        大きさの合計がmax_bytes以下になるようにTxを選び、(親が先になる順のTx, 手数料の合計)を返す。
+        祖先を含めた手数料率が最も高いTxを祖先ごと選び、選んだTxの子孫はまだ選んでいない祖先だけで手数料率を計算しなおす
+        """
+        selected: Set[bytes] = set()
+        result: List[Tx] = []
+        size = 0
+        fees = 0
+        # まだ選んでいない祖先だけで計算した(手数料、大きさ)。一度も更新されていないTxは載らない
+        modified: Dict[bytes, Tuple[int, int]] = {}
+        heap = [(-e.ancestor_fee_rate, e.ancestor_count, h, e.ancestor_fee, e.ancestor_size) for h, e in self._entries.items()]
+        heapq.heapify(heap)
+        min_size = min((e.size for e in self._entries.values()), default=0)
+
+        while heap and max_bytes - size >= min_size:
+            _, _, tx_hash, fee, package_size = heapq.heappop(heap)
+            if tx_hash in selected:
+                continue
+            entry = self._entries[tx_hash]
+            if modified.get(tx_hash, (entry.ancestor_fee, entry.ancestor_size)) != (fee, package_size):
+                continue  # 古い要素
+            if size + package_size > max_bytes:
+                continue
+
+            package = [
+                self._entries[h] for h in self._ancestors(entry.parents) | {tx_hash} if h not in selected
+            ]
+            package.sort(key=lambda e: e.ancestor_count)
+            for member in package:
+                selected.add(member.tx_hash)
+                result.append(member.tx)
+                size += member.size
+                fees += member.fee
+            for member in package:
+                for descendant_hash in self._descendants(member.tx_hash):
+                    if descendant_hash in selected:
+                        continue
+                    descendant = self._entries[descendant_hash]
+                    d_fee, d_size = modified.get(descendant_hash, (descendant.ancestor_fee, descendant.ancestor_size))
+                    d_fee, d_size = d_fee - member.fee, d_size - member.size
+                    modified[descendant_hash] = (d_fee, d_size)
+                    heapq.heappush(heap, (-d_fee / d_size, descendant.ancestor_count, descendant_hash, d_fee, d_size))
+        return result, fees
+
+    def maybe_persist(self) -> None:
+        if self.path is not None and monotonic() - self._last_persist >= self.persist_interval:
+            self.persist()
+
+    def persist(self) -> None:
+        """
+        プール内のTxを、Txの数(可変長整数)とTx.as_binを親が先になる順に並べた形式で書き出す。
+        一時ファイルに書いてfsyncしてから置き換えるので、途中でクラッシュしても前回のファイルが残る
+        """
+        self._last_persist = monotonic()
+        if self.path is None:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(int_to_bytes(len(self._entries)))
+            for tx in self.txs():
+                f.write(tx.as_bin())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def load(self) -> int:
+        """
+        persistで書き出したTxを読み込み、現在のUTXOセットで有効なものだけをプールに加える。加えた数を返す。
+        ファイルが壊れていれば、ログに残して何も加えない(空のプールから始める)
+        """
+        if self.path is None or not os.path.exists(self.path):
+            return 0
+        with open(self.path, "rb") as f:
+            view = memoryview(f.read())
+        txs = []
+        try:
+            count, offset = bytes_to_int(view, 0)
+            for _ in range(count):
+                tx, offset = Tx.read_from(view, offset)
+                txs.append(tx)
+            if offset != len(view):
+                raise Exception("Mempool file has trailing bytes")
+        except Exception as e:
+            logger.warning("Ignoring corrupted mempool file %s: %s", self.path, e)
+            self._last_persist = monotonic()
+            return 0
+        added = 0
+        for tx in txs:
+            try:
+                self.add(tx)
+                added += 1
+            except Exception:
+                pass
+        self._last_persist = monotonic()
+        return added
@@ -0,0 +1,117 @@
+"""
+merkle rootの計算と、SPVクライアント向けの包含証明(merkle branch)。
+
+merkle_rootは再帰もレベルごとのリストの作り直しもせず、1つのバッファの前半に親ノードを上書きしながら計算する。
+MerkleTreeは全レベルを保持しておき、葉を1つ(extranonceを変えたcoinbaseなど)書き換えたときに、
+根までの経路上のlog(n)個のノードだけを計算しなおす。
+要素数が奇数のレベルでは、Bitcoinと同じく最後の要素を複製して対にする。
+"""
+from typing import List, Sequence
+
+import hashlib
+
+
+_sha256 = hashlib.sha256
+
+
+def _hash_pair(data) -> bytes:
+    return _sha256(_sha256(data).digest()).digest()
+
+
+def merkle_root(tx_hashes: Sequence[bytes]) -> bytes:
+    count = len(tx_hashes)
+    if count == 0:
+        raise Exception("Merkle tree needs at least one hash")
+    # 末尾の32bytesは、要素数が奇数のときに最後の要素を複製するための領域
+    buf = bytearray(b"".join(tx_hashes) + bytes(32))
+    view = memoryview(buf)
+    while count > 1:
+        if count % 2 == 1:
+            view[count * 32:count * 32 + 32] = view[(count - 1) * 32:count * 32]
+            count += 1
+        for i in range(count // 2):
+            # 親ノードは子ノードより前にあるので、まだ読んでいない部分を上書きすることはない
+            view[i * 32:i * 32 + 32] = _hash_pair(view[i * 64:i * 64 + 64])
+        count //= 2
+    return bytes(view[:32])
+
+
+def merkle_branch(tx_hashes: Sequence[bytes], index: int) -> List[bytes]:
+    """
+    index番目の葉から根までの経路上にある兄弟ノード(葉に近い順)。merkle_root_from_branchと合わせて包含証明になる
+    """
+    return MerkleTree(tx_hashes).branch(index)
+
+
+def merkle_root_from_branch(tx_hash: bytes, branch: Sequence[bytes], index: int = 0) -> bytes:
+    """
+    index番目の葉とその兄弟ノードから根を計算する。indexの各ビットが、そのレベルで自分が右側かどうかを表す
+    """
+    for sibling in branch:
+        if index & 1:
+            tx_hash = _hash_pair(sibling + tx_hash)
+        else:
+            tx_hash = _hash_pair(tx_hash + sibling)
+        index >>= 1
+    return tx_hash
+
+
+def verify_merkle_proof(tx_hash: bytes, branch: Sequence[bytes], index: int, root: bytes) -> bool:
+    if index >> len(branch):
+        return False  # 経路の長さに対してindexが大きすぎる
+    return merkle_root_from_branch(tx_hash, branch, index) == root
+
+
+class MerkleTree:
+    def __init__(self, tx_hashes: Sequence[bytes]):
+        if len(tx_hashes) == 0:
+            raise Exception("Merkle tree needs at least one hash")
+        self.counts = [len(tx_hashes)]
+        self.levels = [bytearray(b"".join(tx_hashes))]
+        while self.counts[-1] > 1:
+            level = memoryview(self.levels[-1])
+            count = self.counts[-1]
+            parent = bytearray(((count + 1) // 2) * 32)
+            for i in range(count // 2):
+                parent[i * 32:i * 32 + 32] = _hash_pair(level[i * 64:i * 64 + 64])
+            if count % 2 == 1:
+                last = level[(count - 1) * 32:count * 32]
+                parent[-32:] = _hash_pair(bytes(last) * 2)
+            self.levels.append(parent)
+            self.counts.append((count + 1) // 2)
+
+    @property
+    def root(self) -> bytes:
+        return bytes(self.levels[-1])
+
+    def __len__(self) -> int:
+        return self.counts[0]
+
+    def branch(self, index: int) -> List[bytes]:
+        if not 0 <= index < self.counts[0]:
+            raise IndexError(index)
+        branch = []
+        for level, count in zip(self.levels[:-1], self.counts[:-1]):
+            sibling = index ^ 1
+            if sibling >= count:
+                sibling = index
+            branch.append(bytes(level[sibling * 32:sibling * 32 + 32]))
+            index >>= 1
+        return branch
+
+    def update(self, index: int, tx_hash: bytes) -> bytes:
+        """
+        index番目の葉を書き換え、経路上のノードだけを計算しなおして新しい根を返す
+        """
+        if not 0 <= index < self.counts[0]:
+            raise IndexError(index)
+        self.levels[0][index * 32:index * 32 + 32] = tx_hash
+        for depth in range(len(self.levels) - 1):
+            level, count = self.levels[depth], self.counts[depth]
+            left = index & ~1
+            right = left + 1 if left + 1 < count else left
+            index >>= 1
+            self.levels[depth + 1][index * 32:index * 32 + 32] = _hash_pair(
+                bytes(level[left * 32:left * 32 + 32]) + bytes(level[right * 32:right * 32 + 32])
+            )
+        return self.root
@@ -1,13 +1,32 @@
-from .block import Block, get_target, load_blocks
+from .block import Block
+from .chainstate import ChainState, get_chain_state
 from .tx import Tx, TxIn, OutPoint, TxOut
 from .script import script_int_to_bytes, script_int_to_bytes_contain_opcode
-from .util import bits_to_target
+from .merkle import merkle_root, merkle_branch, merkle_root_from_branch
+from .util import bits_to_target, HeaderHasher
+from .config import block_reward, max_future_block_time, max_block_size
 from .address import address_to_script
+from . import batch_hash
 
-from time import time as now_time
+from dataclasses import dataclass
+from time import time as now_time, perf_counter
+from typing import Callable, Iterator, List, Optional, Tuple
 
 import binascii
+import multiprocessing
 import random
+import threading
+
+
+# 1タスクあたりに探索するnonceの数。小さすぎるとプロセス間通信の割合が増え、大きすぎると停止までの遅延が増える
+nonce_chunk_size = 1 << 20
+# ワーカーが停止フラグを確認する間隔(nonce数)
+stop_check_interval = 1 << 14
+# progressコールバックを呼び出す間隔(秒)
+progress_interval = 1.0
+nonce_max = 0xffffffff
+# coinbaseのscript_sigに埋め込むextranonceの大きさ(bytes)
+extranonce_size = 4
 
 
 def create_genesis_block(msg: str, time: int, bits: int, reward: int) -> Block:
@@ -48,7 +67,7 @@ def create_genesis_block(msg: str, time: int, bits: int, reward: int) -> Block:
     block = Block(
         version=1,  # versionの説明は上記ですでにされているため省略
         hash_prev_block=bytes([0]) * 32,  # 本来はNULLが代入されているが、簡易的な処理しか実装していないので32bytes分の0を代入
-        hash_merkle_root=genesis_tx.tx_hash(),  # 本来merkle root生成機構を通すべきだが、ジェネシスブロック上では無意味なので省略
+        hash_merkle_root=merkle_root([genesis_tx.tx_hash()]),  # Txが1つだけなので、そのハッシュがそのままmerkle rootになる
         time=time,
         bits=bits,
         nonce=0,
@@ -59,7 +78,7 @@ def create_genesis_block(msg: str, time: int, bits: int, reward: int) -> Block:
     return mining_block(block)
 
 
-def create_coinbase_tx(script_sig: bytes, script_pubkey: bytes, reward: int = 50 * 10 ** 9) -> Tx:
+def create_coinbase_tx(script_sig: bytes, script_pubkey: bytes, reward: int = block_reward) -> Tx:
     outpoint = OutPoint(
         tx_hash=bytes([0]) * 32,
         index=0xffffffff  # この数値はuint32における最大値。通常の送金等では使われることはまずないだろうということで使われていると推測
@@ -83,48 +102,325 @@ def create_coinbase_tx(script_sig: bytes, script_pubkey: bytes, reward: int = 50
     return coinbase_tx
 
 
-def create_block(height: int, receive_address: str) -> Block:
+def create_block_template(
+        height: Optional[int],
+        receive_address: str,
+        hash_prev_block: bytes = None,
+        bits: int = None,
+        chain_state: ChainState = None,
+        mempool=None
+) -> Block:
+    """
+    マイニング前(nonceが0)のブロックを生成する。
+    coinbaseのscript_sigの末尾にはextranonceを入れる領域を確保しておき、nonceを探索しきった場合にはここを書き換えて別のヘッダを作る。
+    height、hash_prev_block、bitsを省略した場合は、chain_state(省略時はプロセス内で共有するChainState)の先頭から求める。
+    mempoolを渡した場合は、ブロックがmax_block_sizeに収まる範囲で手数料率の高いTxを入れ、その手数料をマイニング報酬に加える。
+    """
+    if height is None or hash_prev_block is None or bits is None:
+        if chain_state is None:
+            chain_state = get_chain_state()
+        if height is None:
+            height = chain_state.height + 1
+        if hash_prev_block is None:
+            hash_prev_block = chain_state.hash_prev_block
+        if bits is None:
+            bits = chain_state.next_bits()
     coinbase_tx = create_coinbase_tx(
-        script_sig=script_int_to_bytes_contain_opcode(height)+b"\x00",  # height + OP_0
+        script_sig=(
+            script_int_to_bytes_contain_opcode(height) +  # height
+            script_int_to_bytes(extranonce_size) + bytes(extranonce_size)  # extranonce(初期値は0)
+        ),
         script_pubkey=address_to_script(receive_address)
     )
+    txs = []
+    if mempool is not None:
+        # ヘッダ、Txの数(最大9bytes)、coinbase(報酬が増えても大きさは変わらない)の分を除いた残りにTxを詰める
+        txs, fees = mempool.block_template(max_block_size - 80 - 9 - coinbase_tx.serialized_size())
+        coinbase_tx.tx_outs[0].value += fees
 
     # 一旦ブロックを作る(nonceは0を設定)
     block = Block(
         version=1,  # versionの説明は上記ですでにされているため省略
-        hash_prev_block=bytes([0]) * 32,  # 本来はNULLが代入されているが、簡易的な処理しか実装していないので32bytes分の0を代入
-        hash_merkle_root=coinbase_tx.tx_hash(),  # 本来merkle root生成機構を通すべきだが、ジェネシスブロック上では無意味なので省略
+        hash_prev_block=hash_prev_block,
+        hash_merkle_root=merkle_root([tx.tx_hash() for tx in [coinbase_tx] + txs]),
         time=int(now_time()),
-        bits=get_target(load_blocks()),
+        bits=bits,
         nonce=0,
-        transactions=[coinbase_tx]
+        transactions=[coinbase_tx] + txs
     )
+    return block
+
+
+def create_block(
+        height: Optional[int],
+        receive_address: str,
+        workers: int = 1,
+        chain_state: ChainState = None,
+        mempool=None
+) -> Block:
+    """
+    chain_state(省略時はプロセス内で共有するChainState)の先頭の上にブロックを作ってマイニングし、見つかったブロックを先頭に追加する。
+    チェーン全体を読み込まないので、ブロックの生成にかかる時間はチェーンの長さによらない。
+    mempoolを渡した場合は、そこからTxを選んでブロックに入れる
+    """
+    if chain_state is None:
+        chain_state = get_chain_state()
+    block = create_block_template(height, receive_address, chain_state=chain_state, mempool=mempool)
 
     # マイニングに移行
-    return mining_block(block)
+    block = mining_block(block, workers=workers, extranonce_size=extranonce_size)
+    chain_state.connect(block)
+    return block
+
+
+def set_extranonce(block: Block, extranonce: int, size: int = extranonce_size, branch: List[bytes] = None) -> None:
+    """
+    coinbaseのscript_sigの末尾size bytesをextranonceで書き換え、merkle rootを計算しなおす。
+    coinbaseの兄弟ノード(merkle_branch(..., 0))を渡せば、Txの数がnのときlog(n)回のハッシュ計算で済む
+    """
+    coinbase_tx = block.transactions[0]
+    script_sig = coinbase_tx.tx_ins[0].script_sig
+    coinbase_tx.tx_ins[0].script_sig = script_sig[:-size] + extranonce.to_bytes(size, "little")
+    if branch is None:
+        block.hash_merkle_root = merkle_root([tx.tx_hash() for tx in block.transactions])
+    else:
+        block.hash_merkle_root = merkle_root_from_branch(coinbase_tx.tx_hash(), branch)
+
+
+def iter_work(block: Block, extranonce_size: int = 0) -> Iterator[bytes]:
+    """
+    nonce空間を探索しきるたびに、まだ探索していないヘッダ(nonceを除いた76bytes)を生成する。
+    extranonce_sizeが指定されていればextranonceを1ずつ増やし、あわせてtimeを現在時刻まで進める。
+    extranonceを使い切った(あるいは使えない)場合は、未来すぎない範囲でtimeを1秒ずつ進める。
+    extranonceかtimeのどちらかが必ず前回までより大きくなるので、同じヘッダを二度探索することはない。
+    blockはその場で書き換えられ、yieldされたヘッダと常に一致する。
+    """
+    extranonce = 0
+    extranonce_max = (1 << (8 * extranonce_size)) - 1
+    # coinbase以外のTxは変わらないので、coinbaseの兄弟ノードは一度だけ求めればよい
+    branch = merkle_branch([tx.tx_hash() for tx in block.transactions], 0) if extranonce_size else None
+    yield block.header_prefix()
+    while True:
+        time_now = int(now_time())
+        if extranonce < extranonce_max:
+            extranonce += 1
+            set_extranonce(block, extranonce, extranonce_size, branch)
+            block.time = max(block.time, time_now)
+        elif block.time < time_now + max_future_block_time:
+            block.time += 1
+        else:
+            raise Exception("Work space is exhausted")
+        yield block.header_prefix()
+
+
+def _nonce_ranges(chunk_size: int = None) -> Iterator[Tuple[int, int]]:
+    """
+    nonce空間全体をchunk_size(既定値はnonce_chunk_size)ごとに区切って返す。0から探すのではなく、ランダムな区間から始めて一周する
+    """
+    if chunk_size is None:
+        chunk_size = nonce_chunk_size
+    chunk_count = (nonce_max + 1) // chunk_size
+    first = random.randrange(chunk_count)
+    for i in range(chunk_count):
+        start = ((first + i) % chunk_count) * chunk_size
+        yield start, start + chunk_size
+
+
+@dataclass
+class MiningStats:
+    """
+    マイニングの進捗。progressコールバックに渡される
+    """
+    nonces_tried: int
+    elapsed: float
+    target: int
+
+    @property
+    def hashrate(self) -> float:
+        """1秒あたりのハッシュ計算回数"""
+        if self.elapsed <= 0:
+            return 0.0
+        return self.nonces_tried / self.elapsed
+
+    @property
+    def expected_block_time(self) -> Optional[float]:
+        """
+        現在のハッシュレートでブロックを1つ見つけるまでにかかる時間の期待値(秒)。
+        ハッシュが一様に分布するとすれば、1回の試行で成功する確率は(target / 2^256)になる
+        """
+        if self.hashrate == 0:
+            return None
+        return ((1 << 256) / self.target) / self.hashrate
+
 
+class CancelToken:
+    """
+    マイニングを外部(別スレッド)から中断するためのトークン。新しいブロックを受け取ったときなどに cancel() を呼ぶ
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self) -> None:
+        self._event.set()
+
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+
+class MiningCancelled(Exception):
+    pass
+
+
+class _Monitor:
+    def __init__(self, target: int, progress: Optional[Callable[[MiningStats], None]], cancel: Optional[CancelToken]):
+        self.target = target
+        self.progress = progress
+        self.cancel = cancel
+        self.nonces_tried = 0
+        self.started = perf_counter()
+        self.last_report = self.started
+
+    def stats(self) -> MiningStats:
+        return MiningStats(
+            nonces_tried=self.nonces_tried,
+            elapsed=perf_counter() - self.started,
+            target=self.target
+        )
+
+    def add(self, nonces_tried: int) -> None:
+        self.nonces_tried += nonces_tried
+        if self.progress is not None and perf_counter() - self.last_report >= progress_interval:
+            self.last_report = perf_counter()
+            self.progress(self.stats())
+
+    def check_cancelled(self) -> None:
+        if self.cancel is not None and self.cancel.cancelled():
+            raise MiningCancelled()
+
+    def finish(self) -> None:
+        if self.progress is not None:
+            self.progress(self.stats())
+
+
+def mining_block(
+        block: Block,
+        workers: int = 1,
+        use_numpy: bool = False,
+        extranonce_size: int = 0,
+        progress: Callable[[MiningStats], None] = None,
+        cancel: CancelToken = None
+) -> Block:
+    """
+    workersに2以上を指定すると、nonce空間を分割して複数プロセスで並列に探索する。
+    Noneを指定した場合はCPUのコア数だけプロセスを立ち上げる。
+    use_numpyをTrueにすると、NumPyで多数のnonceをまとめてハッシュする(NumPyがインストールされている必要がある)。
+    extranonce_sizeにはcoinbaseのscript_sig末尾に確保したextranonceの大きさを指定する(0ならtimeのみを進める)。
+    progressを指定すると、progress_interval秒ごとと見つかったときにMiningStatsを引数に呼び出される。
+    cancelのcancel()が呼ばれるとMiningCancelledを送出して探索を中断する。
+    """
+    if use_numpy and not batch_hash.available():
+        raise Exception("use_numpy requires numpy")
+    if workers is None:
+        workers = multiprocessing.cpu_count()
 
-def mining_block(block: Block) -> Block:
     # bitsは32bytesのバイト列に変換され、さらにintのtargetに変換されて使用される。使用方法は後程
     target = bits_to_target(block.bits)
+    work = iter_work(block, extranonce_size)
+    monitor = _Monitor(target, progress, cancel)
 
-    nonce_found = False
-    # 0から探すのではなく、ランダム性をもたせる
-    start = random.randint(0, 0xffffffff)
+    if workers > 1:
+        return _mining_block_parallel(block, work, target, workers, use_numpy, monitor)
 
-    for i in range(start, 0xffffffff):
+    for header_prefix in work:
         # マイニングとは、生成するブロックのハッシュがあらかじめ設定されたtargetよりも小さくなるようなnonceを探すことである。
         # というわけで、全探索的にnonceを探す。
-        block.nonce = i  # nonceを設定
-        block_hash = int.from_bytes(block.block_hash(), "big")  # ブロックのハッシュをintに直す
-        # targetとblock_hashを比較し、targetがblock_hash以下であれば、マイニング成功(=ブロック生成成功)
-        if target > block_hash:
-            print("nonce found!", f"nonce = {block.nonce}", f"block hash = 0x%064x" % block_hash)
-            nonce_found = True
-            break
-
-    # 万が一探索しきっても見つからなければ、再探索する
-    if not nonce_found:
-        return mining_block(block)
+        # 進捗の報告や中断の確認ができるよう、ワーカーよりも細かく区切って探索する
+        for start, end in _nonce_ranges(stop_check_interval):
+            monitor.check_cancelled()
+            nonce, nonces_tried = _search_nonce((header_prefix, target, start, end, use_numpy))
+            monitor.add(nonces_tried)
+            if nonce is not None:
+                monitor.finish()
+                return _nonce_found(block, nonce)
+
+
+def _nonce_found(block: Block, nonce: int) -> Block:
+    block.nonce = nonce  # nonceを設定
+    block_hash = int.from_bytes(block.block_hash(), "big")  # ブロックのハッシュをintに直す
+    print("nonce found!", f"nonce = {block.nonce}", f"block hash = 0x%064x" % block_hash)
     return block
 
+
+_stop_event = None
+
+
+def _init_worker(stop_event) -> None:
+    global _stop_event
+    _stop_event = stop_event
+
+
+def _search_nonce(task: Tuple[bytes, int, int, int, bool]) -> Tuple[Optional[int], int]:
+    """
+    ヘッダのうちnonceを除いた76bytesを受け取り、[start, end)の範囲でnonceを探す。
+    見つかったnonce(見つからなければNone)と、計算したハッシュの数を返す。
+    ワーカープロセスで実行される場合、他のワーカーが先に見つけたら途中で打ち切る。
+    """
+    header_prefix, target, start, end, use_numpy = task
+    if use_numpy:
+        for batch_start in range(start, end, batch_hash.default_batch_size):
+            if _stop_event is not None and _stop_event.is_set():
+                return None, batch_start - start
+            count = min(batch_hash.default_batch_size, end - batch_start)
+            found = batch_hash.search_nonces(header_prefix, target, batch_start, count)
+            if found:
+                return found[0], batch_start + count - start
+        return None, end - start
+
+    # ハッシュはbig endianのintとして比較するので、同じ長さのbig endianのバイト列同士の比較で代用できる
+    target = target.to_bytes(32, "big")
+    # nonce以外のヘッダは探索中に変化しないので、midstateを計算しておく
+    hasher = HeaderHasher(header_prefix)
+    for i in range(start, end):
+        if i % stop_check_interval == 0 and _stop_event is not None and _stop_event.is_set():
+            return None, i - start
+        # targetとblock_hashを比較し、targetがblock_hash以下であれば、マイニング成功(=ブロック生成成功)
+        if target > hasher.hash(i):
+            return i, i - start + 1
+    return None, end - start
+
+
+def _mining_block_parallel(
+        block: Block,
+        work: Iterator[bytes],
+        target: int,
+        workers: int,
+        use_numpy: bool,
+        monitor: _Monitor
+) -> Block:
+    stop_event = multiprocessing.Event()
+
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(stop_event,)) as pool:
+        for header_prefix in work:
+            tasks = [(header_prefix, target, start, end, use_numpy) for start, end in _nonce_ranges()]
+            results = pool.imap_unordered(_search_nonce, tasks)
+            while True:
+                try:
+                    # 中断の確認や進捗の報告が遅れないよう、結果を待つ時間に上限を設ける
+                    nonce, nonces_tried = results.next(timeout=progress_interval)
+                except multiprocessing.TimeoutError:
+                    nonce, nonces_tried = None, 0
+                except StopIteration:
+                    break
+                # 結果が間隔より早く次々に返ってくる場合もあるので、中断は結果を受け取るたびに確かめる
+                if monitor.cancel is not None and monitor.cancel.cancelled():
+                    stop_event.set()
+                    pool.terminate()
+                    monitor.check_cancelled()
+                monitor.add(nonces_tried)
+                if nonce is not None:
+                    # 他のワーカーを止めてから結果を返す
+                    stop_event.set()
+                    pool.terminate()
+                    monitor.finish()
+                    return _nonce_found(block, nonce)
@@ -0,0 +1,243 @@
+"""
+BlockStore、UtxoSet、ChainState(とあればAddressIndex)をまとめて、ブロックの接続、切断、チェーンの組み替え(reorg)を行う。
+
+ブロックを接続するたびに、そのブロックで使われた出力(取り消し用データ)をブロックと同じ場所(revファイル)に保存しておく。
+ブロックの入力のスクリプトは、署名のキャッシュにないものをプロセスプールで並列に検証する(sigcache)。
+ブロックは保存や接続の前に、ブロック単体の検査(PoW、merkle rootなど)と、前のブロックに対する検査(bits、時刻)を行う。
+分岐したチェーンのブロックは、前のブロックを先頭とする状態を難易度調整の窓の分だけたどって作り、それに対して検査する。
+より仕事量の多い分岐が現れたら、ブロックのインデックスから前のブロックをたどって分岐点を見つけ、
+分岐点まで取り消し用データで切断してから新しい分岐のブロックを接続する。
+かかる時間は組み替えるブロックの数に比例し、チェーン全体の長さにはよらない。
+
+UtxoSetはストアより先にディスクに書き込まないよう、必要になったときにストアをflushしてからflushする。
+そのため正しく終了しなかった場合でも、UtxoSetのbest_blockは保存済みのブロックを指している。
+開くときにbest_blockがストアの有効なチェーンの先頭と違えば、取り消し用データで分岐点まで戻してから先頭までのブロックを反映し直す。
+"""
+from .address_index import AddressIndex
+from .block import Block
+from .chainstate import ChainState, block_work
+from .mempool import Mempool
+from .sigcache import create_pool, verify_block_scripts
+from .storage import BlockStore
+from .utxo import UtxoSet, serialize_undo, deserialize_undo
+from .validation import check_block, check_block_context, check_coinbase_value
+
+from typing import List, Optional, Tuple
+
+
+class Node:
+    def __init__(
+            self,
+            store: BlockStore,
+            utxo: UtxoSet,
+            address_index: Optional[AddressIndex] = None,
+            mempool: Optional[Mempool] = None,
+            script_workers: Optional[int] = None,
+            chain_state: Optional[ChainState] = None
+    ):
+        """
+        UtxoSetとAddressIndexは、storeの有効なチェーンの先頭まで反映されている必要がある。
+        UtxoSetとAddressIndexがstoreの先頭まで反映されていなければ(正しく終了しなかった場合)、先頭まで反映し直す。
+        mempoolを渡した場合は、ブロックの接続、切断にあわせてTxを取り除いたり戻したりする。
+        script_workersはスクリプトを検証するプロセスの数(省略時はCPUの数)。プールは最初に必要になったときに作る。
+        chain_stateはstoreの先頭の状態。省略した場合はstoreのチェーン全体のヘッダから作る
+        """
+        self.store = store
+        self.utxo = utxo
+        self.address_index = address_index
+        self.mempool = mempool
+        self._recover()
+        self.chain_state = ChainState.from_store(store) if chain_state is None else chain_state
+        if self.chain_state.tip_hash != store.tip_hash:
+            raise Exception("Chain state is not at the tip of the store")
+        self.script_workers = script_workers
+        self._script_pool = None
+        self._script_pool_created = False
+
+    def _recover(self) -> None:
+        """
+        UtxoSetのbest_blockから有効なチェーンの先頭までのブロックを反映し直す。
+        best_blockが有効なチェーンにない(組み替えの途中で終了した)場合は、まず分岐点まで切断する
+        """
+        empty = bytes([0]) * 32  # 何も接続していない状態(ジェネシスブロックまで切断した場合もこの値になる)
+        best = self.utxo.best_block
+        if (best or empty) != (self.store.tip_hash or empty):
+            while best is not None and best != empty:
+                location = self.store.location(best)
+                if location is None:
+                    raise Exception("UTXO set is at a block that is not in the store")
+                if self.store.hash_at(location.height) == best:
+                    break
+                block = self.store.get_block(best)
+                self.utxo.disconnect_block(block, deserialize_undo(self.store.read_undo(best)), flush=False)
+                best = block.hash_prev_block
+            start = self.store.location(best).height + 1 if best is not None and best != empty else 0
+            for height in range(start, self.store.tip_height + 1):
+                block_hash = self.store.hash_at(height)
+                if not self.store.has_body(block_hash):
+                    raise Exception(f"Block at height {height} has only a header and cannot be replayed")
+                block = self.store.get_block(block_hash)
+                # スクリプトは接続したときに検証済み
+                spent = self.utxo.connect_block(block, height, flush=False)
+                self.store.write_undo(block_hash, serialize_undo(spent))
+                if self.address_index is not None:
+                    self.address_index.disconnect_block(height)
+                    self.address_index.connect_block(block, height, spent)
+            self.store.flush()
+            self.utxo.flush()
+        if self.address_index is not None:
+            self.address_index.rewind(self.store.tip_height)
+
+    def _maybe_flush(self) -> None:
+        if self.utxo.needs_flush():
+            self.store.flush()
+            self.utxo.flush()
+
+    @property
+    def height(self) -> int:
+        return self.chain_state.height
+
+    def connect_block(self, block: Block) -> None:
+        """
+        有効なチェーンの先頭にブロックを接続する。check_block、先頭に対するcheck_block_contextに通らない、
+        使われた出力が存在しない、coinbaseが報酬と手数料より多い、スクリプトが不正などの場合は例外を送出し、何も変更しない
+        """
+        if block.hash_prev_block != self.chain_state.hash_prev_block:
+            raise Exception("Block does not connect to the tip")
+        check_block(block)
+        check_block_context(block, self.chain_state)
+        block_hash = block.block_hash()
+        height = self.chain_state.height + 1
+        spent = self.utxo.connect_block(block, height, flush=False)
+        try:
+            if height > 0:  # ジェネシスブロックの報酬は任意(create_genesis_block)
+                check_coinbase_value(block, spent)
+            verify_block_scripts(block, spent, self._get_script_pool)
+        except Exception:
+            self.utxo.disconnect_block(block, spent, flush=False)
+            raise
+        if self.store.has_body(block_hash):
+            self.store.extend_chain(block_hash)
+        else:
+            self.store.append(block, height)
+        self.store.write_undo(block_hash, serialize_undo(spent))
+        if self.address_index is not None:
+            self.address_index.connect_block(block, height, spent)
+        self.chain_state.connect(block)
+        self._maybe_flush()
+        if self.mempool is not None:
+            self.mempool.remove_for_block(block)
+
+    def _get_script_pool(self):
+        # verify_block_scriptsがキャッシュにない入力を見つけたときだけ呼ぶ。
+        # CPUが1つの場合はcreate_poolがNoneを返すので、作ったかどうかを別に覚えて何度も呼ばないようにする
+        if not self._script_pool_created:
+            self._script_pool = create_pool(self.script_workers)
+            self._script_pool_created = True
+        return self._script_pool
+
+    def disconnect_tip(self) -> Block:
+        """
+        有効なチェーンの先頭のブロックを切断して返す。ブロック自体はストアに残る
+        """
+        block_hash = self.chain_state.tip_hash
+        if block_hash is None:
+            raise Exception("Chain is empty")
+        block = self.store.get_block(block_hash)
+        height = self.chain_state.height
+        self.utxo.disconnect_block(block, deserialize_undo(self.store.read_undo(block_hash)), flush=False)
+        if self.address_index is not None:
+            self.address_index.disconnect_block(height)
+        self.chain_state.disconnect(block, self.store)
+        self.store.rewind(height - 1)
+        self._maybe_flush()
+        if self.mempool is not None:
+            self.mempool.readd_block(block)
+        return block
+
+    def add_block(self, block: Block) -> bool:
+        """
+        ブロックを受け取る。先頭につながれば接続し、分岐したチェーンのブロックであれば検査して保存したうえで、
+        その分岐の仕事量が有効なチェーンより多ければ組み替える。有効なチェーンが変わったらTrueを返す。
+        検査に通らないブロックは保存せずに例外を送出する
+        """
+        block_hash = block.block_hash()
+        if self.store.has_body(block_hash):
+            return False
+        if block.hash_prev_block == self.chain_state.hash_prev_block:
+            self.connect_block(block)
+            return True
+        prev = self.store.location(block.hash_prev_block)
+        if prev is None:
+            raise Exception("Previous block is unknown")
+        # bitsを偽った(PoWのない)分岐の仕事量を数えて組み替えてしまわないよう、保存する前に検査する
+        check_block(block)
+        check_block_context(block, ChainState.from_window(self.store, block.hash_prev_block))
+        self.store.append(block, prev.height + 1)
+        fork_height, branch = self.find_fork(block_hash)
+        if self._work(branch) <= self._work(self.store.hash_at(height) for height in range(fork_height + 1, self.height + 1)):
+            return False
+        self.reorg(block_hash)
+        return True
+
+    def find_fork(self, block_hash: bytes) -> Tuple[int, List[bytes]]:
+        """
+        保存済みのブロックから前のブロックをたどり、有効なチェーンとの分岐点の高さと、
+        分岐点の次からそのブロックまでのブロックハッシュ(古い順)を返す
+        """
+        branch = []
+        while True:
+            location = self.store.location(block_hash)
+            if location is None:
+                raise Exception("Branch does not connect to the stored chain")
+            if self.store.hash_at(location.height) == block_hash:
+                break
+            branch.append(block_hash)
+            if location.height == 0:
+                return -1, branch[::-1]  # ジェネシスブロックから分岐している
+            block_hash = self.store.get_block_view(block_hash).hash_prev_block
+        return location.height, branch[::-1]
+
+    def _work(self, block_hashes) -> int:
+        return sum(block_work(self.store.get_block_view(block_hash).bits) for block_hash in block_hashes)
+
+    def reorg(self, new_tip: bytes) -> None:
+        """
+        new_tipを先頭とする分岐に組み替える。新しい分岐のブロックが接続できなかった場合は、元のチェーンに戻して例外を送出する
+        """
+        fork_height, branch = self.find_fork(new_tip)
+        disconnected: List[Block] = []
+        while self.height > fork_height:
+            disconnected.append(self.disconnect_tip())
+        try:
+            for block_hash in branch:
+                self.connect_block(self.store.get_block(block_hash))
+        except Exception:
+            while self.height > fork_height:
+                self.disconnect_tip()
+            for block in reversed(disconnected):
+                self.connect_block(block)
+            raise
+
+    def flush(self) -> None:
+        self.store.flush()
+        self.utxo.flush()
+        if self.mempool is not None:
+            self.mempool.persist()
+
+    def close(self) -> None:
+        if self._script_pool is not None:
+            self._script_pool.close()
+            self._script_pool.join()
+            self._script_pool = None
+        self._script_pool_created = False
+        self.store.close()
+        self.utxo.close()
+        if self.address_index is not None:
+            self.address_index.close()
+
+    def __enter__(self) -> "Node":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
@@ -0,0 +1,171 @@
+"""
+署名の検証結果のキャッシュと、ブロックの全入力のスクリプトの並列検証。
+
+ECDSAの検証は1回数msかかり、Txの検証で最も重い処理になる。同じTxはメモリプールに入るときと、ブロックに含まれて
+接続されるときの2回検証されるので、正しいと確かめた(sighash, 公開鍵, 署名)の組をSignatureCacheに覚えておき、
+2回目は検証を省く。キャッシュは件数に上限があり、あふれたら最も長く使われていないものから捨てる(LRU)。
+
+ブロックの接続では、まずキャッシュだけで検証できる入力を除き、残りの入力をTxごとにまとめてプロセスプールで検証する。
+ワーカーが正しいと確かめた組は、呼び出し元のプロセスのキャッシュに加える。
+"""
+from .interpreter import verify_input, ScriptError, TxSignatureChecker
+from .sighash import SignatureHasher
+from .tx import Tx
+from .utxo import SpentCoins
+
+from collections import OrderedDict
+from threading import Lock
+from typing import List, Optional, Tuple
+
+import multiprocessing
+
+
+default_max_entries = 1 << 16
+# 1つのタスクでワーカーに渡す入力の数。同じTxの入力はまとめて渡し、Txのシリアライズを何度も送らないようにする
+inputs_per_task = 16
+
+CacheKey = Tuple[bytes, bytes, bytes]  # (sighash, 公開鍵, 署名)
+
+
+class SignatureCache:
+    def __init__(self, max_entries: int = default_max_entries):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[CacheKey, None]" = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: CacheKey) -> bool:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, key: CacheKey) -> None:
+        with self._lock:
+            self._entries[key] = None
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+signature_cache = SignatureCache()
+
+
+class _CacheMiss(Exception):
+    pass
+
+
+class CachingSignatureChecker(TxSignatureChecker):
+    """
+    検証の前にキャッシュを引き、正しかった署名をキャッシュに加える。
+    cache_onlyの場合はキャッシュにない署名を検証せず_CacheMissを送出する(並列検証の前の振り分けに使う)
+    """
+    def __init__(
+            self,
+            tx: Tx,
+            index: int,
+            cache: Optional[SignatureCache] = None,
+            cache_only: bool = False,
+            hasher: Optional[SignatureHasher] = None
+    ):
+        super().__init__(tx, index, hasher)
+        self.cache = signature_cache if cache is None else cache
+        self.cache_only = cache_only
+        self.verified: List[CacheKey] = []
+
+    def verify_signature(self, digest: bytes, sig: bytes, pubkey: bytes) -> bool:
+        key = (digest, bytes(pubkey), bytes(sig))
+        if key in self.cache:
+            return True
+        if self.cache_only:
+            raise _CacheMiss()
+        if not super().verify_signature(digest, sig, pubkey):
+            return False
+        self.cache.add(key)
+        self.verified.append(key)
+        return True
+
+
+def _verify_task(task: Tuple[bytes, List[Tuple[int, bytes]]]) -> Tuple[Optional[str], List[CacheKey]]:
+    """
+    ワーカーで実行する。Txの一部の入力を検証し、(エラー(なければNone), 正しいと確かめた署名のキー)を返す
+    """
+    tx_bin, inputs = task
+    tx = Tx.from_bin(tx_bin)
+    hasher = SignatureHasher(tx)
+    cache = SignatureCache()  # ワーカー内では使い捨てにする
+    verified: List[CacheKey] = []
+    for index, script_pubkey in inputs:
+        checker = CachingSignatureChecker(tx, index, cache, hasher=hasher)
+        try:
+            verify_input(tx, index, script_pubkey, checker)
+        except ScriptError as e:
+            return f"Input {index} of tx {tx.tx_hash()[::-1].hex()}: {e}", verified
+        verified.extend(checker.verified)
+    return None, verified
+
+
+def verify_block_scripts(
+        block,
+        spent: SpentCoins,
+        pool=None,
+        cache: Optional[SignatureCache] = None
+) -> None:
+    """
+    ブロックのcoinbase以外の全入力のスクリプトを検証する。spentはUtxoSet.connect_blockが返した、入力の順に並んだ使われた出力。
+    poolにmultiprocessing.Poolを渡すと、キャッシュにない入力をプールで検証する。プールを返す関数を渡すと、キャッシュにない
+    入力がプールを使うほどある場合にだけ呼び出す(プールを必要になるまで作らないため)。不正な入力があればScriptErrorを送出する
+    """
+    cache = signature_cache if cache is None else cache
+    tasks: List[Tuple[bytes, List[Tuple[int, bytes]]]] = []
+    position = 0
+    for tx in block.transactions[1:]:
+        pending: List[Tuple[int, bytes]] = []
+        hasher = SignatureHasher(tx)
+        for index in range(len(tx.tx_ins)):
+            script_pubkey = spent[position][1].script_pubkey
+            position += 1
+            try:
+                checker = CachingSignatureChecker(tx, index, cache, cache_only=True, hasher=hasher)
+                verify_input(tx, index, script_pubkey, checker)
+            except _CacheMiss:
+                pending.append((index, script_pubkey))
+            except ScriptError as e:
+                raise ScriptError(f"Input {index} of tx {tx.tx_hash()[::-1].hex()}: {e}")
+        if pending:
+            tx_bin = tx.as_bin()
+            for i in range(0, len(pending), inputs_per_task):
+                tasks.append((tx_bin, pending[i:i + inputs_per_task]))
+
+    if len(tasks) > 1 and callable(pool):
+        pool = pool()
+    if pool is None or len(tasks) <= 1:
+        results = map(_verify_task, tasks)
+    else:
+        results = pool.imap_unordered(_verify_task, tasks)
+    for error, verified in results:
+        for key in verified:
+            cache.add(key)
+        if error is not None:
+            raise ScriptError(error)
+
+
+def create_pool(workers: Optional[int] = None):
+    """
+    verify_block_scriptsに渡すプロセスプールを作る。workersが1ならNone(呼び出し元のプロセスで検証する)
+    """
+    processes = workers or multiprocessing.cpu_count()
+    if processes <= 1:
+        return None
+    return multiprocessing.Pool(processes)
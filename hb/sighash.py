@@ -0,0 +1,147 @@
+"""
+署名の対象となるハッシュ(sighash)の計算と、P2PKHの入力への署名。
+OP_CHECKSIGは、署名の末尾1byteのhash_typeに従って選んだTxの一部をsha256dしたハッシュに対して署名を検証する。
+
+Bitcoinの(SegWit以前の)方式(legacy_signature_hash)は入力ごとにTx全体をシリアライズしなおすので、
+入力がn個のTxの検証にはO(n^2)の時間がかかる。このチェーンではBIP143と同じ形のハッシュ(SignatureHasher)を使う。
+全入力のOutPoint、全入力のsequence、全出力のハッシュはTxごとに一度だけ計算し、入力ごとには一定の長さのデータだけをハッシュする。
+"""
+from .ecc import encode_der, encode_pubkey, private_to_public, sign
+from .script import script_int_to_bytes
+from .tx import Tx, TxIn, TxOut, OutPoint
+from .util import int_to_bytes, sha256d
+
+from typing import Optional
+
+
+SIGHASH_ALL = 0x01
+SIGHASH_NONE = 0x02
+SIGHASH_SINGLE = 0x03
+SIGHASH_ANYONECANPAY = 0x80
+
+
+def legacy_signature_hash(tx: Tx, index: int, script_code: bytes, hash_type: int) -> bytes:
+    """
+    Bitcoinの(SegWit以前の)方式。署名する入力のscript_sigをscript_codeに、他の入力のscript_sigを空にしたTxを
+    シリアライズし、hash_type(4bytes)を付けてsha256dする。入力ごとにTx全体をシリアライズしなおす
+    """
+    if index >= len(tx.tx_ins):
+        raise Exception("Input index is out of range")
+    base_type = hash_type & 0x1f
+    if base_type == SIGHASH_SINGLE and index >= len(tx.tx_outs):
+        # 対応する出力がない場合、Bitcoinでは1を署名対象とする(仕様上の不具合だが互換性のため残されている)
+        return (1).to_bytes(32, "little")
+
+    tx_ins = []
+    for i, tx_in in enumerate(tx.tx_ins):
+        if i == index:
+            tx_ins.append(TxIn(OutPoint(tx_in.outpoint.tx_hash, tx_in.outpoint.index), script_code, tx_in.sequence))
+        elif not hash_type & SIGHASH_ANYONECANPAY:
+            sequence = 0 if base_type in (SIGHASH_NONE, SIGHASH_SINGLE) else tx_in.sequence
+            tx_ins.append(TxIn(OutPoint(tx_in.outpoint.tx_hash, tx_in.outpoint.index), b"", sequence))
+    if hash_type & SIGHASH_ANYONECANPAY:
+        tx_ins = [tx_ins[0]]
+
+    if base_type == SIGHASH_NONE:
+        tx_outs = []
+    elif base_type == SIGHASH_SINGLE:
+        tx_outs = [TxOut(0xffffffffffffffff, b"") for _ in range(index)] + [tx.tx_outs[index]]
+    else:
+        tx_outs = list(tx.tx_outs)
+
+    tx_copy = Tx(version=tx.version, tx_ins=tx_ins, tx_outs=tx_outs, locktime=tx.locktime)
+    return sha256d(tx_copy.as_bin() + hash_type.to_bytes(4, "little"))
+
+
+class SignatureHasher:
+    """
+    1つのTxの全入力のsighashを計算する。BIP143と同じく
+    version || hashPrevouts || hashSequence || 入力のOutPoint || script_code || 入力のsequence || hashOutputs || locktime || hash_type
+    をsha256dする(BIP143と違い、使う出力の金額は含めない)。
+    hashPrevouts、hashSequence、hashOutputsは最初に必要になったときに計算して使いまわす。
+    計算した後にTxを書き換えた場合は、新しくSignatureHasherを作りなおすこと
+    """
+    _zero = bytes(32)
+
+    def __init__(self, tx: Tx):
+        self.tx = tx
+        self._version = tx.version.to_bytes(4, "little")
+        self._locktime = tx.locktime.to_bytes(4, "little")
+        self._hash_prevouts: Optional[bytes] = None
+        self._hash_sequence: Optional[bytes] = None
+        self._hash_outputs: Optional[bytes] = None
+
+    @property
+    def hash_prevouts(self) -> bytes:
+        if self._hash_prevouts is None:
+            self._hash_prevouts = sha256d(b"".join(tx_in.outpoint.as_bin() for tx_in in self.tx.tx_ins))
+        return self._hash_prevouts
+
+    @property
+    def hash_sequence(self) -> bytes:
+        if self._hash_sequence is None:
+            self._hash_sequence = sha256d(b"".join(tx_in.sequence.to_bytes(4, "little") for tx_in in self.tx.tx_ins))
+        return self._hash_sequence
+
+    @property
+    def hash_outputs(self) -> bytes:
+        if self._hash_outputs is None:
+            self._hash_outputs = sha256d(b"".join(tx_out.as_bin() for tx_out in self.tx.tx_outs))
+        return self._hash_outputs
+
+    def hash(self, index: int, script_code: bytes, hash_type: int) -> bytes:
+        tx = self.tx
+        if index >= len(tx.tx_ins):
+            raise Exception("Input index is out of range")
+        tx_in = tx.tx_ins[index]
+        base_type = hash_type & 0x1f
+        anyone_can_pay = hash_type & SIGHASH_ANYONECANPAY
+
+        hash_prevouts = self._zero if anyone_can_pay else self.hash_prevouts
+        if anyone_can_pay or base_type in (SIGHASH_NONE, SIGHASH_SINGLE):
+            hash_sequence = self._zero
+        else:
+            hash_sequence = self.hash_sequence
+        if base_type == SIGHASH_NONE:
+            hash_outputs = self._zero
+        elif base_type == SIGHASH_SINGLE:
+            # 対応する出力がなければ0(legacyのように1を署名させることはしない)
+            hash_outputs = sha256d(tx.tx_outs[index].as_bin()) if index < len(tx.tx_outs) else self._zero
+        else:
+            hash_outputs = self.hash_outputs
+
+        return sha256d(b"".join((
+            self._version, hash_prevouts, hash_sequence,
+            tx_in.outpoint.as_bin(), int_to_bytes(len(script_code)), script_code, tx_in.sequence.to_bytes(4, "little"),
+            hash_outputs, self._locktime, hash_type.to_bytes(4, "little")
+        )))
+
+
+def signature_hash(tx: Tx, index: int, script_code: bytes, hash_type: int) -> bytes:
+    """
+    1つの入力のsighash。同じTxの複数の入力を扱う場合は、SignatureHasherを1つ作って使いまわす方が速い
+    """
+    return SignatureHasher(tx).hash(index, script_code, hash_type)
+
+
+def sign_p2pkh_input(
+        tx: Tx,
+        index: int,
+        private_key: int,
+        script_pubkey: bytes,
+        hash_type: int = SIGHASH_ALL,
+        compressed: bool = True,
+        hasher: Optional[SignatureHasher] = None
+) -> bytes:
+    """
+    P2PKHの出力を使うindex番目の入力のscript_sig(<署名> <公開鍵>)を作り、txに設定して返す。
+    多数の入力に署名する場合は、同じhasherを渡す(script_sigはsighashに含まれないので、署名の途中で作りなおす必要はない)
+    """
+    if hasher is None:
+        hasher = SignatureHasher(tx)
+    digest = hasher.hash(index, script_pubkey, hash_type)
+    sig = encode_der(*sign(private_key, digest)) + bytes([hash_type])
+    pubkey = encode_pubkey(private_to_public(private_key), compressed)
+    script_sig = script_int_to_bytes(len(sig)) + sig + script_int_to_bytes(len(pubkey)) + pubkey
+    tx.tx_ins[index].script_sig = script_sig
+    return script_sig
@@ -0,0 +1,239 @@
+"""
+UTXOセットのスナップショット。
+ある高さのUTXOセットをバイナリのファイルに書き出しておけば、新しいノードはジェネシスブロックからすべてのブロックを
+反映し直さなくても、スナップショットを読み込むだけで(UTXOセットの大きさに比例する時間で)その高さから動き始められる。
+ブロックストアにはスナップショットの高さまでのヘッダだけがあればよい(BlockStore.append_header)。
+読み込んだ後、スナップショットの高さまでのブロックの本体を別のスレッドで検証しながら反映し直し、同じUTXOセットになることを確かめる。
+
+ファイルの形式は、ヘッダ(magic、バージョン、ブロックハッシュ、高さ、UTXOの数、UTXOのハッシュ)の後に、
+キー(36bytes)とCoin.as_binがキーの順に並ぶ。UTXOのハッシュはこの並び全体のsha256で、読み込むときに検証する。
+"""
+from .block import Block
+from .chainstate import ChainState
+from .node import Node
+from .storage import BlockStore, read_blocks
+from .utxo import Coin, UtxoSet, deserialize_undo
+from .validation import BlockValidationError, check_block, check_block_context, check_coinbase_value
+
+from itertools import islice
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import hashlib
+import heapq
+import os
+import struct
+import threading
+
+
+snapshot_magic = b"hbus"
+snapshot_version = 1
+
+_snapshot_header = struct.Struct("<4sI32sIQ32s")  # magic、バージョン、ブロックハッシュ、高さ、UTXOの数、UTXOのハッシュ
+
+
+class SnapshotInfo(NamedTuple):
+    block_hash: bytes
+    height: int
+    coin_count: int
+    utxo_hash: bytes
+
+
+def utxo_set_hash(coins: Iterable[Tuple[bytes, Coin]]) -> Tuple[bytes, int]:
+    """
+    キーの順に並んだUTXOのハッシュと数。スナップショットに書かれるハッシュと同じ値になる
+    """
+    h = hashlib.sha256()
+    count = 0
+    for key, coin in coins:
+        h.update(key + coin.as_bin())
+        count += 1
+    return h.digest(), count
+
+
+def _coins_at(node: Node, height: int) -> Iterator[Tuple[bytes, Coin]]:
+    """
+    heightの時点のUTXOをキーの順に返す。先頭からheightまでの各ブロックの取り消し用データを使うので、
+    チェーンを巻き戻す必要はない(かかる時間はUTXOセットの大きさと巻き戻す深さに比例する)
+    """
+    restored = []
+    for h in range(height + 1, node.height + 1):
+        for key, coin in deserialize_undo(node.store.read_undo(node.store.hash_at(h))):
+            if coin.height <= height:
+                restored.append((key, coin))
+    restored.sort(key=lambda item: item[0])
+    current = ((key, coin) for key, coin in node.utxo.items() if coin.height <= height)
+    return heapq.merge(current, restored, key=lambda item: item[0])
+
+
+def write_snapshot(node: Node, path: str, height: Optional[int] = None) -> SnapshotInfo:
+    """
+    heightの時点(省略した場合は先頭)のUTXOセットをpathに書き出す
+    """
+    if height is None:
+        height = node.height
+    if not 0 <= height <= node.height:
+        raise Exception(f"Height {height} is not on the active chain")
+    block_hash = node.store.hash_at(height)
+
+    h = hashlib.sha256()
+    count = 0
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(bytes(_snapshot_header.size))  # UTXOの数とハッシュは最後に書く
+        for key, coin in _coins_at(node, height):
+            record = key + coin.as_bin()
+            f.write(record)
+            h.update(record)
+            count += 1
+        info = SnapshotInfo(block_hash, height, count, h.digest())
+        f.seek(0)
+        f.write(_snapshot_header.pack(snapshot_magic, snapshot_version, *info))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return info
+
+
+def read_snapshot_info(path: str) -> SnapshotInfo:
+    with open(path, "rb") as f:
+        header = f.read(_snapshot_header.size)
+    if len(header) != _snapshot_header.size:
+        raise Exception("Snapshot is truncated")
+    magic, version, *info = _snapshot_header.unpack(header)
+    if magic != snapshot_magic or version != snapshot_version:
+        raise Exception("Unsupported snapshot format")
+    return SnapshotInfo(*info)
+
+
+def load_snapshot(path: str, utxo: UtxoSet, expected_hash: Optional[bytes] = None) -> SnapshotInfo:
+    """
+    スナップショットを空のUtxoSetに読み込む。UTXOのハッシュがヘッダ(とexpected_hash)と一致しなければ例外を送出する。
+    その場合、utxoのbest_blockは設定されないので、途中まで読み込んだUtxoSetは捨てること
+    """
+    if utxo.best_block is not None or len(utxo):
+        raise Exception("UTXO set is not empty")
+    info = read_snapshot_info(path)
+    if expected_hash is not None and info.utxo_hash != expected_hash:
+        raise Exception("Snapshot hash does not match the expected hash")
+
+    # UTXOセット全体をメモリに載せないよう、ファイルから1件ずつ読み、UtxoSetのキャッシュもその都度溢れた分を書き出す
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        f.seek(_snapshot_header.size)
+        for _ in range(info.coin_count):
+            key = f.read(36)
+            if len(key) != 36:
+                raise Exception("Snapshot is truncated")
+            coin_bin = Coin.read_bin(f)
+            h.update(key)
+            h.update(coin_bin)
+            utxo.add(key, Coin.from_bin(coin_bin))
+            utxo.maybe_flush()
+        if f.read(1) or h.digest() != info.utxo_hash:
+            raise Exception("Snapshot is corrupted")
+
+    utxo.best_block = info.block_hash
+    utxo.flush()
+    return info
+
+
+class SnapshotValidator(threading.Thread):
+    """
+    ジェネシスブロックからスナップショットの高さまでのブロックを検証しながら別のUtxoSetに反映し、スナップショットと同じになるか確かめる。
+    blocksには(ピアからダウンロードするなどした)ジェネシスブロックから順に並んだブロックを渡す。省略した場合はstoreに保存された本体を読む。
+    ブロックはcheck_blockと前のブロックに対するcheck_block_contextで検査し、最後のブロックがスナップショットのブロックであることを確かめる。
+    終わるとvalidにTrueかFalseが入る(Falseの場合はerrorに理由が入る)
+    """
+    def __init__(
+            self,
+            store: BlockStore,
+            info: SnapshotInfo,
+            utxo_path: str = ":memory:",
+            blocks: Optional[Iterable[Block]] = None
+    ):
+        super().__init__(daemon=True)
+        if blocks is None:
+            if not store.has_body(store.hash_at(0)):
+                raise Exception("Store has only block headers; pass the blocks to validate")
+            store.flush()
+        self.store = store
+        self.blocks = blocks
+        self.info = info
+        self.utxo_path = utxo_path
+        self.validated_height = -1
+        self.valid: Optional[bool] = None
+        self.error: Optional[Exception] = None
+        self._stop_event = threading.Event()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def _stored_blocks(self) -> Iterator[Block]:
+        # 位置はこのスレッドで引く(ノードを起動する前にチェーン全体をたどらないため)。スナップショットより下のチェーンは変わらない
+        locations = (self.store.location(self.store.hash_at(height)) for height in range(self.info.height + 1))
+        return read_blocks(self.store.path, locations)
+
+    def run(self) -> None:
+        utxo = UtxoSet(self.utxo_path)
+        try:
+            state = ChainState()
+            blocks = self._stored_blocks() if self.blocks is None else self.blocks
+            for height, block in enumerate(islice(blocks, self.info.height + 1)):
+                if self._stop_event.is_set():
+                    return
+                try:
+                    check_block(block)
+                    check_block_context(block, state)
+                    spent = utxo.connect_block(block, height)
+                    if height > 0:  # ジェネシスブロックの報酬は任意(create_genesis_block)
+                        check_coinbase_value(block, spent)
+                except Exception as e:
+                    raise BlockValidationError(height, str(e))
+                state.connect(block)
+                self.validated_height = height
+            if state.tip_hash != self.info.block_hash:
+                raise Exception("Chain does not lead to the snapshot block")
+            if utxo_set_hash(utxo.items()) != (self.info.utxo_hash, self.info.coin_count):
+                raise Exception("UTXO set does not match the snapshot")
+            self.valid = True
+        except Exception as e:
+            self.error = e
+            self.valid = False
+        finally:
+            utxo.close()
+
+
+def start_from_snapshot(
+        path: str,
+        store: BlockStore,
+        utxo: UtxoSet,
+        expected_hash: Optional[bytes] = None,
+        validator_utxo_path: str = ":memory:",
+        blocks: Optional[Iterable[Block]] = None
+) -> Tuple[Node, SnapshotValidator]:
+    """
+    スナップショットを空のutxoに読み込み、その高さからノードを動かし始める。
+    storeはスナップショットのブロックまでのチェーンを、少なくともヘッダで持っている必要がある。
+    先頭の状態はスナップショットのブロックから難易度調整の窓の分だけヘッダをたどって作るので、チェーン全体は読まない。
+    スナップショットより先に本体のあるブロックがあれば接続し直す。
+    返されるSnapshotValidatorは、blocks(省略した場合はstoreの本体)でスナップショットまでの履歴の検証をすでに別のスレッドで始めている
+    """
+    info = read_snapshot_info(path)
+    if store.hash_at(info.height) != info.block_hash:
+        raise Exception("Snapshot block is not on the active chain")
+    validator = SnapshotValidator(store, info, validator_utxo_path, blocks)
+    load_snapshot(path, utxo, expected_hash)
+
+    pending: List[bytes] = []
+    for height in range(info.height + 1, store.tip_height + 1):
+        block_hash = store.hash_at(height)
+        if not store.has_body(block_hash):
+            break
+        pending.append(block_hash)
+    store.rewind(info.height)
+    node = Node(store, utxo, chain_state=ChainState.from_window(store, info.block_hash))
+    for block_hash in pending:
+        node.connect_block(store.get_block(block_hash))
+
+    validator.start()
+    return node, validator
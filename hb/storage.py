@@ -0,0 +1,435 @@
+"""
+ブロックを生の形式(Block.as_bin)のまま追記していくストレージ。
+blockchain.jsonのように保存のたびに全体を書き直したり、読み込みのたびに全体をパースしたりする必要がない。
+
+- blk00000.dat, blk00001.dat, ... : [magic(4bytes)][ブロックの大きさ(little、4bytes)][生のブロック] が並ぶ。
+  1ファイルがmax_file_sizeを超えたら次のファイルに移る
+- index.dat : ブロックハッシュ(32bytes)、ファイル番号(4bytes)、ファイル内の位置(8bytes)、大きさ(4bytes)、高さ(4bytes)の
+  固定長レコードが追記順に並ぶ。開くときに読み込み、ハッシュからの辞書を作る。分岐したチェーンのブロックもすべて含む。
+  同じブロックハッシュのレコードが複数あれば、後のものが有効になる
+- ヘッダだけのブロック(append_header)は、Txが0個のブロックとして保存する。スナップショットから始めるノードのように、
+  本体を持たないブロックまでのチェーンを作るのに使う。後からappendで本体を保存すると、インデックスは本体を指すようになる
+- chain.dat : 有効なチェーンのブロックハッシュ(32bytes)が高さの順に並ぶ。チェーンの組み替え(reorg)では末尾を切り詰めて追記する
+- rev00000.dat, rev00001.dat, ... : ブロックの取り消し用データ(undo)。同じ番号のblkファイルのブロックのものが、
+  blkファイルと同じ形式(magicだけ異なる)で並ぶ
+- undo.dat : 取り消し用データのインデックス。index.datと同じ形式
+
+書き込みはOSのバッファに任せ、fsyncはsync_interval個のブロックごと(とflush()、close()の時)にまとめて行う。
+ブロックファイル、取り消し用データを先にfsyncしてからインデックスとchain.datをfsyncするので、インデックスが指すデータは必ずディスク上に存在する。
+途中でクラッシュした場合は、開くときに壊れたレコードや中途半端に書かれたブロック、取り消し用データを切り捨てる。
+
+get_block_view()はブロックファイルをmmapし、必要なフィールドだけをその場でデコードするBlockViewを返す。
+"""
+from .block import Block
+from .view import BlockView
+
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import mmap
+import os
+import struct
+
+
+block_file_magic = b"hbbk"
+undo_file_magic = b"hbud"
+max_file_size = 128 * 1024 * 1024
+default_sync_interval = 16
+
+_record_header = struct.Struct("<4sI")  # magic、大きさ
+_index_record = struct.Struct("<32sIQII")  # ブロックハッシュ、ファイル番号、位置、大きさ、高さ
+_chain_record = struct.Struct("<32s")  # ブロックハッシュ
+_header_only_size = 81  # ヘッダ(80bytes)とTxの数(0)
+
+
+class BlockLocation(NamedTuple):
+    file_no: int
+    offset: int  # 生のブロックの先頭の位置(レコードのヘッダの直後)
+    length: int
+    height: int
+
+
+class BlockStore:
+    def __init__(self, path: str = "../blockchain_data/blocks", sync_interval: int = default_sync_interval):
+        self.path = path
+        self.sync_interval = sync_interval
+        os.makedirs(path, exist_ok=True)
+
+        self._index: Dict[bytes, BlockLocation] = {}
+        self._undo_index: Dict[bytes, BlockLocation] = {}
+        self._chain: List[bytes] = []  # 有効なチェーンのブロックハッシュ。添字が高さ
+        self._readers: Dict[str, BinaryIO] = {}
+        self._maps: Dict[int, mmap.mmap] = {}
+        self._undo_files: Dict[int, BinaryIO] = {}
+        self._unsynced = 0
+
+        self._load_index()
+        self._index_file = open(self._index_path(), "ab")
+        self._undo_index_file = open(self._undo_index_path(), "ab")
+        self._chain_file = open(self._chain_path(), "ab")
+        self._file_no = max([location.file_no for location in self._index.values()], default=0)
+        self._truncate_block_file()
+        self._truncate_undo_files()
+        self._block_file = open(self._block_file_path(self._file_no), "ab")
+
+    def _index_path(self) -> str:
+        return os.path.join(self.path, "index.dat")
+
+    def _undo_index_path(self) -> str:
+        return os.path.join(self.path, "undo.dat")
+
+    def _chain_path(self) -> str:
+        return os.path.join(self.path, "chain.dat")
+
+    def _block_file_path(self, file_no: int) -> str:
+        return block_file_path(self.path, file_no)
+
+    def _undo_file_path(self, file_no: int) -> str:
+        return os.path.join(self.path, f"rev{file_no:05d}.dat")
+
+    def _load_index(self) -> None:
+        by_height: Dict[int, bytes] = {}
+        for block_hash, location in _load_locations(self._index_path(), self._block_file_path):
+            self._index[block_hash] = location
+            by_height[location.height] = block_hash
+        for block_hash, location in _load_locations(self._undo_index_path(), self._undo_file_path):
+            self._undo_index[block_hash] = location
+
+        chain_path = self._chain_path()
+        if os.path.exists(chain_path):
+            with open(chain_path, "rb") as f:
+                data = f.read()
+            for offset in range(0, len(data) - _chain_record.size + 1, _chain_record.size):
+                block_hash = data[offset:offset + _chain_record.size]
+                if block_hash not in self._index:
+                    break  # インデックスへの書き込みが間に合わなかった
+                self._chain.append(block_hash)
+            if len(self._chain) * _chain_record.size != len(data):
+                with open(chain_path, "r+b") as f:
+                    f.truncate(len(self._chain) * _chain_record.size)
+        else:
+            # chain.datがない(以前の形式の)ストアでは、高さごとに最後に書かれたブロックを有効なチェーンとする
+            while len(self._chain) in by_height:
+                self._chain.append(by_height[len(self._chain)])
+            with open(chain_path, "wb") as f:
+                f.write(b"".join(self._chain))
+
+    def _truncate_block_file(self) -> None:
+        """
+        インデックスに載っていない(書き込み途中でクラッシュした)ブロックをファイルの末尾から取り除く
+        """
+        _truncate_file(self._block_file_path(self._file_no), self._index.values(), self._file_no)
+
+    def _truncate_undo_files(self) -> None:
+        """
+        取り消し用データも同じように切り詰める。分岐の組み替えでは古いブロックの取り消し用データを書くことがあるので、
+        最後のファイルだけでなくすべてのrevファイルを調べる
+        """
+        for file_no in range(self._file_no + 1):
+            _truncate_file(self._undo_file_path(file_no), self._undo_index.values(), file_no)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, block_hash: bytes) -> bool:
+        return block_hash in self._index
+
+    @property
+    def tip_height(self) -> int:
+        """有効なチェーンの先頭のブロックの高さ。まだ何もなければ-1"""
+        return len(self._chain) - 1
+
+    @property
+    def tip_hash(self) -> Optional[bytes]:
+        return self._chain[-1] if self._chain else None
+
+    def append(self, block: Block, height: int = None) -> BlockLocation:
+        """
+        ブロックを追記する。heightを省略した場合は前のブロックの次の高さ(前のブロックがなければ現在の先頭の次の高さ)になる。
+        有効なチェーンの先頭につながるブロックはチェーンに加わり、それ以外は分岐したチェーンのブロックとして保存だけされる。
+        ヘッダだけが保存されているブロックなら、本体を追記してそちらを指すようにする
+        """
+        block_hash = block.block_hash()
+        location = self._index.get(block_hash)
+        if location is not None and (location.length > _header_only_size or not block.transactions):
+            return location
+        if location is not None:
+            height = location.height
+        if height is None:
+            prev = self._index.get(block.hash_prev_block)
+            height = prev.height + 1 if prev is not None else len(self._chain)
+
+        block_bin = block.as_bin()
+        record_size = _record_header.size + len(block_bin)
+        position = self._block_file.tell()
+        if position > 0 and position + record_size > max_file_size:
+            self._next_file()
+            position = 0
+
+        self._block_file.write(_record_header.pack(block_file_magic, len(block_bin)))
+        self._block_file.write(block_bin)
+        location = BlockLocation(self._file_no, position + _record_header.size, len(block_bin), height)
+        self._index_file.write(_index_record.pack(block_hash, *location))
+        self._index[block_hash] = location
+        if height == len(self._chain) and (not self._chain or block.hash_prev_block == self._chain[-1]):
+            self._chain.append(block_hash)
+            self._chain_file.write(block_hash)
+
+        self._unsynced += 1
+        if self._unsynced >= self.sync_interval:
+            self.flush()
+        return location
+
+    def append_header(self, block: Block, height: int = None) -> BlockLocation:
+        """
+        ブロックのヘッダだけを保存する。blockのTxは使わない(ヘッダのフィールドだけが必要)
+        """
+        header = Block(block.version, block.hash_prev_block, block.hash_merkle_root, block.time, block.bits, block.nonce, [])
+        return self.append(header, height)
+
+    def has_body(self, block_hash: bytes) -> bool:
+        """ブロックの本体(Tx)が保存されているか。ヘッダだけのブロックや、保存されていないブロックならFalse"""
+        location = self._index.get(block_hash)
+        return location is not None and location.length > _header_only_size
+
+    def extend_chain(self, block_hash: bytes) -> None:
+        """
+        保存済みのブロックを有効なチェーンの先頭に加える
+        """
+        location = self._index.get(block_hash)
+        if location is None:
+            raise KeyError(block_hash.hex())
+        if location.height != len(self._chain) or (
+                self._chain and self.get_block_view(block_hash).hash_prev_block != self._chain[-1]
+        ):
+            raise Exception("Block does not extend the active chain")
+        self._chain.append(block_hash)
+        self._chain_file.write(block_hash)
+
+    def rewind(self, height: int) -> None:
+        """
+        有効なチェーンをheightの高さまで巻き戻す。それより上のブロックは消さず、分岐したチェーンのブロックとして残る
+        """
+        if height >= len(self._chain) - 1:
+            return
+        del self._chain[height + 1:]
+        self._chain_file.flush()
+        self._chain_file.truncate(len(self._chain) * _chain_record.size)
+
+    def write_undo(self, block_hash: bytes, data: bytes) -> None:
+        """
+        ブロックの取り消し用データを、ブロックと同じ番号のrevファイルに書き込む。すでにあれば何もしない
+        """
+        if block_hash in self._undo_index:
+            return
+        location = self._index.get(block_hash)
+        if location is None:
+            raise KeyError(block_hash.hex())
+        undo_file = self._undo_files.get(location.file_no)
+        if undo_file is None:
+            undo_file = open(self._undo_file_path(location.file_no), "ab")
+            self._undo_files[location.file_no] = undo_file
+        position = undo_file.tell()
+        undo_file.write(_record_header.pack(undo_file_magic, len(data)))
+        undo_file.write(data)
+        undo_location = BlockLocation(location.file_no, position + _record_header.size, len(data), location.height)
+        self._undo_index_file.write(_index_record.pack(block_hash, *undo_location))
+        self._undo_index[block_hash] = undo_location
+
+    def read_undo(self, block_hash: bytes) -> bytes:
+        location = self._undo_index.get(block_hash)
+        if location is None:
+            raise KeyError(block_hash.hex())
+        undo_file = self._undo_files.get(location.file_no)
+        if undo_file is not None:
+            undo_file.flush()
+        return self._read(self._undo_file_path(location.file_no), location)
+
+    def _read(self, path: str, location: BlockLocation) -> bytes:
+        reader = self._readers.get(path)
+        if reader is None:
+            reader = open(path, "rb")
+            self._readers[path] = reader
+        reader.seek(location.offset)
+        return reader.read(location.length)
+
+    def _next_file(self) -> None:
+        self.flush()
+        self._block_file.close()
+        self._file_no += 1
+        self._block_file = open(self._block_file_path(self._file_no), "ab")
+
+    def flush(self) -> None:
+        """
+        書き込んだブロックとインデックスをディスクに同期する。データを先に同期してからインデックスを同期する
+        """
+        for f in [self._block_file, *self._undo_files.values(), self._index_file, self._undo_index_file, self._chain_file]:
+            f.flush()
+            os.fsync(f.fileno())
+        self._unsynced = 0
+
+    def location(self, block_hash: bytes) -> Optional[BlockLocation]:
+        return self._index.get(block_hash)
+
+    def hash_at(self, height: int) -> Optional[bytes]:
+        """有効なチェーンのheightの高さのブロックハッシュ"""
+        return self._chain[height] if 0 <= height < len(self._chain) else None
+
+    def read_bin(self, block_hash: bytes) -> bytes:
+        location = self._index.get(block_hash)
+        if location is None:
+            raise KeyError(block_hash.hex())
+        if location.file_no == self._file_no:
+            # まだOSに渡していないデータがあるかもしれないので、読む前に書き出しておく
+            self._block_file.flush()
+        return self._read(self._block_file_path(location.file_no), location)
+
+    def get_block(self, block_hash: bytes) -> Block:
+        return Block.from_bin(self.read_bin(block_hash))
+
+    def get_block_by_height(self, height: int) -> Block:
+        block_hash = self.hash_at(height)
+        if block_hash is None:
+            raise KeyError(height)
+        return self.get_block(block_hash)
+
+    def iter_blocks(self, start_height: int = 0, end_height: int = None) -> Iterator[Block]:
+        """
+        start_height以上end_height未満(省略した場合は先頭まで)のブロックを高さの順に1つずつ読み出す
+        """
+        if end_height is None:
+            end_height = len(self._chain)
+        for height in range(start_height, end_height):
+            yield self.get_block_by_height(height)
+
+    def _map(self, file_no: int, end: int) -> mmap.mmap:
+        """
+        ブロックファイルをmmapする。追記中のファイルはmmapした後も伸びるので、endまで届いていなければmmapしなおす
+        """
+        mapped = self._maps.get(file_no)
+        if mapped is None or len(mapped) < end:
+            if file_no == self._file_no:
+                self._block_file.flush()
+            with open(self._block_file_path(file_no), "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # 古いmmapは、それを参照しているビューがなくなった時点で解放される
+            self._maps[file_no] = mapped
+        return mapped
+
+    def get_block_view(self, block_hash: bytes) -> BlockView:
+        """
+        ブロックをコピーせずに参照するビューを返す。ビューはこのストアを閉じた後は使えない
+        """
+        location = self._index.get(block_hash)
+        if location is None:
+            raise KeyError(block_hash.hex())
+        mapped = self._map(location.file_no, location.offset + location.length)
+        return BlockView(memoryview(mapped)[location.offset:location.offset + location.length])
+
+    def get_block_view_by_height(self, height: int) -> BlockView:
+        block_hash = self.hash_at(height)
+        if block_hash is None:
+            raise KeyError(height)
+        return self.get_block_view(block_hash)
+
+    def close(self) -> None:
+        self.flush()
+        for f in [self._block_file, *self._undo_files.values(), self._index_file, self._undo_index_file, self._chain_file]:
+            f.close()
+        self._undo_files = {}
+        for reader in self._readers.values():
+            reader.close()
+        self._readers = {}
+        for mapped in self._maps.values():
+            try:
+                mapped.close()
+            except BufferError:
+                pass  # まだビューから参照されている場合は、参照がなくなった時点で解放される
+        self._maps = {}
+
+    def __enter__(self) -> "BlockStore":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+
+def block_file_path(path: str, file_no: int) -> str:
+    return os.path.join(path, f"blk{file_no:05d}.dat")
+
+
+def read_blocks(path: str, locations: Iterable[BlockLocation]) -> Iterator[Block]:
+    """
+    locationsのブロックを順に読み出す。BlockStoreとは別にファイルを開くので、
+    BlockStoreに書き込んでいる最中でも別のスレッドから使える(書き込み済みのブロックの位置であること)
+    """
+    readers: Dict[int, BinaryIO] = {}
+    try:
+        for location in locations:
+            reader = readers.get(location.file_no)
+            if reader is None:
+                reader = open(block_file_path(path, location.file_no), "rb")
+                readers[location.file_no] = reader
+            reader.seek(location.offset)
+            yield Block.from_bin(reader.read(location.length))
+    finally:
+        for reader in readers.values():
+            reader.close()
+
+
+def _truncate_file(path: str, locations: Iterable[BlockLocation], file_no: int) -> None:
+    """
+    file_no番のファイルのうち、locationsのどれからも指されていない末尾を切り捨てる
+    """
+    if not os.path.exists(path):
+        return
+    end = max([location.offset + location.length for location in locations if location.file_no == file_no], default=0)
+    if os.path.getsize(path) > end:
+        with open(path, "r+b") as f:
+            f.truncate(end)
+
+
+def _load_locations(index_path: str, file_path: Callable[[int], str]) -> List[Tuple[bytes, BlockLocation]]:
+    """
+    インデックスのファイルを読む。データの書き込みが間に合わなかったレコード以降は捨て、ファイルも切り詰める
+    """
+    if not os.path.exists(index_path):
+        return []
+    with open(index_path, "rb") as f:
+        data = f.read()
+
+    result = []
+    valid = 0
+    file_sizes: Dict[int, int] = {}
+    for offset in range(0, len(data) - _index_record.size + 1, _index_record.size):
+        block_hash, file_no, block_offset, length, height = _index_record.unpack_from(data, offset)
+        if file_no not in file_sizes:
+            path = file_path(file_no)
+            file_sizes[file_no] = os.path.getsize(path) if os.path.exists(path) else 0
+        if block_offset + length > file_sizes[file_no]:
+            break
+        result.append((block_hash, BlockLocation(file_no, block_offset, length, height)))
+        valid = offset + _index_record.size
+
+    if valid != len(data):
+        with open(index_path, "r+b") as f:
+            f.truncate(valid)
+    return result
+
+
+def scan_block_files(path: str = "../blockchain_data/blocks") -> Iterator[Block]:
+    """
+    インデックスを使わずに、ブロックファイルを先頭から順に読んでブロックを1つずつ返す(インデックスの再構築などに使う)。
+    一度に読み込むのはブロック1つ分だけなので、ファイルがいくら大きくてもメモリ使用量は変わらない
+    """
+    file_no = 0
+    while os.path.exists(block_file := block_file_path(path, file_no)):
+        with open(block_file, "rb") as f:
+            while len(header := f.read(_record_header.size)) == _record_header.size:
+                magic, length = _record_header.unpack(header)
+                if magic != block_file_magic:
+                    raise Exception(f"Invalid block record in {block_file}")
+                data = f.read(length)
+                if len(data) != length:
+                    break  # 書き込み途中のブロック
+                yield Block.from_bin(data)
+        file_no += 1
@@ -1,14 +1,50 @@
-from dataclasses import dataclass, asdict
-from typing import List, Dict, Tuple
+from dataclasses import dataclass
+from typing import Iterator, List, Dict, Tuple
 
-from .util import int_to_bytes, sha256d
+from .util import int_size, write_int, bytes_to_int, sha256d, shallow_asdict, iter_json_array
+from .cache import Cacheable, Tracked
 
 import binascii
 import json
+import struct
+
+
+_uint32 = struct.Struct("<I")
+_uint64 = struct.Struct("<Q")
+
+
+def _serialize(obj) -> bytes:
+    """
+    先に全体の大きさを求めてバッファを一度だけ確保し、そこにserialize_intoで書き込む
+    """
+    buf = bytearray(obj.serialized_size())
+    obj.serialize_into(buf, 0)
+    return bytes(buf)
+
+
+def _write_bytes(buf, offset: int, data: bytes) -> int:
+    """
+    長さ(可変長整数)とそれに続くバイト列を書き込む
+    """
+    offset = write_int(buf, offset, len(data))
+    buf[offset:offset + len(data)] = data
+    return offset + len(data)
+
+
+def _read_bytes(view: memoryview, offset: int) -> Tuple[bytes, int]:
+    """
+    長さ(可変長整数)とそれに続くバイト列を読み取る。memoryviewをスライスしてからbytesにするので、コピーは一度だけで済む
+    """
+    length, offset = bytes_to_int(view, offset)
+    end = offset + length
+    if end > len(view):
+        raise Exception("Data is truncated")
+    return bytes(view[offset:end]), end
 
 
 @dataclass
-class OutPoint:
+class OutPoint(Tracked):
+    __slots__ = ("tx_hash", "index")
     tx_hash: bytes
     index: int
 
@@ -30,7 +66,7 @@ class OutPoint:
         return cls(**shaped_data)
 
     def as_dict(self) -> Dict:
-        result = asdict(self)
+        result = shallow_asdict(self)
         result["tx_hash"] = result["tx_hash"].hex()
         return result
 
@@ -42,13 +78,39 @@ class OutPoint:
         OutPointはその通貨をたどるために使われる情報。どの取引でその通貨が自分のアドレスに入ってきたかを示す値になる。
         なお、マイニングで生成された場合はtx_hashが32bytes分の0で埋められる。
         """
-        block_bin = self.tx_hash
-        block_bin += self.index.to_bytes(4, "little")
-        return block_bin
+        return _serialize(self)
+
+    def serialized_size(self) -> int:
+        return 36
+
+    def serialize_into(self, buf, offset: int) -> int:
+        """
+        書き込み可能なバッファ(bytearrayなど)のoffsetの位置に書き込み、書き終わった位置を返す
+        """
+        buf[offset:offset + 32] = self.tx_hash
+        _uint32.pack_into(buf, offset + 32, self.index)
+        return offset + 36
+
+    @classmethod
+    def from_bin(cls, data: bytes) -> "OutPoint":
+        return cls.read_from(memoryview(data), 0)[0]
+
+    @classmethod
+    def read_from(cls, view: memoryview, offset: int) -> Tuple["OutPoint", int]:
+        """
+        viewのoffsetの位置からOutPointを読み取り、読み終わった位置とともに返す
+        """
+        if offset + 36 > len(view):
+            raise Exception("Data is truncated")
+        tx_hash = bytes(view[offset:offset + 32])
+        index, = _uint32.unpack_from(view, offset + 32)
+        return cls(tx_hash=tx_hash, index=index), offset + 36
 
 
 @dataclass
-class TxIn:
+class TxIn(Tracked):
+    __slots__ = ("outpoint", "script_sig", "sequence")
+    _child_fields = ("outpoint",)
     outpoint: OutPoint
     script_sig: bytes
     sequence: int
@@ -74,7 +136,7 @@ class TxIn:
         return cls(**shaped_data)
 
     def as_dict(self) -> Dict:
-        result = asdict(self)
+        result = shallow_asdict(self)
         result["outpoint"] = result["outpoint"].as_dict()
         result["script_sig"] = result["script_sig"].hex()
         return result
@@ -89,15 +151,34 @@ class TxIn:
         ScriptSigはOutPointでたどられた通貨を所有していることを証明するための、秘密鍵による署名が入ることが一般的。
         SequenceはCSV(Check Sequence Verify)に使われる。
         """
-        block_bin = self.outpoint.as_bin()
-        block_bin += int_to_bytes(len(self.script_sig))
-        block_bin += self.script_sig
-        block_bin += self.sequence.to_bytes(4, "little")
-        return block_bin
+        return _serialize(self)
+
+    def serialized_size(self) -> int:
+        return 36 + int_size(len(self.script_sig)) + len(self.script_sig) + 4
+
+    def serialize_into(self, buf, offset: int) -> int:
+        offset = self.outpoint.serialize_into(buf, offset)
+        offset = _write_bytes(buf, offset, self.script_sig)
+        _uint32.pack_into(buf, offset, self.sequence)
+        return offset + 4
+
+    @classmethod
+    def from_bin(cls, data: bytes) -> "TxIn":
+        return cls.read_from(memoryview(data), 0)[0]
+
+    @classmethod
+    def read_from(cls, view: memoryview, offset: int) -> Tuple["TxIn", int]:
+        outpoint, offset = OutPoint.read_from(view, offset)
+        script_sig, offset = _read_bytes(view, offset)
+        if offset + 4 > len(view):
+            raise Exception("Data is truncated")
+        sequence, = _uint32.unpack_from(view, offset)
+        return cls(outpoint=outpoint, script_sig=script_sig, sequence=sequence), offset + 4
 
 
 @dataclass
-class TxOut:
+class TxOut(Tracked):
+    __slots__ = ("value", "script_pubkey")
     value: int
     script_pubkey: bytes
 
@@ -119,7 +200,7 @@ class TxOut:
         return cls(**shaped_data)
 
     def as_dict(self) -> Dict:
-        result = asdict(self)
+        result = shallow_asdict(self)
         result["script_pubkey"] = result["script_pubkey"].hex()
         return result
 
@@ -132,14 +213,32 @@ class TxOut:
         Valueは送金価格を表し、最小単位で示される。
         ScriptPubKeyは送金のためのスクリプトが記述される。(Bitcoin Scriptが用いられるが、複雑なため省略)
         """
-        block_bin = self.value.to_bytes(8, "little")
-        block_bin += int_to_bytes(len(self.script_pubkey))
-        block_bin += self.script_pubkey
-        return block_bin
+        return _serialize(self)
+
+    def serialized_size(self) -> int:
+        return 8 + int_size(len(self.script_pubkey)) + len(self.script_pubkey)
+
+    def serialize_into(self, buf, offset: int) -> int:
+        _uint64.pack_into(buf, offset, self.value)
+        return _write_bytes(buf, offset + 8, self.script_pubkey)
+
+    @classmethod
+    def from_bin(cls, data: bytes) -> "TxOut":
+        return cls.read_from(memoryview(data), 0)[0]
+
+    @classmethod
+    def read_from(cls, view: memoryview, offset: int) -> Tuple["TxOut", int]:
+        if offset + 8 > len(view):
+            raise Exception("Data is truncated")
+        value, = _uint64.unpack_from(view, offset)
+        script_pubkey, offset = _read_bytes(view, offset + 8)
+        return cls(value=value, script_pubkey=script_pubkey), offset
 
 
 @dataclass
-class Tx:
+class Tx(Cacheable):
+    __slots__ = ("version", "tx_ins", "tx_outs", "locktime")
+    _child_fields = ("tx_ins", "tx_outs")
     version: int
     tx_ins: List[TxIn]
     tx_outs: List[TxOut]
@@ -173,7 +272,10 @@ class Tx:
         return cls(**shaped_data)
 
     def as_dict(self) -> Dict:
-        return asdict(self)
+        result = shallow_asdict(self)
+        result["tx_ins"] = [tx_in.as_dict() for tx_in in self.tx_ins]
+        result["tx_outs"] = [tx_out.as_dict() for tx_out in self.tx_outs]
+        return result
 
     def as_hex(self) -> str:
         return self.as_bin().hex()
@@ -189,29 +291,79 @@ class Tx:
         TxOutの中身についてはTxOut Classを参照。
         LockTimeは簡単に言えば、設定した時刻まで送金出来ないように制限をかけられる値。0に設定されていれば、LockTimeは無効化される。
         """
-        block_bin = self.version.to_bytes(4, "little")
-        block_bin += int_to_bytes(len(self.tx_ins))
+        return self._cached("tx_bin", lambda: _serialize(self))
+
+    def serialized_size(self) -> int:
+        return self._cached("tx_size", self._serialized_size)
+
+    def _serialized_size(self) -> int:
+        size = 4 + int_size(len(self.tx_ins)) + int_size(len(self.tx_outs)) + 4
         for tx_in in self.tx_ins:
-            block_bin += tx_in.as_bin()
-        block_bin += int_to_bytes(len(self.tx_outs))
+            size += tx_in.serialized_size()
         for tx_out in self.tx_outs:
-            block_bin += tx_out.as_bin()
-        block_bin += self.locktime.to_bytes(4, "little")
+            size += tx_out.serialized_size()
+        return size
+
+    def serialize_into(self, buf, offset: int) -> int:
+        tx_bin = self._cached_value("tx_bin")
+        if tx_bin is not None:
+            buf[offset:offset + len(tx_bin)] = tx_bin
+            return offset + len(tx_bin)
+        _uint32.pack_into(buf, offset, self.version)
+        offset = write_int(buf, offset + 4, len(self.tx_ins))
+        for tx_in in self.tx_ins:
+            offset = tx_in.serialize_into(buf, offset)
+        offset = write_int(buf, offset, len(self.tx_outs))
+        for tx_out in self.tx_outs:
+            offset = tx_out.serialize_into(buf, offset)
+        _uint32.pack_into(buf, offset, self.locktime)
+        return offset + 4
 
-        return block_bin
+    @classmethod
+    def from_bin(cls, data: bytes) -> "Tx":
+        tx, offset = cls.read_from(memoryview(data), 0)
+        if offset != len(data):
+            raise Exception("Tx data has trailing bytes")
+        return tx
+
+    @classmethod
+    def read_from(cls, view: memoryview, offset: int) -> Tuple["Tx", int]:
+        if offset + 4 > len(view):
+            raise Exception("Data is truncated")
+        version, = _uint32.unpack_from(view, offset)
+        tx_in_len, offset = bytes_to_int(view, offset + 4)
+        tx_ins = []
+        for _ in range(tx_in_len):
+            tx_in, offset = TxIn.read_from(view, offset)
+            tx_ins.append(tx_in)
+        tx_out_len, offset = bytes_to_int(view, offset)
+        tx_outs = []
+        for _ in range(tx_out_len):
+            tx_out, offset = TxOut.read_from(view, offset)
+            tx_outs.append(tx_out)
+        if offset + 4 > len(view):
+            raise Exception("Data is truncated")
+        locktime, = _uint32.unpack_from(view, offset)
+        return cls(version=version, tx_ins=tx_ins, tx_outs=tx_outs, locktime=locktime), offset + 4
 
     def tx_hash(self) -> bytes:
-        block_bin = self.as_bin()
-        return sha256d(block_bin)
+        """
+        txidはシリアライズ結果とともにキャッシュされ、このTx(や中のTxIn、TxOut)が書き換えられると計算しなおされる
+        """
+        return self._cached("tx_hash", lambda: sha256d(self.as_bin()))
+
+
+def iter_txs(path: str = "../blockchain_data/tx.json") -> Iterator[Tx]:
+    """
+    tx.jsonからTxを1つずつ読み出す
+    """
+    with open(path) as f:
+        for tx in iter_json_array(f):
+            yield Tx.from_dict(tx)
 
 
 def load_txs() -> List[Tx]:
-    result = []
-    with open(f"../blockchain_data/tx.json") as f:
-        txs = json.loads(f.read())
-    for tx in txs:
-        result.append(Tx.from_dict(tx))
-    return result
+    return list(iter_txs())
 
 
 def dump_txs(txs: List[Tx]) -> None:
@@ -1,7 +1,16 @@
-from typing import Dict, List
+from dataclasses import fields
+from typing import Dict, Iterator, List, TextIO, Tuple
 
 import hashlib
 import json
+import struct
+
+
+def shallow_asdict(obj) -> Dict:
+    """
+    dataclasses.asdictと違い、入れ子になったdataclassを辞書に変換せずそのまま返す
+    """
+    return {f.name: getattr(obj, f.name) for f in fields(obj)}
 
 
 def int_to_bytes(num: int) -> bytes:
@@ -17,6 +26,43 @@ def int_to_bytes(num: int) -> bytes:
     return hed.to_bytes(1, "little") + num.to_bytes(8, "little")
 
 
+def int_size(num: int) -> int:
+    """
+    int_to_bytesで変換したときの長さ
+    """
+    if num < 0xfd:
+        return 1
+    if num <= 0xffff:
+        return 3
+    if num <= 0xffffffff:
+        return 5
+    return 9
+
+
+def write_int(buf, offset: int, num: int) -> int:
+    """
+    int_to_bytesと同じ形式でbufのoffsetの位置に書き込み、書き終わった位置を返す
+    """
+    data = int_to_bytes(num)
+    buf[offset:offset + len(data)] = data
+    return offset + len(data)
+
+
+def bytes_to_int(data, offset: int = 0) -> Tuple[int, int]:
+    """
+    int_to_bytesの逆。dataのoffsetの位置から可変長整数を読み取り、値と読み終わった位置を返す
+    """
+    if offset >= len(data):
+        raise Exception("Data is truncated")
+    hed = data[offset]
+    if hed < 0xfd:
+        return hed, offset + 1
+    size = {0xfd: 2, 0xfe: 4, 0xff: 8}[hed]
+    if offset + 1 + size > len(data):
+        raise Exception("Data is truncated")
+    return int.from_bytes(data[offset + 1:offset + 1 + size], "little"), offset + 1 + size
+
+
 def bits_to_target(bits: int) -> int:
     bitsN = (bits >> 24) & 0xff
     if not (0x03 <= bitsN <= 0x1f):
@@ -38,26 +84,70 @@ def target_to_bits(target: int) -> int:
     return bitsN << 24 | bitsBase
 
 
+def iter_json_array(f: TextIO, chunk_size: int = 1 << 16) -> Iterator:
+    """
+    JSONの配列が書かれたファイルから、要素を1つずつ読み出す。
+    ファイル全体を読み込まず、要素1つ分とchunk_size程度のバッファしか保持しない
+    """
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+
+    def fill() -> bool:
+        nonlocal buf, pos, eof
+        # 要素が大きい場合に同じ部分を何度もパースしないよう、読み込む量を倍々に増やす
+        data = f.read(max(chunk_size, len(buf) - pos))
+        if not data:
+            eof = True
+            return False
+        buf = buf[pos:] + data
+        pos = 0
+        return True
+
+    def skip_whitespace() -> str:
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buf):
+                return buf[pos]
+            if not fill():
+                raise Exception("Unexpected end of JSON array")
+
+    if skip_whitespace() != "[":
+        raise Exception("JSON array is expected")
+    pos += 1
+    if skip_whitespace() == "]":
+        return
+    while True:
+        skip_whitespace()
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+            # 数値などは途中で切れていてもパースできてしまうので、要素の後ろに区切り文字が読み込まれていることを確認する
+            rest = buf[end:end + 64].lstrip(" \t\r\n")
+            if not eof and (not rest or rest[0] not in ",]"):
+                raise ValueError("JSON array element is incomplete")
+        except ValueError:
+            if not fill():
+                raise
+            continue
+        pos = end
+        yield item
+        c = skip_whitespace()
+        if c == "]":
+            return
+        if c != ",":
+            raise Exception("',' is expected in JSON array")
+        pos += 1
+
+
 def made_merkle_root(txs: List[bytes]) -> bytes:
-    result = []
-    one = txs[0]
-    for tx in txs[1:]:
-        if one is not None:
-            result.append(sha256d(one + tx))
-            one = None
-        else:
-            one = tx
-
-    if one is not None:
-        if result:
-            result.append(sha256d(one + one))
-        else:
-            result.append(one)
-
-    if len(result) >= 2:
-        return made_merkle_root(result)
-    else:
-        return result[0]
+    """
+    merkle.merkle_rootと同じ(互換のために残している)
+    """
+    from .merkle import merkle_root
+    return merkle_root(txs)
 
 
 def sha256(x: bytes) -> bytes:
@@ -66,3 +156,99 @@ def sha256(x: bytes) -> bytes:
 
 def sha256d(x: bytes) -> bytes:
     return bytes(sha256(sha256(x)))
+
+
+# RIPEMD-160の各ラウンドで使う定数(OpenSSL 3ではhashlibからripemd160が使えないことがあるため、その場合に使う)
+_rmd_r1 = [
+    0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 7, 4, 13, 1, 10, 6, 15, 3, 12, 0, 9, 5, 2, 14, 11, 8,
+    3, 10, 14, 4, 9, 15, 8, 1, 2, 7, 0, 6, 13, 11, 5, 12, 1, 9, 11, 10, 0, 8, 12, 4, 13, 3, 7, 15, 14, 5, 6, 2,
+    4, 0, 5, 9, 7, 12, 2, 10, 14, 1, 3, 8, 11, 6, 15, 13
+]
+_rmd_r2 = [
+    5, 14, 7, 0, 9, 2, 11, 4, 13, 6, 15, 8, 1, 10, 3, 12, 6, 11, 3, 7, 0, 13, 5, 10, 14, 15, 8, 12, 4, 9, 1, 2,
+    15, 5, 1, 3, 7, 14, 6, 9, 11, 8, 12, 2, 10, 0, 4, 13, 8, 6, 4, 1, 3, 11, 15, 0, 5, 12, 2, 13, 9, 7, 10, 14,
+    12, 15, 10, 4, 1, 5, 8, 7, 6, 2, 13, 14, 0, 3, 9, 11
+]
+_rmd_s1 = [
+    11, 14, 15, 12, 5, 8, 7, 9, 11, 13, 14, 15, 6, 7, 9, 8, 7, 6, 8, 13, 11, 9, 7, 15, 7, 12, 15, 9, 11, 7, 13, 12,
+    11, 13, 6, 7, 14, 9, 13, 15, 14, 8, 13, 6, 5, 12, 7, 5, 11, 12, 14, 15, 14, 15, 9, 8, 9, 14, 5, 6, 8, 6, 5, 12,
+    9, 15, 5, 11, 6, 8, 13, 12, 5, 12, 13, 14, 11, 8, 5, 6
+]
+_rmd_s2 = [
+    8, 9, 9, 11, 13, 15, 15, 5, 7, 7, 8, 11, 14, 14, 12, 6, 9, 13, 15, 7, 12, 8, 9, 11, 7, 7, 12, 7, 6, 15, 13, 11,
+    9, 7, 15, 11, 8, 6, 6, 14, 12, 13, 5, 14, 13, 13, 7, 5, 15, 5, 8, 11, 14, 14, 6, 14, 6, 9, 12, 9, 12, 5, 15, 8,
+    8, 5, 12, 9, 12, 5, 14, 6, 8, 13, 6, 5, 15, 13, 11, 11
+]
+_rmd_k1 = [0x00000000, 0x5a827999, 0x6ed9eba1, 0x8f1bbcdc, 0xa953fd4e]
+_rmd_k2 = [0x50a28be6, 0x5c4dd124, 0x6d703ef3, 0x7a6d76e9, 0x00000000]
+
+
+def _rmd_f(j: int, x: int, y: int, z: int) -> int:
+    if j < 16:
+        return x ^ y ^ z
+    if j < 32:
+        return (x & y) | (~x & z)
+    if j < 48:
+        return (x | ~y) ^ z
+    if j < 64:
+        return (x & z) | (y & ~z)
+    return x ^ (y | ~z)
+
+
+def _ripemd160_fallback(data: bytes) -> bytes:
+    def rol(v: int, s: int) -> int:
+        v &= 0xffffffff
+        return ((v << s) | (v >> (32 - s))) & 0xffffffff
+
+    h = [0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476, 0xc3d2e1f0]
+    data = bytes(data) + b"\x80" + bytes((55 - len(data)) % 64) + (8 * len(data)).to_bytes(8, "little")
+    for block in range(0, len(data), 64):
+        x = struct.unpack_from("<16I", data, block)
+        al, bl, cl, dl, el = h
+        ar, br, cr, dr, er = h
+        for j in range(80):
+            t = rol(al + _rmd_f(j, bl, cl, dl) + x[_rmd_r1[j]] + _rmd_k1[j // 16], _rmd_s1[j]) + el
+            al, el, dl, cl, bl = el, dl, rol(cl, 10), bl, t & 0xffffffff
+            t = rol(ar + _rmd_f(79 - j, br, cr, dr) + x[_rmd_r2[j]] + _rmd_k2[j // 16], _rmd_s2[j]) + er
+            ar, er, dr, cr, br = er, dr, rol(cr, 10), br, t & 0xffffffff
+        t = (h[1] + cl + dr) & 0xffffffff
+        h[1] = (h[2] + dl + er) & 0xffffffff
+        h[2] = (h[3] + el + ar) & 0xffffffff
+        h[3] = (h[4] + al + br) & 0xffffffff
+        h[4] = (h[0] + bl + cr) & 0xffffffff
+        h[0] = t
+    return struct.pack("<5I", *h)
+
+
+def ripemd160(x: bytes) -> bytes:
+    try:
+        return hashlib.new("ripemd160", x).digest()
+    except ValueError:
+        return _ripemd160_fallback(x)
+
+
+def hash160(x: bytes) -> bytes:
+    """公開鍵からアドレス(P2PKH)のハッシュを作るときに使う。RIPEMD-160(SHA-256(x))"""
+    return ripemd160(sha256(x))
+
+
+class HeaderHasher:
+    """
+    ブロックヘッダ(80bytes)のうちnonce(末尾4bytes)以外は探索中に変化しないので、
+    先頭64bytesを処理した時点のSHA-256の内部状態(midstate)を保持しておき、nonceごとには残りの16bytesだけをハッシュする。
+    """
+
+    def __init__(self, header_prefix: bytes):
+        if len(header_prefix) != 76:
+            raise Exception(f"header prefix must be 76 bytes. got: {len(header_prefix)}")
+        self._midstate = hashlib.sha256(header_prefix[:64])
+        self._tail = header_prefix[64:]
+        self._pack_nonce = struct.Struct("<I").pack
+
+    def hash(self, nonce: int) -> bytes:
+        h = self._midstate.copy()
+        h.update(self._tail + self._pack_nonce(nonce))
+        return hashlib.sha256(h.digest()).digest()
+
+    def hash_int(self, nonce: int) -> int:
+        return int.from_bytes(self.hash(nonce), "big")
@@ -0,0 +1,265 @@
+"""
+未使用のトランザクション出力(UTXO)の集合。
+(tx_hash, index)をキーに、金額、script_pubkey、そのTxが含まれるブロックの高さを保持する。
+
+ブロックを接続(connect_block)すると、そのブロックで使われた出力を取り除き、新しく作られた出力を加える。
+切断(disconnect_block)はその逆を行う。どちらもブロック内の入出力の数に比例する時間で済み、
+ある出力が使えるかどうかは、チェーン全体を調べずに1回の参照でわかる。
+
+永続化にはsqlite3を使い、その手前に書き戻し型のキャッシュを置く。
+変更はキャッシュに溜めておき、変更の件数がflush_thresholdを超えたとき(かflush()が呼ばれたとき)にまとめて書き込む。
+書き込みは1つのトランザクションで行い、どのブロックまで反映したか(best_block)も一緒に記録する。
+"""
+from .block import Block
+from .script import Opcodes
+from .util import int_to_bytes, bytes_to_int
+
+from typing import BinaryIO, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import sqlite3
+import struct
+
+
+default_cache_size = 1 << 20
+default_flush_threshold = 1 << 16
+
+_coin_header = struct.Struct("<IBQ")  # 高さ、coinbaseかどうか、金額
+
+
+class Coin(NamedTuple):
+    value: int
+    script_pubkey: bytes
+    height: int
+    is_coinbase: bool = False
+
+    def as_bin(self) -> bytes:
+        return (
+            _coin_header.pack(self.height, self.is_coinbase, self.value) +
+            int_to_bytes(len(self.script_pubkey)) +
+            self.script_pubkey
+        )
+
+    @classmethod
+    def from_bin(cls, data: bytes) -> "Coin":
+        return cls.read_from(memoryview(data), 0)[0]
+
+    @staticmethod
+    def read_bin(f: BinaryIO) -> bytes:
+        """
+        ファイルからCoin.as_bin 1つ分のバイト列を読み出す(ファイル全体は読み込まない)
+        """
+        data = f.read(_coin_header.size + 1)
+        if len(data) == _coin_header.size + 1 and data[-1] >= 0xfd:
+            data += f.read({0xfd: 2, 0xfe: 4, 0xff: 8}[data[-1]])
+        length, offset = bytes_to_int(data, _coin_header.size)
+        data += f.read(length)
+        if len(data) != offset + length:
+            raise Exception("Data is truncated")
+        return data
+
+    @classmethod
+    def read_from(cls, view: memoryview, offset: int) -> Tuple["Coin", int]:
+        if offset + _coin_header.size > len(view):
+            raise Exception("Data is truncated")
+        height, is_coinbase, value = _coin_header.unpack_from(view, offset)
+        length, offset = bytes_to_int(view, offset + _coin_header.size)
+        if offset + length > len(view):
+            raise Exception("Data is truncated")
+        return cls(value, bytes(view[offset:offset + length]), height, bool(is_coinbase)), offset + length
+
+
+def outpoint_key(tx_hash: bytes, index: int) -> bytes:
+    """
+    UTXOのキー。OutPoint.as_binと同じ形式(tx_hash + little endianのindex)
+    """
+    return tx_hash + index.to_bytes(4, "little")
+
+
+def is_unspendable(script_pubkey: bytes) -> bool:
+    return script_pubkey[:1] == bytes([Opcodes.OP_RETURN])
+
+
+# ブロックで使われた出力の一覧。disconnect_blockで元に戻すために使う
+SpentCoins = List[Tuple[bytes, Coin]]
+
+
+def serialize_undo(spent: SpentCoins) -> bytes:
+    """
+    ブロックの取り消し用データ。使われた出力の数(可変長整数)に続いて、キー(36bytes)とCoin.as_binが並ぶ
+    """
+    return int_to_bytes(len(spent)) + b"".join(key + coin.as_bin() for key, coin in spent)
+
+
+def deserialize_undo(data: bytes) -> SpentCoins:
+    view = memoryview(data)
+    count, offset = bytes_to_int(view, 0)
+    spent = []
+    for _ in range(count):
+        key = bytes(view[offset:offset + 36])
+        coin, offset = Coin.read_from(view, offset + 36)
+        spent.append((key, coin))
+    return spent
+
+
+class UtxoSet:
+    def __init__(
+            self,
+            path: str = "../blockchain_data/utxo.sqlite",
+            cache_size: int = default_cache_size,
+            flush_threshold: int = default_flush_threshold
+    ):
+        """
+        cache_sizeはメモリ上に保持するUTXOの数の上限、flush_thresholdはディスクに書き込む前に溜めておく変更の数
+        """
+        self.cache_size = cache_size
+        self.flush_threshold = flush_threshold
+        self._db = sqlite3.connect(path)
+        self._db.execute("CREATE TABLE IF NOT EXISTS utxo (key BLOB PRIMARY KEY, coin BLOB NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value BLOB NOT NULL)")
+        self._db.commit()
+        # キャッシュの値がNoneのものは「使用済み(ディスクからも消す必要がある)」を表す
+        self._cache: Dict[bytes, Optional[Coin]] = {}
+        self._dirty = set()
+        row = self._db.execute("SELECT value FROM meta WHERE name = 'best_block'").fetchone()
+        self.best_block: Optional[bytes] = row[0] if row else None
+
+    def get(self, tx_hash: bytes, index: int) -> Optional[Coin]:
+        return self._get(outpoint_key(tx_hash, index))
+
+    def _get(self, key: bytes) -> Optional[Coin]:
+        if key in self._cache:
+            return self._cache[key]
+        row = self._db.execute("SELECT coin FROM utxo WHERE key = ?", (key,)).fetchone()
+        coin = Coin.from_bin(row[0]) if row else None
+        if coin is not None:
+            self._cache[key] = coin
+        return coin
+
+    def __contains__(self, key: bytes) -> bool:
+        return self._get(key) is not None
+
+    def add(self, key: bytes, coin: Coin) -> None:
+        self._cache[key] = coin
+        self._dirty.add(key)
+
+    def spend(self, key: bytes) -> Coin:
+        coin = self._get(key)
+        if coin is None:
+            raise Exception(f"Output {key[:32].hex()}:{int.from_bytes(key[32:], 'little')} is missing or already spent")
+        self._cache[key] = None
+        self._dirty.add(key)
+        return coin
+
+    def connect_block(self, block: Block, height: int, flush: bool = True) -> SpentCoins:
+        """
+        ブロックの全Txを順に反映し、使われた出力を返す(disconnect_blockに渡せば元に戻せる)。
+        同じブロックの前のTxの出力を使うこともできる。
+        flushがFalseなら必要になってもディスクに書き込まない(ブロックの保存より先に書き込まないよう、呼び出し元がflushする場合)。
+        使われた出力が存在しない、入力の合計より出力の合計が大きい、まだ使われていない出力と同じTxがある、
+        のいずれかに当てはまれば例外を送出し、何も変更しない
+        """
+        spent: SpentCoins = []
+        added: List[bytes] = []
+        try:
+            for tx_index, tx in enumerate(block.transactions):
+                tx_hash = tx.tx_hash()
+                is_coinbase = tx_index == 0
+                if not is_coinbase:
+                    value_in = 0
+                    for tx_in in tx.tx_ins:
+                        key = tx_in.outpoint.as_bin()
+                        coin = self.spend(key)
+                        spent.append((key, coin))
+                        value_in += coin.value
+                    if value_in < sum(tx_out.value for tx_out in tx.tx_outs):
+                        raise Exception(f"Tx {tx_hash[::-1].hex()} spends more than its inputs")
+                for index, tx_out in enumerate(tx.tx_outs):
+                    if is_unspendable(tx_out.script_pubkey):
+                        continue
+                    key = outpoint_key(tx_hash, index)
+                    if key in self:
+                        # 同じTxが二度現れた(まだ使われていない出力を上書きしてしまう)
+                        raise Exception(f"Tx {tx_hash[::-1].hex()} overwrites an unspent output")
+                    self.add(key, Coin(tx_out.value, tx_out.script_pubkey, height, is_coinbase))
+                    added.append(key)
+        except Exception:
+            # 途中まで反映した変更を取り消す(同じブロック内で作られて使われた出力は、戻した後に消す)
+            for key, coin in spent:
+                self.add(key, coin)
+            for key in added:
+                self.add(key, None)
+            raise
+
+        self.best_block = block.block_hash()
+        if flush:
+            self.maybe_flush()
+        return spent
+
+    def disconnect_block(self, block: Block, spent: SpentCoins, flush: bool = True) -> None:
+        """
+        connect_blockの逆。使われた出力を元に戻し、ブロックで作られた出力を取り除く
+        """
+        for key, coin in spent:
+            self.add(key, coin)
+        for tx in block.transactions:
+            tx_hash = tx.tx_hash()
+            for index, tx_out in enumerate(tx.tx_outs):
+                if not is_unspendable(tx_out.script_pubkey):
+                    self.add(outpoint_key(tx_hash, index), None)
+        self.best_block = block.hash_prev_block
+        if flush:
+            self.maybe_flush()
+
+    def maybe_flush(self) -> None:
+        """
+        変更がflush_threshold件以上溜まったか、キャッシュがcache_sizeを超えたときだけflushする
+        """
+        if self.needs_flush():
+            self.flush()
+
+    def needs_flush(self) -> bool:
+        return len(self._dirty) >= self.flush_threshold or len(self._cache) > self.cache_size
+
+    def flush(self) -> None:
+        """
+        キャッシュの変更を1つのトランザクションでディスクに書き込む。
+        キャッシュがcache_sizeを超えている場合は、書き込んだ後にキャッシュを空にする
+        """
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO utxo (key, coin) VALUES (?, ?)",
+                [(key, self._cache[key].as_bin()) for key in self._dirty if self._cache[key] is not None]
+            )
+            self._db.executemany(
+                "DELETE FROM utxo WHERE key = ?",
+                [(key,) for key in self._dirty if self._cache[key] is None]
+            )
+            if self.best_block is not None:
+                self._db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('best_block', ?)", (self.best_block,))
+        self._dirty = set()
+        if len(self._cache) > self.cache_size:
+            self._cache = {}
+        else:
+            self._cache = {key: coin for key, coin in self._cache.items() if coin is not None}
+
+    def items(self) -> Iterator[Tuple[bytes, Coin]]:
+        """
+        すべてのUTXOをキーの順に返す(先にflushする)
+        """
+        self.flush()
+        for key, coin in self._db.execute("SELECT key, coin FROM utxo ORDER BY key"):
+            yield key, Coin.from_bin(coin)
+
+    def __len__(self) -> int:
+        self.flush()
+        return self._db.execute("SELECT COUNT(*) FROM utxo").fetchone()[0]
+
+    def close(self) -> None:
+        self.flush()
+        self._db.close()
+
+    def __enter__(self) -> "UtxoSet":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
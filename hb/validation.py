@@ -0,0 +1,189 @@
+"""
+チェーン全体の検証。検証は2段階に分かれている。
+
+1. ブロック単体で行える検査(check_block): シリアライズ、PoW、merkle root、coinbaseの位置など。
+   ブロック同士が依存しないので、プロセスプールで並列に行う
+2. 前のブロックに依存する検査: hash_prev_blockによるつながり、bitsが難易度調整(get_targetと同じ規則)どおりか、
+   時刻、(UtxoSetを渡した場合は)使われた出力が存在するか、coinbaseが報酬と手数料より多く受け取っていないか。
+   ブロックの順に1つずつ行う
+
+ブロックはwindow個ずつまとめて1段目に渡し、1段目が次のまとまりを検査している間に、2段目が前のまとまりを検査する。
+一度にメモリに載るのは高々2つのまとまりだけなので、チェーンがいくら長くてもメモリ使用量は変わらない。
+"""
+from .block import Block, iter_blocks
+from .chainstate import ChainState
+from .config import block_reward, max_block_size, max_future_block_time
+from .merkle import merkle_root
+from .storage import BlockStore
+from .utxo import SpentCoins, UtxoSet
+from .util import bits_to_target
+
+from time import time as now_time
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import multiprocessing
+
+
+default_window = 256
+
+
+class BlockValidationError(Exception):
+    def __init__(self, height: int, reason: str):
+        super().__init__(f"Block at height {height} is invalid: {reason}")
+        self.height = height
+        self.reason = reason
+
+
+def _is_coinbase(tx) -> bool:
+    return (
+        len(tx.tx_ins) == 1 and
+        tx.tx_ins[0].outpoint.tx_hash == bytes([0]) * 32 and
+        tx.tx_ins[0].outpoint.index == 0xffffffff
+    )
+
+
+def check_block(block: Block) -> None:
+    """
+    ブロック単体で行える検査。問題があれば例外を送出する
+    """
+    if int.from_bytes(block.block_hash(), "big") >= bits_to_target(block.bits):
+        raise Exception("Block hash does not satisfy bits")
+    if not block.transactions:
+        raise Exception("Block has no transactions")
+    if block.serialized_size() > max_block_size:
+        raise Exception("Block is too large")
+    if not _is_coinbase(block.transactions[0]):
+        raise Exception("First transaction is not a coinbase")
+    for tx in block.transactions[1:]:
+        if _is_coinbase(tx):
+            raise Exception("Block has more than one coinbase")
+        if not tx.tx_ins or not tx.tx_outs:
+            raise Exception("Transaction has no inputs or outputs")
+    tx_hashes = [tx.tx_hash() for tx in block.transactions]
+    if len(set(tx_hashes)) != len(tx_hashes):
+        # 重複したTxはmerkle rootを変えずに作れてしまう(CVE-2012-2459)
+        raise Exception("Block has duplicate transactions")
+    if merkle_root(tx_hashes) != block.hash_merkle_root:
+        raise Exception("Merkle root does not match the transactions")
+
+
+def _check_block_bin(data: bytes) -> Optional[str]:
+    """
+    プロセスプールで実行する1段目。生のブロックをパースしてcheck_blockを行い、問題があればその理由を返す
+    """
+    try:
+        check_block(Block.from_bin(data))
+    except Exception as e:
+        return str(e)
+    return None
+
+
+def check_block_context(block: Block, state: ChainState) -> None:
+    """
+    stateの先頭の次のブロックとして正しいかの検査。問題があれば例外を送出する
+    """
+    if block.hash_prev_block != state.hash_prev_block:
+        raise Exception("Block does not connect to the previous block")
+    if state.tip_hash is not None and block.bits != state.next_bits():
+        raise Exception("Bits do not follow the difficulty adjustment")
+    # 同じ秒に続けて見つかったブロックも受け付けるよう、中央値と同じ時間は許す
+    if state.tip_hash is not None and block.time < state.median_time_past():
+        raise Exception("Block time is before the median time of the previous blocks")
+    if block.time > now_time() + max_future_block_time:
+        raise Exception("Block time is too far in the future")
+
+
+def check_coinbase_value(block: Block, spent: SpentCoins) -> None:
+    """
+    coinbaseの出力の合計が、マイニング報酬と手数料(使われた出力の合計からcoinbase以外の出力の合計を引いたもの)の和を
+    超えていないかの検査。spentはUtxoSet.connect_blockが返した使われた出力
+    """
+    fees = sum(coin.value for _, coin in spent) - sum(
+        tx_out.value for tx in block.transactions[1:] for tx_out in tx.tx_outs
+    )
+    if sum(tx_out.value for tx_out in block.transactions[0].tx_outs) > block_reward + fees:
+        raise Exception("Coinbase pays more than the block reward and fees")
+
+
+def _windows(blocks: Iterable[Tuple[bytes, Optional[Block]]], window: int) -> Iterator[List[Tuple[bytes, Optional[Block]]]]:
+    batch = []
+    for item in blocks:
+        batch.append(item)
+        if len(batch) >= window:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _validate(
+        blocks: Iterable[Tuple[bytes, Optional[Block]]],
+        workers: Optional[int],
+        utxo: Optional[UtxoSet],
+        window: int
+) -> ChainState:
+    state = ChainState()
+
+    def contextual(batch, errors) -> None:
+        for (data, block), error in zip(batch, errors):
+            height = state.height + 1
+            if error is not None:
+                raise BlockValidationError(height, error)
+            if block is None:
+                block = Block.from_bin(data)
+            try:
+                check_block_context(block, state)
+                if utxo is not None:
+                    spent = utxo.connect_block(block, height)
+                    if height > 0:  # ジェネシスブロックの報酬は任意(create_genesis_block)
+                        check_coinbase_value(block, spent)
+            except Exception as e:
+                raise BlockValidationError(height, str(e))
+            state.connect(block)
+
+    if workers == 1:
+        for batch in _windows(blocks, window):
+            contextual(batch, [_check_block_bin(data) for data, _ in batch])
+        return state
+
+    processes = workers or multiprocessing.cpu_count()
+    with multiprocessing.Pool(processes) as pool:
+        chunk_size = max(1, window // (4 * processes))
+        pending = None
+        for batch in _windows(blocks, window):
+            result = pool.map_async(_check_block_bin, [data for data, _ in batch], chunk_size)
+            if pending is not None:
+                contextual(pending[0], pending[1].get())
+            pending = (batch, result)
+        if pending is not None:
+            contextual(pending[0], pending[1].get())
+    return state
+
+
+def validate_chain(
+        blocks: Iterable[Block] = None,
+        workers: Optional[int] = None,
+        utxo: Optional[UtxoSet] = None,
+        window: int = default_window
+) -> ChainState:
+    """
+    ジェネシスブロックから順に並んだブロック(省略した場合はblockchain.json)を検証し、先頭の状態を返す。
+    workersは1段目のプロセス数(省略時はCPUの数)。utxoに空のUtxoSetを渡すと、使われた出力の検査も行い、UTXOセットを作る。
+    問題のあるブロックが見つかったら、その高さを持つBlockValidationErrorを送出する
+    """
+    if blocks is None:
+        blocks = iter_blocks()
+    return _validate(((block.as_bin(), block) for block in blocks), workers, utxo, window)
+
+
+def validate_store(
+        store: BlockStore,
+        workers: Optional[int] = None,
+        utxo: Optional[UtxoSet] = None,
+        window: int = default_window
+) -> ChainState:
+    """
+    BlockStoreの有効なチェーンを検証する(再インデックスなど)。生のブロックをそのまま1段目に渡すので、シリアライズの検査にもなる
+    """
+    blocks = ((store.read_bin(store.hash_at(height)), None) for height in range(store.tip_height + 1))
+    return _validate(blocks, workers, utxo, window)
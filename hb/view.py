@@ -0,0 +1,160 @@
+"""
+生のブロック(Block.as_binの形式)のバイト列の上に被せる、読み取り専用の遅延ビュー。
+フィールドはアクセスされたときに初めてデコードされ、バイト列はmemoryviewのまま参照するのでコピーされない。
+mmapしたブロックファイルと組み合わせると、大きなブロックの中の1つのTxだけを、ブロック全体をパースせずに読み出せる。
+"""
+from .block import Block
+from .tx import Tx, TxIn, TxOut
+from .util import bytes_to_int, sha256d
+
+from typing import Iterator, List
+
+import struct
+
+
+_uint32 = struct.Struct("<I")
+
+
+def _skip_bytes(view: memoryview, offset: int) -> int:
+    length, offset = bytes_to_int(view, offset)
+    return offset + length
+
+
+def _skip_tx_in(view: memoryview, offset: int) -> int:
+    return _skip_bytes(view, offset + 36) + 4
+
+
+def _skip_tx_out(view: memoryview, offset: int) -> int:
+    return _skip_bytes(view, offset + 8)
+
+
+class TxView:
+    def __init__(self, view: memoryview):
+        self.raw = view
+        self._tx_in_offsets = None
+        self._tx_out_offsets = None
+        self._end = None
+
+    def _scan(self) -> None:
+        """
+        TxIn、TxOutの位置だけを求める。長さを読んで読み飛ばすので、中身はデコードもコピーもしない
+        """
+        view = self.raw
+        count, offset = bytes_to_int(view, 4)
+        self._tx_in_offsets = []
+        for _ in range(count):
+            self._tx_in_offsets.append(offset)
+            offset = _skip_tx_in(view, offset)
+        count, offset = bytes_to_int(view, offset)
+        self._tx_out_offsets = []
+        for _ in range(count):
+            self._tx_out_offsets.append(offset)
+            offset = _skip_tx_out(view, offset)
+        self._end = offset + 4
+
+    @property
+    def version(self) -> int:
+        return _uint32.unpack_from(self.raw, 0)[0]
+
+    @property
+    def locktime(self) -> int:
+        if self._end is None:
+            self._scan()
+        return _uint32.unpack_from(self.raw, self._end - 4)[0]
+
+    @property
+    def tx_in_count(self) -> int:
+        return bytes_to_int(self.raw, 4)[0]
+
+    @property
+    def tx_out_count(self) -> int:
+        if self._tx_out_offsets is None:
+            self._scan()
+        return len(self._tx_out_offsets)
+
+    def tx_in(self, index: int) -> TxIn:
+        if self._tx_in_offsets is None:
+            self._scan()
+        return TxIn.read_from(self.raw, self._tx_in_offsets[index])[0]
+
+    def tx_out(self, index: int) -> TxOut:
+        if self._tx_out_offsets is None:
+            self._scan()
+        return TxOut.read_from(self.raw, self._tx_out_offsets[index])[0]
+
+    def tx_hash(self) -> bytes:
+        return sha256d(self.raw)
+
+    def to_tx(self) -> Tx:
+        return Tx.read_from(self.raw, 0)[0]
+
+
+class BlockView:
+    def __init__(self, view: memoryview):
+        self.raw = view
+        self._tx_offsets = None
+
+    @property
+    def version(self) -> int:
+        return _uint32.unpack_from(self.raw, 0)[0]
+
+    @property
+    def hash_prev_block(self) -> bytes:
+        return bytes(self.raw[4:36])
+
+    @property
+    def hash_merkle_root(self) -> bytes:
+        return bytes(self.raw[36:68])
+
+    @property
+    def time(self) -> int:
+        return _uint32.unpack_from(self.raw, 68)[0]
+
+    @property
+    def bits(self) -> int:
+        return _uint32.unpack_from(self.raw, 72)[0]
+
+    @property
+    def nonce(self) -> int:
+        return _uint32.unpack_from(self.raw, 76)[0]
+
+    def block_hash(self) -> bytes:
+        return sha256d(self.raw[:80])
+
+    def _tx_offset_table(self) -> List[int]:
+        """
+        各Txの先頭の位置の表。初めて必要になったときに、Txを読み飛ばしながら作る
+        """
+        if self._tx_offsets is None:
+            view = self.raw
+            count, offset = bytes_to_int(view, 80)
+            offsets = []
+            for _ in range(count):
+                offsets.append(offset)
+                in_count, offset = bytes_to_int(view, offset + 4)
+                for _ in range(in_count):
+                    offset = _skip_tx_in(view, offset)
+                out_count, offset = bytes_to_int(view, offset)
+                for _ in range(out_count):
+                    offset = _skip_tx_out(view, offset)
+                offset += 4
+            offsets.append(offset)
+            self._tx_offsets = offsets
+        return self._tx_offsets
+
+    @property
+    def tx_count(self) -> int:
+        return bytes_to_int(self.raw, 80)[0]
+
+    def tx(self, index: int) -> TxView:
+        offsets = self._tx_offset_table()
+        if not 0 <= index < len(offsets) - 1:
+            raise IndexError(index)
+        return TxView(self.raw[offsets[index]:offsets[index + 1]])
+
+    def txs(self) -> Iterator[TxView]:
+        for i in range(len(self._tx_offset_table()) - 1):
+            yield self.tx(i)
+
+    def to_block(self) -> Block:
+        return Block.read_from(self.raw, 0)[0]
@@ -0,0 +1,330 @@
+"""
+外部のマイニングワーカーに仕事(ブロックヘッダのテンプレート)を配り、見つかった解を受け付けるサーバー。
+ワーカーはそれぞれload_blocks()してブロックを組み立てる必要がなく、サーバーから受け取ったテンプレートのnonceを探すだけでよい。
+
+通信はTCPまたはUnixドメインソケット上で、1行1メッセージのJSONで行う。
+- {"method": "getblocktemplate"}
+    テンプレートと、そのワーカー専用のextranonceの範囲を返す
+- {"method": "submit", "job_id": ..., "extranonce": ..., "time": ..., "nonce": ...}
+    解(またはshare)を提出する。resultは "block", "share", "stale", "rejected" のいずれか。
+    extranonceはその接続に割り当てた範囲のものでなければならず、同じ解を二度提出することもできない
+
+チェーンの先頭が変わったら new_tip() を呼ぶ。それ以前に配ったテンプレートはすべて無効(stale)になる。
+"""
+from .block import Block
+from .chainstate import ChainState
+from .merkle import merkle_branch, merkle_root_from_branch
+from .mining import create_block_template, set_extranonce, extranonce_size
+from .config import max_future_block_time
+from .util import int_to_bytes, sha256d, bits_to_target, HeaderHasher
+
+from time import time as now_time, monotonic
+from typing import Callable, Dict, List, Optional, Tuple
+
+import copy
+import json
+import socket
+import socketserver
+import threading
+
+
+# 1回のgetblocktemplateで1ワーカーに割り当てるextranonceの数
+extranonce_range_size = 1 << 16
+# ワーカーがテンプレートを取得しなおすまでの時間(秒)
+job_refresh_interval = 5.0
+
+
+def coinbase_parts(block: Block, size: int = extranonce_size) -> Tuple[bytes, bytes]:
+    """
+    coinbaseトランザクションをextranonceの前後で分割する。ワーカーは coinbase1 + extranonce + coinbase2 でcoinbaseを復元できる
+    """
+    coinbase_tx = block.transactions[0]
+    tx_in = coinbase_tx.tx_ins[0]
+    coinbase1 = (
+        coinbase_tx.version.to_bytes(4, "little") +
+        int_to_bytes(len(coinbase_tx.tx_ins)) +
+        tx_in.outpoint.as_bin() +
+        int_to_bytes(len(tx_in.script_sig)) +
+        tx_in.script_sig[:-size]
+    )
+    coinbase_bin = coinbase_tx.as_bin()
+    return coinbase1, coinbase_bin[len(coinbase1) + size:]
+
+
+class _Job:
+    def __init__(self, job_id: str, template: Block):
+        self.job_id = job_id
+        self.template = template
+        self.coinbase1, self.coinbase2 = coinbase_parts(template)
+        self.merkle_branch = merkle_branch([tx.tx_hash() for tx in template.transactions], 0)
+        self.submitted = set()
+        # 割り当てたextranonceの範囲の先頭 -> 割り当てたワーカー(接続)
+        self.extranonce_owners: Dict[int, object] = {}
+
+
+class WorkServer:
+    def __init__(
+            self,
+            receive_address: str,
+            height: int,
+            hash_prev_block: bytes = None,
+            bits: int = None,
+            share_bits: int = None,
+            on_block: Callable[[Block], None] = None,
+            chain_state: Optional[ChainState] = None
+    ):
+        """
+        share_bitsにはbitsより易しい難易度を指定でき、それを満たす提出はshareとして数えられる(省略時はbitsと同じ)。
+        on_blockはブロックが見つかったときに呼び出される。
+        hash_prev_blockやbitsを省略した場合はchain_state(省略時はプロセス内で共有するChainState)の先頭から求める。
+        見つかったブロックがchain_stateの先頭につながる場合は、chain_stateにも接続する
+        """
+        self.receive_address = receive_address
+        self.chain_state = chain_state
+        self.on_block = on_block
+        self.share_bits = share_bits
+        self.shares = 0
+        self.blocks: List[Block] = []
+        self._lock = threading.Lock()
+        self._servers: List[socketserver.BaseServer] = []
+        self._job_counter = 0
+        self._jobs: Dict[str, _Job] = {}
+        self._job: Optional[_Job] = None
+        self._next_extranonce = 0
+        self.new_tip(hash_prev_block, height, bits)
+
+    def new_tip(self, hash_prev_block: Optional[bytes], height: int, bits: int = None) -> None:
+        """
+        チェーンの先頭が変わったときに呼ぶ。配布済みのテンプレートを破棄し、新しい先頭の上に積むテンプレートを作る
+        """
+        with self._lock:
+            self._new_tip(hash_prev_block, height, bits)
+
+    def _new_tip(self, hash_prev_block: Optional[bytes], height: int, bits: Optional[int]) -> None:
+        self.height = height
+        template = create_block_template(height, self.receive_address, hash_prev_block, bits, self.chain_state)
+        self._job_counter += 1
+        self._job = _Job(f"{self._job_counter:x}", template)
+        self._jobs = {self._job.job_id: self._job}
+        self._next_extranonce = 0
+
+    def get_block_template(self, worker: object = None) -> Dict:
+        """
+        workerは提出元を区別するための値(TCPなどでは接続ごとのハンドラ)。割り当てたextranonceの範囲はworkerだけが使える
+        """
+        with self._lock:
+            job = self._job
+            if self._next_extranonce + extranonce_range_size > 1 << (8 * extranonce_size):
+                raise Exception("Extranonce space is exhausted")
+            extranonce_start = self._next_extranonce
+            self._next_extranonce += extranonce_range_size
+            job.extranonce_owners[extranonce_start] = worker
+
+        template = job.template
+        return {
+            "job_id": job.job_id,
+            "version": template.version,
+            "hash_prev_block": template.hash_prev_block.hex(),
+            "coinbase1": job.coinbase1.hex(),
+            "coinbase2": job.coinbase2.hex(),
+            "merkle_branch": [h.hex() for h in job.merkle_branch],
+            "time": template.time,
+            "bits": template.bits,
+            "share_bits": self.share_bits or template.bits,
+            "extranonce_size": extranonce_size,
+            "extranonce_start": extranonce_start,
+            "extranonce_count": extranonce_range_size,
+        }
+
+    def submit(self, job_id: str, extranonce: int, time: int, nonce: int, worker: object = None) -> str:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return "stale"
+            extranonce_start = extranonce - extranonce % extranonce_range_size
+            if extranonce_start not in job.extranonce_owners or job.extranonce_owners[extranonce_start] is not worker:
+                # 他のワーカーの範囲のextranonceで同じヘッダを提出し、shareを二重に数えさせることを防ぐ
+                return "rejected"
+            if not 0 <= nonce <= 0xffffffff:
+                return "rejected"
+            if not job.template.time <= time <= int(now_time()) + max_future_block_time:
+                return "rejected"
+            if (extranonce, time, nonce) in job.submitted:
+                return "rejected"
+
+            # shareのたびにテンプレートのBlockをコピーして書き換えなくて済むよう、ヘッダはバイト列から組み立てる
+            template = job.template
+            coinbase_hash = sha256d(job.coinbase1 + extranonce.to_bytes(extranonce_size, "little") + job.coinbase2)
+            header = b"".join((
+                template.version.to_bytes(4, "little"),
+                template.hash_prev_block,
+                merkle_root_from_branch(coinbase_hash, job.merkle_branch),
+                time.to_bytes(4, "little"),
+                template.bits.to_bytes(4, "little"),
+                nonce.to_bytes(4, "little"),
+            ))
+            block_hash = int.from_bytes(sha256d(header), "big")
+            if block_hash >= bits_to_target(self.share_bits or template.bits):
+                return "rejected"
+            job.submitted.add((extranonce, time, nonce))
+            if block_hash >= bits_to_target(template.bits):
+                self.shares += 1
+                return "share"
+
+            block = copy.deepcopy(template)
+            set_extranonce(block, extranonce, branch=job.merkle_branch)
+            block.time = time
+            block.nonce = nonce
+            self.blocks.append(block)
+            if self.chain_state is not None and block.hash_prev_block == self.chain_state.hash_prev_block:
+                self.chain_state.connect(block)
+            # chain_stateがあれば難易度調整を反映したbitsを求めさせる。なければ同じbitsのまま続ける
+            self._new_tip(block.block_hash(), self.height + 1, None if self.chain_state is not None else block.bits)
+
+        if self.on_block is not None:
+            self.on_block(block)
+        return "block"
+
+    def handle(self, request: Dict, worker: object = None) -> Dict:
+        method = request.get("method")
+        try:
+            if method == "getblocktemplate":
+                return {"result": self.get_block_template(worker)}
+            if method == "submit":
+                return {"result": self.submit(
+                    request["job_id"], request["extranonce"], request["time"], request["nonce"], worker
+                )}
+        except (KeyError, TypeError, ValueError) as e:
+            return {"error": f"invalid request: {e}"}
+        except Exception as e:
+            # extranonceを使い切った場合やon_blockの失敗など。例外で接続を切らず、クライアントにエラーを返す
+            return {"error": str(e)}
+        return {"error": f"unknown method: {method}"}
+
+    def _handler(self):
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self) -> None:
+                for line in self.rfile:
+                    try:
+                        request = json.loads(line)
+                    except ValueError:
+                        response = {"error": "invalid json"}
+                    else:
+                        response = server.handle(request, self)
+                    self.wfile.write(json.dumps(response).encode() + b"\n")
+
+        return Handler
+
+    def serve_tcp(self, host: str = "127.0.0.1", port: int = 0) -> Tuple[str, int]:
+        """
+        別スレッドでTCPサーバーを起動し、待ち受けているアドレスを返す(port=0なら空いているポートを使う)
+        """
+        server = socketserver.ThreadingTCPServer((host, port), self._handler())
+        server.daemon_threads = True
+        self._start(server)
+        return server.server_address
+
+    def serve_unix(self, path: str) -> str:
+        server = socketserver.ThreadingUnixStreamServer(path, self._handler())
+        server.daemon_threads = True
+        self._start(server)
+        return path
+
+    def _start(self, server: socketserver.BaseServer) -> None:
+        self._servers.append(server)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def shutdown(self) -> None:
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        self._servers = []
+
+
+class WorkClient:
+    """
+    WorkServerに接続するワーカー側のクライアント。addressは(host, port)のタプルかUnixドメインソケットのパス
+    """
+
+    def __init__(self, address):
+        if isinstance(address, str):
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.connect(address)
+        self._file = self._sock.makefile("rwb")
+
+    def call(self, request: Dict) -> Dict:
+        self._file.write(json.dumps(request).encode() + b"\n")
+        self._file.flush()
+        response = json.loads(self._file.readline())
+        if "error" in response:
+            raise Exception(response["error"])
+        return response["result"]
+
+    def get_block_template(self) -> Dict:
+        return self.call({"method": "getblocktemplate"})
+
+    def submit(self, job_id: str, extranonce: int, time: int, nonce: int) -> str:
+        return self.call({"method": "submit", "job_id": job_id, "extranonce": extranonce, "time": time, "nonce": nonce})
+
+    def close(self) -> None:
+        self._file.close()
+        self._sock.close()
+
+
+def mine_job(job: Dict, deadline: float) -> List[Tuple[int, int, int]]:
+    """
+    テンプレートを受け取り、share_bitsを満たす(extranonce, time, nonce)を探す。
+    deadline(time.monotonic()の値)を過ぎるか、ブロックの解が見つかった時点で打ち切る
+    """
+    hash_prev_block = bytes.fromhex(job["hash_prev_block"])
+    coinbase1 = bytes.fromhex(job["coinbase1"])
+    coinbase2 = bytes.fromhex(job["coinbase2"])
+    merkle_branch = [bytes.fromhex(h) for h in job["merkle_branch"]]
+    share_target = bits_to_target(job["share_bits"]).to_bytes(32, "big")
+    block_target = bits_to_target(job["bits"]).to_bytes(32, "big")
+    time = job["time"]
+
+    found = []
+    for extranonce in range(job["extranonce_start"], job["extranonce_start"] + job["extranonce_count"]):
+        coinbase = coinbase1 + extranonce.to_bytes(job["extranonce_size"], "little") + coinbase2
+        header_prefix = (
+            job["version"].to_bytes(4, "little") +
+            hash_prev_block +
+            merkle_root_from_branch(sha256d(coinbase), merkle_branch) +
+            time.to_bytes(4, "little") +
+            job["bits"].to_bytes(4, "little")
+        )
+        hasher = HeaderHasher(header_prefix)
+        for start in range(0, 1 << 32, 1 << 14):
+            if monotonic() > deadline:
+                return found
+            for nonce in range(start, start + (1 << 14)):
+                block_hash = hasher.hash(nonce)
+                if block_hash < share_target:
+                    found.append((extranonce, time, nonce))
+                    if block_hash < block_target:
+                        return found
+    return found
+
+
+def run_worker(address, stop: threading.Event = None, max_jobs: int = None) -> Dict[str, int]:
+    """
+    WorkServerからテンプレートを受け取ってマイニングし、見つけた解を提出し続ける。
+    stopがセットされるか、max_jobs回テンプレートを処理したら終了し、提出結果ごとの件数を返す
+    """
+    client = WorkClient(address)
+    results = {"block": 0, "share": 0, "stale": 0, "rejected": 0}
+    jobs = 0
+    try:
+        while (stop is None or not stop.is_set()) and (max_jobs is None or jobs < max_jobs):
+            job = client.get_block_template()
+            for extranonce, time, nonce in mine_job(job, monotonic() + job_refresh_interval):
+                results[client.submit(job["job_id"], extranonce, time, nonce)] += 1
+            jobs += 1
+    finally:
+        client.close()
+    return results